@@ -0,0 +1,366 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby
+
+# Reflinks are only attempted where fcntl exists (i.e. not on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Exports a project's frames and bounding boxes into a directory laid out as
+#   labels.txt               labelUUID label_name (one label per line)
+#   frames/frameUUID.jpg     the frame image
+#   boxes/frameUUID.txt      YOLO format: labelUUID center_x center_y width height
+#
+# Exports are incremental: a manifest remembers a digest of every frame's
+# boxes from the last export, so only frames whose boxes changed (or that are
+# new) get rewritten, and frames that no longer exist are removed. Frame
+# images are only put in the export again when their URL or the version of
+# their content (see local_file_version) changed, since a hard link keeps the
+# old image if a new one replaces the file under the same URL.
+
+MANIFEST_NAME = "manifest.json"
+
+# ioctl request number for cloning a file's extents on Linux (FICLONE)
+FICLONE = 0x40049409
+
+
+# rows = rows from crud.get_project_boxes_for_export, ordered by frame
+# Yields (frame row, list of box rows) for every frame, frames without any
+# boxes get an empty list
+def group_rows_by_frame(rows):
+    for _, frame_rows in groupby(rows, key=lambda row: row.frame_id):
+        frame_rows = list(frame_rows)
+        boxes = [row for row in frame_rows if row.box_id is not None]
+        yield frame_rows[0], boxes
+
+
+# class_of = callable turning a box's label_id into the class written to the
+#            file, boxes it returns None for are left out
+def yolo_lines(frame, boxes, class_of=str):
+    lines = []
+    for box in boxes:
+        box_class = class_of(box.label_id)
+        if box_class is None:
+            continue
+        center_x = ((box.x_top_left + box.x_bottom_right) / 2) / frame.frame_width
+        center_y = ((box.y_top_left + box.y_bottom_right) / 2) / frame.frame_height
+        normalized_width = box.width / frame.frame_width
+        normalized_height = box.height / frame.frame_height
+        lines.append(
+            f"{box_class} {center_x} {center_y} {normalized_width} {normalized_height}\n"
+        )
+    return lines
+
+
+# Put a frame image at the destination without copying its bytes when
+# possible: a hard link if both are on the same file system, then a reflink
+# (copy-on-write clone) and only then a regular copy
+def link_or_copy(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as source_file, open(
+                destination, "wb"
+            ) as dest_file:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(source, destination)
+
+
+# The size and modification time of a local file, which change whenever the
+# file is written or replaced, or None if it can't be read
+def local_file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_manifest(export_path):
+    try:
+        with open(os.path.join(export_path, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(export_path, manifest):
+    # Write to a temporary file first so a crash never leaves half a manifest
+    manifest_path = os.path.join(export_path, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def write_frame(export_path, frame, lines, copy_frame, frame_changed):
+    frame_id = str(frame.frame_id)
+    if frame_changed:
+        copy_frame(
+            frame.frame_url, os.path.join(export_path, "frames", frame_id + ".jpg")
+        )
+
+    # Write to a temporary file first so that readers never see partial files
+    box_path = os.path.join(export_path, "boxes", frame_id + ".txt")
+    with open(box_path + ".tmp", "w") as boxfile:
+        boxfile.writelines(lines)
+    os.replace(box_path + ".tmp", box_path)
+
+
+# rows = streamed rows from crud.get_project_boxes_for_export
+# labels = the project's labels
+# copy_frame = callable(frame_url, destination path) that puts a frame image
+#              in the export directory
+# frame_version = callable(frame_url) returning a JSON value that changes
+#                 whenever the frame's image does, or None if it can't tell
+# Returns how many frames were written, left unchanged and removed
+def export_annotations(
+    rows,
+    labels,
+    export_path,
+    copy_frame=link_or_copy,
+    frame_version=local_file_version,
+    max_workers=8,
+):
+    os.makedirs(os.path.join(export_path, "frames"), exist_ok=True)
+    os.makedirs(os.path.join(export_path, "boxes"), exist_ok=True)
+
+    # Save all current labels and UUIDs in a single txt file
+    with open(os.path.join(export_path, "labels.txt"), "w") as labelsfile:
+        labelsfile.writelines(
+            [str(label.id) + " " + label.name + "\n" for label in labels]
+        )
+
+    previous_manifest = load_manifest(export_path)
+    manifest = {}
+    stats = {"written": 0, "unchanged": 0, "removed": 0}
+
+    # Frames are written by a pool of threads while the query keeps streaming,
+    # with a cap on how many writes can be waiting so memory stays bounded
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for frame, boxes in group_rows_by_frame(rows):
+            frame_id = str(frame.frame_id)
+            lines = yolo_lines(frame, boxes)
+            digest = hashlib.sha1("".join(lines).encode()).hexdigest()
+            entry = {
+                "frame_url": frame.frame_url,
+                "frame_version": frame_version(frame.frame_url),
+                "boxes": digest,
+            }
+            manifest[frame_id] = entry
+
+            previous_entry = previous_manifest.get(frame_id)
+            if previous_entry == entry and os.path.exists(
+                os.path.join(export_path, "boxes", frame_id + ".txt")
+            ):
+                stats["unchanged"] += 1
+                continue
+
+            frame_changed = (
+                previous_entry is None
+                or previous_entry["frame_url"] != frame.frame_url
+                or previous_entry.get("frame_version") != entry["frame_version"]
+                or not os.path.exists(
+                    os.path.join(export_path, "frames", frame_id + ".jpg")
+                )
+            )
+            pending.add(
+                pool.submit(
+                    write_frame, export_path, frame, lines, copy_frame, frame_changed
+                )
+            )
+            stats["written"] += 1
+
+            if len(pending) >= 4 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+        for future in pending:
+            future.result()
+
+    # Remove the files of frames that no longer exist
+    for frame_id in previous_manifest.keys() - manifest.keys():
+        for path in [
+            os.path.join(export_path, "frames", frame_id + ".jpg"),
+            os.path.join(export_path, "boxes", frame_id + ".txt"),
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+        stats["removed"] += 1
+
+    save_manifest(export_path, manifest)
+    return stats
+
+
+###############################################################
+# Streamed ZIP export
+###############################################################
+
+# A ZIP archive of a project can also be streamed straight to the client as
+# it is produced, without staging anything on disk:
+#   images/frameUUID.jpg     the frame image
+#   labels/frameUUID.txt     YOLO format: class_index center_x center_y width height
+#   labels/classes.txt       label names, the line number is the class index
+#   annotations.json         COCO format
+#
+# Only the current entry's compressor and small label files are ever held in
+# memory, so memory use does not depend on the size of the project.
+
+EXPORT_FORMATS = ["yolo", "coco"]
+
+
+# File-like object that zipfile writes into, the bytes are collected until
+# the generator hands them to the client
+class _ZipStreamSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    # zipfile needs to know the offset of each entry, but never seeks
+    # because the sink isn't seekable (it writes data descriptors instead)
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _new_entry(name, compress_type):
+    entry = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    entry.compress_type = compress_type
+    return entry
+
+
+# COCO needs integer IDs, so derive a 63 bit one from the frame's UUID. This
+# way images and annotations agree without keeping a mapping in memory.
+def coco_image_id(frame_id):
+    return frame_id.int >> 65
+
+
+def _coco_chunks(labels, load_frame_rows, load_box_rows, category_ids):
+    yield '{"categories": '
+    yield json.dumps(
+        [{"id": category_ids[label.id], "name": label.name} for label in labels]
+    )
+
+    yield ', "images": ['
+    separator = ""
+    for frame in load_frame_rows():
+        image = {
+            "id": coco_image_id(frame.frame_id),
+            "file_name": "images/" + str(frame.frame_id) + ".jpg",
+            "width": frame.frame_width,
+            "height": frame.frame_height,
+        }
+        yield separator + json.dumps(image)
+        separator = ", "
+
+    yield '], "annotations": ['
+    separator = ""
+    annotation_id = 1
+    for box in load_box_rows():
+        if box.box_id is None or box.label_id not in category_ids:
+            continue
+        annotation = {
+            "id": annotation_id,
+            "image_id": coco_image_id(box.frame_id),
+            "category_id": category_ids[box.label_id],
+            "bbox": [box.x_top_left, box.y_top_left, box.width, box.height],
+            "area": box.width * box.height,
+            "iscrowd": 0,
+        }
+        yield separator + json.dumps(annotation)
+        separator = ", "
+        annotation_id += 1
+    yield "]}"
+
+
+# labels = the project's labels
+# load_frame_rows = callable returning streamed rows from
+#                   crud.get_project_frames_for_export
+# load_box_rows = callable returning streamed rows from
+#                 crud.get_project_boxes_for_export
+# read_frame = callable(frame_url) returning an iterable of byte chunks
+# Yields the bytes of the ZIP archive as they are produced
+def stream_export_zip(
+    labels, load_frame_rows, load_box_rows, read_frame, formats=EXPORT_FORMATS
+):
+    sink = _ZipStreamSink()
+    class_indices = {label.id: str(index) for index, label in enumerate(labels)}
+
+    with zipfile.ZipFile(sink, mode="w", allowZip64=True) as archive:
+        if "yolo" in formats:
+            archive.writestr(
+                _new_entry("labels/classes.txt", zipfile.ZIP_DEFLATED),
+                "".join(label.name + "\n" for label in labels),
+            )
+
+        for frame, boxes in group_rows_by_frame(load_box_rows()):
+            frame_id = str(frame.frame_id)
+
+            # JPEGs are already compressed so store them as they are
+            with archive.open(
+                _new_entry("images/" + frame_id + ".jpg", zipfile.ZIP_STORED),
+                "w",
+                force_zip64=True,
+            ) as image_entry:
+                for chunk in read_frame(frame.frame_url):
+                    image_entry.write(chunk)
+                    if len(sink.chunks) > 0:
+                        yield sink.drain()
+
+            if "yolo" in formats:
+                archive.writestr(
+                    _new_entry("labels/" + frame_id + ".txt", zipfile.ZIP_DEFLATED),
+                    "".join(yolo_lines(frame, boxes, class_indices.get)),
+                )
+            if len(sink.chunks) > 0:
+                yield sink.drain()
+
+        if "coco" in formats:
+            category_ids = {label.id: index + 1 for index, label in enumerate(labels)}
+            with archive.open(
+                _new_entry("annotations.json", zipfile.ZIP_DEFLATED),
+                "w",
+                force_zip64=True,
+            ) as coco_entry:
+                for text in _coco_chunks(
+                    labels, load_frame_rows, load_box_rows, category_ids
+                ):
+                    coco_entry.write(text.encode())
+                    if len(sink.chunks) > 0:
+                        yield sink.drain()
+
+    # Closing the archive writes the central directory
+    yield sink.drain()
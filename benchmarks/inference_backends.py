@@ -0,0 +1,117 @@
+# Compares the CPU inference backends (see inference_backends.py) on the two
+# models preprocessing runs: frames per second through the object detector
+# and box embeddings per second through the feature extractor.
+#
+# Frames come from a video in test_videos, crops are random. Exports are
+# written to MODEL_EXPORT_DIR the first time a backend is used and that time
+# isn't counted.
+#
+#   python benchmarks/inference_backends.py --threads 4 --batch-size 8
+#
+# Add onnx-int8 to --backends once the quantized feature extractor has been
+# calibrated (see quantization.py).
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import torch
+
+from inference_backends import BACKENDS, EMBEDDER_BACKENDS, EMBEDDING_INPUT_SIZE
+from model_provider import build_detector, build_embedder
+
+DEFAULT_VIDEO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "test_videos",
+    "president-mckinley-oath.mp4",
+)
+
+
+def read_frames(video_path, count):
+    vidcap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        has_frame, image = vidcap.read()
+        if not has_frame:
+            break
+        frames.append(image)
+    if len(frames) == 0:
+        raise ValueError("Could not read any frames from " + video_path)
+
+    # Loop short videos to get the requested number of frames
+    while len(frames) < count:
+        frames.extend(frames[: count - len(frames)])
+    return frames
+
+
+def time_detector(backend, threads, frames, warmup):
+    detector = build_detector(backend, threads)
+    for image in frames[:warmup]:
+        detector.detect(image)
+    start = time.perf_counter()
+    for image in frames:
+        detector.detect(image)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def time_embedder(backend, threads, crop_batches, warmup):
+    embedder = build_embedder(backend, threads)
+    for crops in crop_batches[:warmup]:
+        embedder.embed(crops)
+    start = time.perf_counter()
+    for crops in crop_batches:
+        embedder.embed(crops)
+    crop_count = sum(len(crops) for crops in crop_batches)
+    return crop_count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backends", nargs="+", choices=EMBEDDER_BACKENDS, default=BACKENDS
+    )
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--video", default=DEFAULT_VIDEO)
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--crops", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.frames)
+    torch.manual_seed(0)
+    crop_batches = [
+        torch.rand(
+            min(args.batch_size, args.crops - start),
+            3,
+            EMBEDDING_INPUT_SIZE,
+            EMBEDDING_INPUT_SIZE,
+        )
+        for start in range(0, args.crops, args.batch_size)
+    ]
+
+    print(
+        f"{args.frames} frames, {args.crops} crops in batches of {args.batch_size}, "
+        f"{args.threads or 'default'} threads"
+    )
+    print(f"{'backend':<14}{'frames/s':>12}{'embeddings/s':>16}")
+    for backend in args.backends:
+        # Only the feature extractor has a quantized backend
+        detector_column = "-"
+        if backend in BACKENDS:
+            frames_per_second = time_detector(
+                backend, args.threads, frames, args.warmup
+            )
+            detector_column = f"{frames_per_second:.1f}"
+        embeddings_per_second = time_embedder(
+            backend, args.threads, crop_batches, args.warmup
+        )
+        print(f"{backend:<14}{detector_column:>12}{embeddings_per_second:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
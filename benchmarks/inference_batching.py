@@ -0,0 +1,135 @@
+# Compares concurrent preprocessing jobs calling the detection and feature
+# extraction models directly, as each background task used to, with sharing
+# them through the batching inference server (see inference_server.py).
+#
+# Each job runs its frames through the detector and the crops of the boxes
+# found through the feature extractor, as predict_bounding_boxes does, without
+# the database. Reports frames per second over all jobs and, when batching,
+# the average number of frames and crops per model call.
+#
+#   python benchmarks/inference_batching.py --jobs 1 2 4 8
+#
+# The backends and thread counts come from the same environment variables as
+# the server's (DETECTOR_BACKEND, EMBEDDER_BACKEND, ...).
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import torch
+import torchvision.transforms.functional as TF
+
+from inference_server import InferenceServer
+import model_provider
+from preprocessing import crop_box
+
+DEFAULT_VIDEO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "test_videos",
+    "president-mckinley-oath.mp4",
+)
+
+
+# Every frame, unlike preprocessing's one per second, looping short videos
+def read_frames(video_path, count):
+    vidcap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        has_frame, image = vidcap.read()
+        if not has_frame:
+            break
+        frames.append(image)
+    if len(frames) == 0:
+        raise ValueError("Could not read any frames from " + video_path)
+    while len(frames) < count:
+        frames.extend(frames[: count - len(frames)])
+    return frames
+
+
+def run_job(models, frames):
+    for image in frames:
+        results = models.detect(image)
+        frame_tensor = TF.to_tensor(image)
+        crops = [
+            crop_box(
+                frame_tensor,
+                int(box.xyxy[0][0]),
+                int(box.xyxy[0][1]),
+                int(box.xywh[0][2]),
+                int(box.xywh[0][3]),
+            )
+            for box in results.boxes
+        ]
+        if len(crops) > 0:
+            models.embed(torch.cat(crops))
+
+
+class DirectModels:
+    def detect(self, image):
+        return model_provider.detector.get().detect(image)
+
+    def embed(self, crops):
+        return model_provider.embedder.get().embed(crops)
+
+
+# Returns frames per second over all of the jobs
+def time_jobs(models, jobs, frames):
+    threads = [
+        threading.Thread(target=run_job, args=(models, frames)) for _ in range(jobs)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return jobs * len(frames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--video", default=DEFAULT_VIDEO)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--max-batch-frames", type=int, default=8)
+    parser.add_argument("--max-batch-crops", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.frames)
+    model_provider.load_all()
+    # Warm up both models
+    run_job(DirectModels(), frames[:2])
+
+    print(
+        f"{args.frames} frames per job, batches of up to {args.max_batch_frames} "
+        f"frames and {args.max_batch_crops} crops, {args.max_wait_ms} ms wait"
+    )
+    print(
+        f"{'jobs':>6}{'direct frames/s':>18}{'batched frames/s':>19}"
+        f"{'frames/batch':>15}{'crops/batch':>14}"
+    )
+    for jobs in args.jobs:
+        direct = time_jobs(DirectModels(), jobs, frames)
+        server = InferenceServer(
+            model_provider.detector,
+            model_provider.embedder,
+            args.max_batch_frames,
+            args.max_batch_crops,
+            args.max_wait_ms / 1000,
+        )
+        batched = time_jobs(server, jobs, frames)
+        server.close()
+        print(
+            f"{jobs:>6}{direct:>18.1f}{batched:>19.1f}"
+            f"{server.detection_batcher.average_batch_size():>15.1f}"
+            f"{server.embedding_batcher.average_batch_size():>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Measures how long a fresh process takes to get ready and how much memory it
+# holds at that point, for each way the server can be run:
+#
+#   api     importing main with SERVER_MODE=api
+#   all     importing main with SERVER_MODE=all (models load on first upload)
+#   worker  importing worker.py and loading the models, as it does on start
+#
+# Each mode runs in its own interpreter. Importing main connects to the
+# database, so the .env file has to be set up as for the server:
+#
+#   python benchmarks/startup.py --repeat 3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VISION_MODULES = ["cv2", "torch", "torchvision", "ultralytics", "efficientnet_pytorch"]
+
+MODES = {
+    "api": ("api", "import main"),
+    "all": ("all", "import main"),
+    "worker": ("api", "import worker; worker.model_provider.load_all()"),
+}
+
+# Runs in the child process. ru_maxrss is in kilobytes on Linux.
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "vision_modules": [m for m in {modules!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure(mode):
+    server_mode, statement = MODES[mode]
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            CHILD.format(statement=statement, modules=VISION_MODULES),
+        ],
+        cwd=ROOT,
+        env={**os.environ, "SERVER_MODE": server_mode},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'seconds':>10}{'peak RSS MB':>14}  vision modules loaded")
+    for mode in args.modes:
+        runs = [measure(mode) for _ in range(args.repeat)]
+        # The fastest run is the least disturbed by the rest of the machine
+        best = min(runs, key=lambda run: run["seconds"])
+        print(
+            f"{mode:<10}{best['seconds']:>10.2f}{best['rss_mb']:>14.0f}  "
+            + (", ".join(best["vision_modules"]) or "none")
+        )
+
+
+if __name__ == "__main__":
+    main()
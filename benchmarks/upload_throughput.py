@@ -0,0 +1,105 @@
+# Measures how quickly preprocessing can push frame images to storage,
+# comparing one upload at a time (what preprocess_video used to do) with the
+# storage backend's batched, concurrent uploads and with a frame pack.
+#
+# Runs offline against the in-memory backend, with a simulated round trip
+# per request standing in for the network latency of a real storage account:
+#
+#   python benchmarks/upload_throughput.py --frames 500 --latency-ms 20
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import InMemoryStorage
+from frame_pack import open_frame_pack, PACK_NAME
+
+
+def run_serial(frames, latency):
+    storage = InMemoryStorage(upload_concurrency=1, latency=latency)
+    start = time.perf_counter()
+    for index, frame in enumerate(frames):
+        storage.write("benchmark", f"video/frames/{index}.jpg", frame)
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return elapsed, len(frames)
+
+
+def run_batched(frames, latency, concurrency):
+    storage = InMemoryStorage(upload_concurrency=concurrency, latency=latency)
+    start = time.perf_counter()
+    uploads = storage.batch_uploader("benchmark")
+    for index, frame in enumerate(frames):
+        uploads.write(f"video/frames/{index}.jpg", frame)
+    uploads.wait()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return elapsed, len(frames)
+
+
+# Appends go through the backend's open_append file, one request per flush
+class _CountingStorage(InMemoryStorage):
+    def open_append(self, project_name, path):
+        append_file = super().open_append(project_name, path)
+        storage = self
+        original_write = append_file.write
+
+        def write(data):
+            if storage.latency > 0:
+                time.sleep(storage.latency)
+            storage.requests += 1
+            return original_write(data)
+
+        append_file.write = write
+        return append_file
+
+
+def run_pack(frames, latency):
+    storage = _CountingStorage(upload_concurrency=1, latency=latency)
+    storage.requests = 0
+    start = time.perf_counter()
+    frame_pack = open_frame_pack(storage, "benchmark", "video/frames/" + PACK_NAME)
+    for frame in frames:
+        frame_pack.add(frame)
+    frame_pack.close()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    return elapsed, storage.requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--frame-kb", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 8, 16])
+    args = parser.parse_args()
+
+    frames = [os.urandom(args.frame_kb * 1024) for _ in range(args.frames)]
+    latency = args.latency_ms / 1000
+    total_mb = args.frames * args.frame_kb / 1024
+
+    results = [("serial", *run_serial(frames, latency))]
+    for concurrency in args.concurrency:
+        results.append(
+            (f"batched x{concurrency}", *run_batched(frames, latency, concurrency))
+        )
+    results.append(("frame pack", *run_pack(frames, latency)))
+
+    print(
+        f"{args.frames} frames of {args.frame_kb} KB, "
+        f"{args.latency_ms:g} ms simulated latency per request"
+    )
+    print(f"{'mode':<14}{'seconds':>10}{'frames/s':>12}{'MB/s':>10}{'requests':>10}")
+    for mode, elapsed, requests in results:
+        print(
+            f"{mode:<14}{elapsed:>10.2f}{args.frames / elapsed:>12.1f}"
+            f"{total_mb / elapsed:>10.1f}{requests:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Perceptual hashes of frames, used to skip running the models on frames that
+# look the same as one already preprocessed in the project: the new frame
+# gets a copy of that frame's predicted boxes instead (see
+# preprocessing.preprocess_video).
+#
+# The hash is a 64 bit difference hash: the frame is shrunk to a 9x8
+# grayscale thumbnail and each bit says whether a pixel is brighter than the
+# one to its right. Re-encoding, noise and small shifts change only a few
+# bits, so frames are near duplicates when their hashes differ in at most a
+# few bits (their Hamming distance).
+
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+
+# Number of set bits in each byte value
+_BYTE_BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1
+)
+
+
+# Returns the frame's (an image as returned by OpenCV) hash as a signed 64
+# bit integer, which is what the frames table stores
+def perceptual_hash(image):
+    import cv2
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(
+        gray, (HASH_WIDTH + 1, HASH_HEIGHT), interpolation=cv2.INTER_AREA
+    )
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).reshape(-1)
+    return int(np.packbits(bits).view(">i8")[0])
+
+
+def hamming_distances(hashes, frame_hash):
+    differing = np.bitwise_xor(hashes, np.int64(frame_hash))
+    return _BYTE_BIT_COUNTS[differing.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+# The hashes of a project's frames whose boxes can be copied
+class FrameHashIndex:
+    # rows = (frame ID, hash) pairs to start with
+    def __init__(self, rows=()):
+        self.frame_ids = []
+        self.hashes = np.empty(1024, dtype=np.int64)
+        for frame_id, frame_hash in rows:
+            self.add(frame_id, frame_hash)
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def add(self, frame_id, frame_hash):
+        if len(self.frame_ids) == len(self.hashes):
+            self.hashes = np.resize(self.hashes, 2 * len(self.hashes))
+        self.hashes[len(self.frame_ids)] = frame_hash
+        self.frame_ids.append(frame_id)
+
+    # Returns the ID of the frame whose hash is closest to frame_hash, if it
+    # differs in at most max_distance bits, otherwise None. Between frames
+    # that are as close, the one added last wins, which is usually the
+    # previous frame of the same video.
+    def nearest(self, frame_hash, max_distance):
+        if len(self.frame_ids) == 0:
+            return None
+        distances = hamming_distances(self.hashes[: len(self.frame_ids)], frame_hash)
+        # argmin returns the first of the smallest, search from the end
+        last_closest = len(distances) - 1 - int(np.argmin(distances[::-1]))
+        if distances[last_closest] > max_distance:
+            return None
+        return self.frame_ids[last_closest]
@@ -0,0 +1,179 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+# Packed frame storage: instead of one JPEG file (or blob) per frame, all of a
+# video's frames are appended to a single pack file, and an index file next
+# to it records where each frame starts and how long it is. Frames are
+# buffered and written in large sequential appends, which avoids creating
+# millions of tiny files and makes far fewer object store requests.
+#
+# A packed frame's frame_url is "<directory>/frames.pack#<frame number>".
+#
+# Frames become readable once the batch they are in has been flushed, so
+# while a video is still being preprocessed its newest frames may not be
+# readable yet.
+
+PACK_NAME = "frames.pack"
+PACK_SEPARATOR = "#"
+INDEX_SUFFIX = ".idx"
+
+# One index entry per frame: offset into the pack and length, little endian
+INDEX_ENTRY = struct.Struct("<QI")
+
+# Frames are appended to the pack in batches of about this many bytes
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def frame_pack_url(pack_path, frame_number):
+    return pack_path + PACK_SEPARATOR + str(frame_number)
+
+
+def is_packed_frame(frame_url):
+    return PACK_NAME + PACK_SEPARATOR in frame_url
+
+
+# Returns (pack path, frame number) of a packed frame's frame_url
+def parse_frame_pack_url(frame_url):
+    pack_path, frame_number = frame_url.rsplit(PACK_SEPARATOR, 1)
+    return pack_path, int(frame_number)
+
+
+class FramePackWriter:
+    # pack_file, index_file = file-like objects that are written to in order
+    def __init__(self, pack_file, index_file, batch_bytes=DEFAULT_BATCH_BYTES):
+        self.pack_file = pack_file
+        self.index_file = index_file
+        self.batch_bytes = batch_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.offset = 0
+        self.frame_count = 0
+
+    # Returns the frame number of the added frame
+    def add(self, image_bytes):
+        self.pending.append(image_bytes)
+        self.pending_bytes += len(image_bytes)
+        frame_number = self.frame_count
+        self.frame_count += 1
+        if self.pending_bytes >= self.batch_bytes:
+            self.flush()
+        return frame_number
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        index_entries = []
+        for image_bytes in self.pending:
+            index_entries.append(INDEX_ENTRY.pack(self.offset, len(image_bytes)))
+            self.offset += len(image_bytes)
+
+        # The frames go in before their index entries, so readers never see
+        # an entry for data that hasn't been written yet
+        self.pack_file.write(b"".join(self.pending))
+        self.pack_file.flush()
+        self.index_file.write(b"".join(index_entries))
+        self.index_file.flush()
+
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.pack_file.close()
+        self.index_file.close()
+
+
+# storage = a storage.StorageBackend
+def open_frame_pack(storage, project_name, pack_path, batch_bytes=DEFAULT_BATCH_BYTES):
+    return FramePackWriter(
+        storage.open_append(project_name, pack_path),
+        storage.open_append(project_name, pack_path + INDEX_SUFFIX),
+        batch_bytes,
+    )
+
+
+# Returns the bytes of a packed frame. Packs on local disk are read through
+# mmap, others with two ranged reads (index entry, then the frame itself).
+def read_packed_frame(storage, project_name, frame_url):
+    pack_path, frame_number = parse_frame_pack_url(frame_url)
+    local_pack_path = storage.local_path(project_name, pack_path)
+    if local_pack_path is not None:
+        return frame_pack_readers.read(frame_pack_url(local_pack_path, frame_number))
+
+    entry = storage.read_range(
+        project_name,
+        pack_path + INDEX_SUFFIX,
+        frame_number * INDEX_ENTRY.size,
+        INDEX_ENTRY.size,
+    )
+    if len(entry) < INDEX_ENTRY.size:
+        raise FileNotFoundError("Frame " + frame_url + " has not been written yet")
+    offset, length = INDEX_ENTRY.unpack(entry)
+    return storage.read_range(project_name, pack_path, offset, length)
+
+
+class FramePackReader:
+    def __init__(self, pack_path):
+        with open(pack_path + INDEX_SUFFIX, "rb") as index_file:
+            stat = os.fstat(index_file.fileno())
+            self.index_identity = (stat.st_ino, stat.st_size)
+            self.index = index_file.read()
+        self.frame_count = len(self.index) // INDEX_ENTRY.size
+
+        self.pack = None
+        if self.frame_count > 0:
+            with open(pack_path, "rb") as pack_file:
+                self.pack = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, frame_number):
+        if not 0 <= frame_number < self.frame_count:
+            raise IndexError(frame_number)
+        offset, length = INDEX_ENTRY.unpack_from(
+            self.index, frame_number * INDEX_ENTRY.size
+        )
+        return self.pack[offset : offset + length]
+
+
+# Keeps readers of recently used packs open. Evicted readers aren't closed
+# explicitly since another thread may still be reading from them, their
+# mmap is released once the last reference goes away.
+class FramePackReaderCache:
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.readers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_reader(self, pack_path):
+        stat = os.stat(pack_path + INDEX_SUFFIX)
+        with self.lock:
+            reader = self.readers.get(pack_path)
+            if reader is not None:
+                self.readers.move_to_end(pack_path)
+                if reader.index_identity == (stat.st_ino, stat.st_size):
+                    return reader
+
+        # Not opened yet, the pack has grown since it was opened, or it was
+        # written again from scratch
+        reader = FramePackReader(pack_path)
+        with self.lock:
+            self.readers[pack_path] = reader
+            self.readers.move_to_end(pack_path)
+            while len(self.readers) > self.max_open:
+                self.readers.popitem(last=False)
+        return reader
+
+    # Returns the bytes of a locally stored packed frame
+    def read(self, frame_url):
+        pack_path, frame_number = parse_frame_pack_url(frame_url)
+        reader = self._get_reader(pack_path)
+        try:
+            return reader.read(frame_number)
+        except IndexError:
+            raise FileNotFoundError("Frame " + frame_url + " has not been written yet")
+
+
+frame_pack_readers = FramePackReaderCache()
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Picks which frames of a video are preprocessed, set per project (see
+# PUT /projects/{project_id}/sampling):
+#
+#   fixed     one frame per second of video
+#   adaptive  a frame whenever the picture has changed enough since the last
+#             frame that was picked, checked every min_interval seconds, and
+#             at least one every max_interval seconds
+#
+# Adaptive sampling spends the models on what's new in a video. Footage from
+# a static camera gets a frame every max_interval seconds instead of one
+# every second, while a fast cut is picked up within min_interval seconds.
+
+# Frames are compared as grayscale thumbnails of this many pixels square
+SIGNATURE_SIZE = 32
+HISTOGRAM_BINS = 32
+
+
+# A small grayscale thumbnail of a frame (as returned by OpenCV), cheap to
+# compare with others
+def frame_signature(image):
+    import cv2
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(
+        gray, (SIGNATURE_SIZE, SIGNATURE_SIZE), interpolation=cv2.INTER_AREA
+    )
+
+
+# How different two frames look, from 0 (the same) to 1. Takes the larger of
+# the mean pixel difference, which catches motion, and the difference between
+# the brightness histograms, which catches cuts between similar looking
+# scenes and isn't thrown off by noise.
+def signature_difference(signature, other_signature):
+    pixel_difference = (
+        np.abs(signature.astype(np.int16) - other_signature.astype(np.int16)).mean()
+        / 255
+    )
+    histogram, _ = np.histogram(signature, bins=HISTOGRAM_BINS, range=(0, 256))
+    other_histogram, _ = np.histogram(
+        other_signature, bins=HISTOGRAM_BINS, range=(0, 256)
+    )
+    histogram_difference = np.abs(histogram - other_histogram).sum() / (
+        2 * signature.size
+    )
+    return float(max(pixel_difference, histogram_difference))
+
+
+class SceneChangeSampler:
+    def __init__(self, threshold, max_interval):
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.last_signature = None
+        self.last_time = None
+
+    # Whether to keep the frame at time seconds into the video. Frames have
+    # to be offered in order.
+    def keep(self, time, signature):
+        keep = (
+            self.last_signature is None
+            or time - self.last_time >= self.max_interval
+            or signature_difference(signature, self.last_signature) >= self.threshold
+        )
+        if keep:
+            self.last_signature = signature
+            self.last_time = time
+        return keep
+
+
+# Yields (frame number, has_frame, image) for each frame to preprocess, where
+# has_frame is False if the frame couldn't be read.
+# settings = the project (a models.Project) or anything else with its
+# sampling_mode, min_sample_interval, max_sample_interval and
+# scene_change_threshold
+def sample_frames(vidcap, num_frames, fps, settings):
+    if settings.sampling_mode == "adaptive":
+        yield from _sample_adaptively(vidcap, num_frames, fps, settings)
+        return
+
+    import cv2
+
+    for frame in np.arange(0, num_frames, fps):
+        vidcap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        has_frame, image = vidcap.read()
+        yield frame, has_frame, image
+
+
+# Reads through the video in order, only converting the frames that are
+# checked (every min_interval seconds) into images
+def _sample_adaptively(vidcap, num_frames, fps, settings):
+    step = max(1, round(fps * settings.min_sample_interval))
+    sampler = SceneChangeSampler(
+        settings.scene_change_threshold, settings.max_sample_interval
+    )
+
+    kept_any = False
+    frame = 0
+    while frame < num_frames:
+        if not vidcap.grab():
+            # The frame count is only an estimate for some formats, so
+            # running out of frames early only matters if there were none
+            if not kept_any:
+                yield frame, False, None
+            return
+        if frame % step == 0:
+            has_frame, image = vidcap.retrieve()
+            if not has_frame:
+                yield frame, False, None
+                return
+            if sampler.keep(frame / fps, frame_signature(image)):
+                kept_any = True
+                yield frame, True, image
+        frame += 1
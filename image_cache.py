@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# Downscaled variants of frame images (e.g. thumbnails for grid views) are
+# generated on demand and kept in a directory on disk. The directory is
+# bounded in size, across every process sharing it: once it grows past
+# max_bytes, the least recently used variants are deleted.
+#
+# OpenCV is only imported once a variant actually has to be generated.
+
+# fmt query parameter -> (file extension, media type)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+
+
+# data = encoded image bytes
+# width = width of the variant, images are never scaled up
+# quality = 1 to 100, ignored for PNG
+# Returns the variant's encoded bytes
+def resize_image(data, width, quality, fmt):
+    import cv2
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+
+    height, original_width = image.shape[:2]
+    if width is not None and width < original_width:
+        new_height = max(1, round(height * width / original_width))
+        # INTER_AREA avoids aliasing when shrinking by large factors
+        image = cv2.resize(image, (width, new_height), interpolation=cv2.INTER_AREA)
+
+    if fmt == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = []
+
+    is_success, buffer = cv2.imencode(IMAGE_FORMATS[fmt][0], image, params)
+    if not is_success:
+        raise ValueError("Could not encode image as " + fmt)
+    return buffer.tobytes()
+
+
+class ThumbnailCache:
+    # rescan_bytes = how much this process writes between totalling up the
+    # directory, by default a sixteenth of max_bytes
+    def __init__(self, directory, max_bytes, rescan_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if rescan_bytes is None:
+            rescan_bytes = max(1, max_bytes // 16)
+        self.rescan_bytes = rescan_bytes
+        self.lock = threading.Lock()
+        self.written_since_scan = 0
+
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self._evict()
+
+    def _file_name(self, key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    # Returns the cached bytes for the key, or None
+    def get(self, key):
+        path = os.path.join(self.directory, self._file_name(key))
+        try:
+            with open(path, "rb") as variant_file:
+                data = variant_file.read()
+            # The modification time is when the variant was last used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        name = self._file_name(key)
+
+        # Write to a temporary file first so that readers never see partial
+        # files, dot files are skipped when totalling up the directory
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, os.path.join(self.directory, name))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self.lock:
+            self.written_since_scan += len(data)
+            if self.written_since_scan >= self.rescan_bytes:
+                self._evict()
+
+    # Every API worker process can write to the directory, so its size is
+    # totalled up from the files themselves rather than tracked in memory.
+    # The directory can outgrow max_bytes by at most rescan_bytes for each
+    # process between scans.
+    def _evict(self):
+        self.written_since_scan = 0
+        files = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+            total_bytes += stat.st_size
+
+        # Least recently used first
+        for _, name, size in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
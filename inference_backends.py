@@ -0,0 +1,299 @@
+import os
+import re
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+
+# Backends that run the detection and feature extraction models on the CPU:
+#
+#   torch        the models as they are, run eagerly by PyTorch
+#   torchscript  traced, frozen and optimized for inference with TorchScript
+#   onnx         exported to ONNX and run by ONNX Runtime
+#
+# Every backend of a kind takes the same input and returns the same output,
+# so they can be swapped through configuration (see model_provider.py).
+# Exported models are written once to an export directory, named after the
+# version of the weights they were exported from, and reused after that.
+#
+# threads = size of the backend's intra-op thread pool, 0 for the library's
+# default. ONNX Runtime sessions each have their own pool, while everything
+# that runs on PyTorch (eager and TorchScript) shares the process' pool.
+
+BACKENDS = ("torch", "torchscript", "onnx")
+
+# The feature extractor can also run as an ONNX model with INT8 weights and
+# activations, which has to be calibrated first (see quantization.py)
+EMBEDDER_BACKENDS = BACKENDS + ("onnx-int8",)
+QUANTIZED_ONNX_SUFFIX = ".int8.onnx"
+
+# Boxes are cropped and resized to this many pixels square before their
+# features are extracted
+EMBEDDING_INPUT_SIZE = 64
+
+ONNX_OPSET = 13
+
+
+def _set_torch_threads(threads):
+    import torch
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+
+# A version tag (see model_registry.py) as part of a file name
+def export_file_name(version_tag, suffix):
+    return re.sub(r"[^A-Za-z0-9._-]", "_", version_tag) + suffix
+
+
+# Writes to a temporary file in the export directory first so that other
+# processes never load a partial export. write = callable given the path.
+def _write_export(export_path, write):
+    os.makedirs(os.path.dirname(export_path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(export_path),
+        prefix=".",
+        suffix=os.path.splitext(export_path)[1],
+    )
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, export_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+###############################################################
+# Detectors
+###############################################################
+
+
+class Detector(ABC):
+    # image = a decoded frame as returned by OpenCV
+    # Returns the ultralytics Results of the frame, whose boxes have xyxy,
+    # xywh and cls and whose names map class IDs to label names
+    @abstractmethod
+    def detect(self, image):
+        raise NotImplementedError
+
+    # Returns the Results of each image, in order. Backends that can run
+    # several frames in one forward pass override this.
+    def detect_batch(self, images):
+        return [self.detect(image) for image in images]
+
+
+# ultralytics runs all three formats itself, picking the runtime from the
+# file it's given
+class YOLODetector(Detector):
+    # model_path = .pt weights, or a .torchscript or .onnx export of them
+    def __init__(self, model_path, threads=0):
+        from ultralytics import YOLO
+
+        _set_torch_threads(threads)
+        self.model = YOLO(model_path, task="detect")
+        # Exports are made with a fixed batch size of 1
+        self.batched = model_path.endswith(".pt")
+
+    def detect(self, image):
+        return self.model(image)[0]
+
+    def detect_batch(self, images):
+        if not self.batched:
+            return super().detect_batch(images)
+        return self.model(list(images))
+
+
+YOLO_EXPORT_SUFFIXES = {"torchscript": ".torchscript", "onnx": ".onnx"}
+
+
+# Returns the path of the exported detector, exporting it first if needed.
+# weights_path = the .pt weights, downloaded first if they're missing
+def export_detector(weights_path, backend, export_dir, version_tag):
+    export_path = os.path.join(
+        export_dir, export_file_name(version_tag, YOLO_EXPORT_SUFFIXES[backend])
+    )
+    if os.path.exists(export_path):
+        return export_path
+
+    from ultralytics import YOLO
+
+    if not os.path.exists(weights_path):
+        YOLO(weights_path)
+
+    # ultralytics writes the export next to the weights, so export from a
+    # copy rather than writing into the model registry
+    os.makedirs(export_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=export_dir) as work_dir:
+        work_weights = os.path.join(work_dir, "model.pt")
+        shutil.copyfile(weights_path, work_weights)
+        exported = YOLO(work_weights).export(format=backend)
+        _write_export(export_path, lambda path: shutil.copyfile(exported, path))
+    return export_path
+
+
+def create_detector(backend, weights_path, export_dir, version_tag, threads=0):
+    if backend == "torch":
+        return YOLODetector(weights_path, threads)
+    if backend in YOLO_EXPORT_SUFFIXES:
+        return YOLODetector(
+            export_detector(weights_path, backend, export_dir, version_tag), threads
+        )
+    raise ValueError("Unknown detector backend " + backend)
+
+
+###############################################################
+# Embedders
+###############################################################
+
+
+class Embedder(ABC):
+    # crops = float tensor of shape (N, 3, EMBEDDING_INPUT_SIZE,
+    # EMBEDDING_INPUT_SIZE)
+    # Returns the EfficientNet features of each crop as a float tensor of
+    # shape (N, 1280, 2, 2)
+    @abstractmethod
+    def embed(self, crops):
+        raise NotImplementedError
+
+
+class TorchEmbedder(Embedder):
+    # model = an EfficientNet in eval mode
+    def __init__(self, model, threads=0):
+        _set_torch_threads(threads)
+        self.model = model
+
+    def embed(self, crops):
+        import torch
+
+        with torch.no_grad():
+            return self.model.extract_features(crops)
+
+
+# Wraps extract_features as the forward pass so that it can be traced. The
+# memory efficient Swish is a custom autograd function that can't be traced
+# or exported, the plain one computes the same thing.
+def _feature_extractor(model):
+    import torch
+
+    class FeatureExtractor(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, crops):
+            return self.model.extract_features(crops)
+
+    model.set_swish(memory_efficient=False)
+    return FeatureExtractor().eval()
+
+
+def _example_crops(batch_size=2):
+    import torch
+
+    return torch.rand(batch_size, 3, EMBEDDING_INPUT_SIZE, EMBEDDING_INPUT_SIZE)
+
+
+class TorchScriptEmbedder(Embedder):
+    def __init__(self, export_path, threads=0):
+        import torch
+
+        _set_torch_threads(threads)
+        self.module = torch.jit.load(export_path, map_location="cpu")
+
+    def embed(self, crops):
+        import torch
+
+        with torch.no_grad():
+            return self.module(crops)
+
+
+def export_torchscript_embedder(model, export_path):
+    import torch
+
+    def write(path):
+        with torch.no_grad():
+            traced = torch.jit.trace(_feature_extractor(model), _example_crops())
+            # Folds the weights and batch norms into the graph as constants
+            optimized = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        torch.jit.save(optimized, path)
+
+    _write_export(export_path, write)
+
+
+class OnnxEmbedder(Embedder):
+    def __init__(self, export_path, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = threads
+        # Only one crop batch runs at a time, so there's nothing to run in
+        # parallel between operators
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            export_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, crops):
+        import torch
+
+        (features,) = self.session.run(None, {self.input_name: crops.numpy()})
+        return torch.from_numpy(features)
+
+
+def export_onnx_embedder(model, export_path):
+    import torch
+
+    def write(path):
+        with torch.no_grad():
+            torch.onnx.export(
+                _feature_extractor(model),
+                _example_crops(),
+                path,
+                input_names=["crops"],
+                output_names=["features"],
+                dynamic_axes={"crops": {0: "batch"}, "features": {0: "batch"}},
+                opset_version=ONNX_OPSET,
+            )
+
+    _write_export(export_path, write)
+
+
+EMBEDDER_EXPORTS = {
+    "torchscript": (".torchscript", export_torchscript_embedder, TorchScriptEmbedder),
+    "onnx": (".onnx", export_onnx_embedder, OnnxEmbedder),
+}
+
+
+def embedder_export_path(backend, export_dir, version_tag):
+    if backend == "onnx-int8":
+        suffix = QUANTIZED_ONNX_SUFFIX
+    else:
+        suffix = EMBEDDER_EXPORTS[backend][0]
+    return os.path.join(export_dir, export_file_name(version_tag, suffix))
+
+
+# load_model = callable returning the EfficientNet in eval mode, only called
+# if the backend runs it eagerly or it hasn't been exported yet
+def create_embedder(backend, load_model, export_dir, version_tag, threads=0):
+    if backend == "torch":
+        return TorchEmbedder(load_model(), threads)
+    if backend == "onnx-int8":
+        export_path = embedder_export_path(backend, export_dir, version_tag)
+        if not os.path.exists(export_path):
+            raise FileNotFoundError(
+                export_path + " doesn't exist yet, create it with "
+                "python quantization.py calibrate-embedder"
+            )
+        return OnnxEmbedder(export_path, threads)
+    if backend not in EMBEDDER_EXPORTS:
+        raise ValueError("Unknown embedder backend " + backend)
+
+    _, export, embedder_class = EMBEDDER_EXPORTS[backend]
+    export_path = embedder_export_path(backend, export_dir, version_tag)
+    if not os.path.exists(export_path):
+        export(load_model(), export_path)
+    return embedder_class(export_path, threads)
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Runs the detection and feature extraction models for every preprocessing
+# job in the process. Instead of each job calling the models from its own
+# thread, jobs queue their frames and crops here and get the results back
+# through futures. One thread per model takes whatever is queued and runs it
+# as a single batch, so concurrent jobs share batched model calls instead of
+# competing for the same CPU threads.
+#
+# A batch is run once it's full (max_batch_size) or once its oldest request
+# has waited max_wait seconds, whichever comes first, so a lone job only
+# ever waits max_wait for company.
+
+
+class MicroBatcher:
+    # run_batch = callable given a list of items, returning a list with one
+    # result per item
+    # size = callable giving how much of max_batch_size an item takes up,
+    # every item counts as 1 by default
+    def __init__(self, run_batch, max_batch_size, max_wait, size=None, name="batch"):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.size = size or (lambda item: 1)
+        self.name = name
+
+        # (item, future, time queued), oldest first
+        self.queue = deque()
+        self.queued_size = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = None
+
+        # For reporting the average batch size
+        self.batch_count = 0
+        self.total_size = 0
+
+    # Returns a concurrent.futures.Future for the item's result
+    def submit(self, item):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The " + self.name + " batcher has been closed")
+            # Started on first use so that processes that never run the
+            # models don't have idle threads
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=self.name + "-batcher", daemon=True
+                )
+                self.thread.start()
+            self.queue.append((item, future, time.monotonic()))
+            self.queued_size += self.size(item)
+            self.condition.notify()
+        return future
+
+    # Waits for a batch to be ready and takes it off the queue. Returns the
+    # (item, future) pairs and their total size, or None once the batcher is
+    # closed and everything queued has been run.
+    def _next_batch(self):
+        with self.condition:
+            while len(self.queue) == 0:
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            deadline = self.queue[0][2] + self.max_wait
+            while self.queued_size < self.max_batch_size and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = []
+            batch_size = 0
+            while len(self.queue) > 0:
+                item_size = self.size(self.queue[0][0])
+                # An item bigger than a whole batch still runs, on its own
+                if len(batch) > 0 and batch_size + item_size > self.max_batch_size:
+                    break
+                item, future, _ = self.queue.popleft()
+                self.queued_size -= item_size
+                # Skip requests that were cancelled while they were queued
+                if future.set_running_or_notify_cancel():
+                    batch.append((item, future))
+                    batch_size += item_size
+            return batch, batch_size
+
+    def _run(self):
+        while True:
+            next_batch = self._next_batch()
+            if next_batch is None:
+                return
+            batch, batch_size = next_batch
+            if len(batch) == 0:
+                continue
+
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batch_count += 1
+            self.total_size += batch_size
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    # In units of max_batch_size, e.g. crops rather than requests
+    def average_batch_size(self):
+        if self.batch_count == 0:
+            return 0.0
+        return self.total_size / self.batch_count
+
+    # Runs whatever is still queued, then stops the batching thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def _embed_batch(embedder, crop_batches):
+    import torch
+
+    features = embedder.get().embed(torch.cat(crop_batches))
+    return list(torch.split(features, [len(crops) for crops in crop_batches]))
+
+
+class InferenceServer:
+    # detector, embedder = model_provider.LazyModels of an
+    # inference_backends.Detector and Embedder
+    # max_batch_frames = most frames the detector runs at once
+    # max_batch_crops = most box crops the feature extractor runs at once
+    def __init__(
+        self, detector, embedder, max_batch_frames=8, max_batch_crops=64, max_wait=0.01
+    ):
+        self.detection_batcher = MicroBatcher(
+            lambda images: detector.get().detect_batch(images),
+            max_batch_frames,
+            max_wait,
+            name="detection",
+        )
+        self.embedding_batcher = MicroBatcher(
+            lambda crop_batches: _embed_batch(embedder, crop_batches),
+            max_batch_crops,
+            max_wait,
+            size=len,
+            name="embedding",
+        )
+
+    # Same as Detector.detect, blocks until the frame's batch has run
+    def detect(self, image):
+        return self.detection_batcher.submit(image).result()
+
+    # Same as Embedder.embed, blocks until the crops' batch has run
+    def embed(self, crops):
+        return self.embedding_batcher.submit(crops).result()
+
+    def close(self):
+        self.detection_batcher.close()
+        self.embedding_batcher.close()
+
+
+def create_inference_server():
+    from model_provider import detector, embedder
+
+    return InferenceServer(
+        detector,
+        embedder,
+        max_batch_frames=int(os.getenv("INFERENCE_MAX_BATCH_FRAMES", "8")),
+        max_batch_crops=int(os.getenv("INFERENCE_MAX_BATCH_CROPS", "64")),
+        max_wait=float(os.getenv("INFERENCE_MAX_WAIT_MS", "10")) / 1000,
+    )
+
+
+inference_server = create_inference_server()
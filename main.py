@@ -1,40 +1,61 @@
-from fastapi import Depends, FastAPI, BackgroundTasks, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, UploadFile, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+import asyncio
 import uuid
-from typing import List
+from typing import List, Optional
+import hashlib
+import itertools
+import urllib.parse
 
 # Data classes for post request bodies
-from sql_app import schemas, models, crud
-from sql_app.database import SessionLocal, engine
+from sql_app import schemas, models, crud, migrations
+from sql_app.database import (
+    SessionLocal,
+    BackgroundSessionLocal,
+    engine,
+    pool_metrics,
+)
+from sql_app.cache import (
+    response_cache,
+    make_etag,
+    etag_matches,
+    InvalidationListener,
+)
 from sqlalchemy.orm import Session
 
-# Azure related imports
+# Storage related imports
 import os
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-
-# Computer vision related imports
-import numpy as np
-import cv2
-from io import BytesIO
-import tempfile
-from ultralytics import YOLO
-import torchvision.transforms.functional as TF
-from efficientnet_pytorch import EfficientNet
-from model_training import ClassifierManager
-import pickle
-import shutil
-
-# Load pre-trained YOLO object detection model
-yolo_model = YOLO("yolov8n.pt")
-
-# Load pre-trained image feature extraction model (EfficientNet)
-feature_extraction_model = EfficientNet.from_pretrained("efficientnet-b0")
-feature_extraction_model.eval()
-
-# Create database tables
+from storage import create_storage_backend, video_files_path, timeline_path
+
+# The computer vision stack (OpenCV, torch and the pretrained models) is only
+# imported when it's first needed, see model_provider.py and preprocessing.py
+from model_provider import model_version
+from similarity_search import BoxIndexRegistry, INDEX_INVALIDATION_CHANNEL
+from training_executor import TrainingExecutor
+from preprocessing_scheduler import PreprocessingScheduler, QueueFull, UPLOAD, RERUN
+from annotation_export import (
+    export_annotations,
+    stream_export_zip,
+    link_or_copy,
+    local_file_version,
+    EXPORT_FORMATS,
+)
+from image_cache import ThumbnailCache, resize_image, IMAGE_FORMATS
+from timeline import sheet_name, INDEX_NAME
+from frame_pack import is_packed_frame, parse_frame_pack_url, read_packed_frame
+from progress import video_progress, FINISHED_STATUSES
+import json
+
+# Per-project nearest-neighbor indexes over bounding box image features
+box_index_registry = BoxIndexRegistry()
+
+# Create database tables and bring existing ones up to date
 models.Base.metadata.create_all(bind=engine)
+migrations.run_migrations(engine)
 
 # Create FastAPI instance
 app = FastAPI()
@@ -49,16 +70,123 @@ def get_db():
         db.close()
 
 
-# Connect to Azure storage account
+# Connect to the Azure storage account if configured, otherwise project files
+# are kept on the local file system (see storage.py)
 load_dotenv()
-connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-blob_service_client = None
-if connect_str:
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+storage = create_storage_backend()
 
 # Check if testing or not
 test_status = os.getenv("TEST_ENVIRONMENT")
 
+# Cap on how many reviewed boxes per label are used to train the label
+# classifier, which keeps retraining fast as projects grow
+max_training_boxes_per_label = int(os.getenv("MAX_TRAINING_BOXES_PER_LABEL", "1000"))
+
+# Number of projects whose training box features are kept in memory between
+# retrains, the least recently trained ones are dropped first
+feature_cache_projects = int(os.getenv("FEATURE_CACHE_PROJECTS", "4"))
+
+# Number of unreviewed boxes whose labels are predicted at a time
+prediction_chunk_size = int(os.getenv("PREDICTION_CHUNK_SIZE", "1024"))
+
+# Unreviewed boxes only get the label classifier's label when it's at least
+# this confident (0 to 1) in it, otherwise they keep the label they have
+min_relabel_confidence = float(os.getenv("MIN_RELABEL_CONFIDENCE", "0"))
+
+# Label classifiers are trained in a pool of worker processes, by default
+# using half of the cores with the rest of them split evenly between workers
+cpu_count = os.cpu_count() or 1
+training_workers = int(os.getenv("TRAINING_WORKERS", str(max(1, cpu_count // 2))))
+training_torch_threads = int(
+    os.getenv(
+        "TRAINING_TORCH_THREADS", str(max(1, cpu_count // (2 * training_workers)))
+    )
+)
+
+# Label classifiers can predict with INT8 weights ("dynamic") as long as they
+# give the same label as the original weights for at least
+# MIN_QUANTIZED_AGREEMENT of the boxes they were trained on
+training_executor = TrainingExecutor(
+    training_workers,
+    training_torch_threads,
+    quantize=os.getenv("CLASSIFIER_QUANTIZATION", "none") == "dynamic",
+    min_quantized_agreement=float(os.getenv("MIN_QUANTIZED_AGREEMENT", "0.98")),
+)
+
+# "all" to preprocess uploaded videos in this process' background tasks, or
+# "api" to only queue them for worker.py so that the API server never loads
+# the computer vision stack
+server_mode = os.getenv("SERVER_MODE", "all")
+
+# The EMBEDDER_BACKEND that videos are preprocessed with, which in
+# SERVER_MODE=api is the workers' rather than this process'. Boxes record it
+# in their model version (see model_provider.py).
+preprocessing_embedder_backend = os.getenv(
+    "PREPROCESSING_EMBEDDER_BACKEND", os.getenv("EMBEDDER_BACKEND", "torch")
+)
+
+# Seconds between checks for new progress while streaming a video's
+# preprocessing progress, and between keep-alive comments when there is none
+progress_poll_interval = float(os.getenv("PROGRESS_POLL_INTERVAL", "1"))
+progress_keep_alive_interval = 15
+
+# In SERVER_MODE=all, at most PREPROCESSING_MAX_JOBS videos are preprocessed
+# at a time. Videos waiting for preprocessing (in this process, or for the
+# workers in SERVER_MODE=api) are capped at PREPROCESSING_MAX_QUEUED, after
+# which uploads are answered with 429 Too Many Requests.
+preprocessing_scheduler = PreprocessingScheduler(
+    int(os.getenv("PREPROCESSING_MAX_JOBS", "2")),
+    int(os.getenv("PREPROCESSING_MAX_QUEUED", "20")),
+)
+
+# Downscaled frame images are kept on disk up to this many megabytes
+thumbnail_cache = ThumbnailCache(
+    os.getenv("THUMBNAIL_CACHE_DIR", "./thumbnail_cache"),
+    int(os.getenv("THUMBNAIL_CACHE_MAX_MB", "512")) * 1024 * 1024,
+)
+
+
+@app.on_event("shutdown")
+def shutdown_training_executor():
+    training_executor.shutdown()
+
+
+@app.on_event("shutdown")
+def shutdown_preprocessing_scheduler():
+    preprocessing_scheduler.shutdown()
+
+
+@app.on_event("shutdown")
+def close_storage():
+    storage.close()
+
+
+# Similarity indexes don't see boxes inserted by other processes (worker.py),
+# which notify once a video is done so that the index is built again
+def drop_box_indexes(project_ids):
+    if project_ids is None:
+        box_index_registry.clear()
+        return
+    for project_id in project_ids:
+        box_index_registry.drop(project_id)
+
+
+# Keeps this worker's response cache in sync with writes made by other workers
+response_cache_listener = InvalidationListener(
+    engine, handlers={INDEX_INVALIDATION_CHANNEL: drop_box_indexes}
+)
+
+
+@app.on_event("startup")
+def start_response_cache_listener():
+    response_cache_listener.start()
+
+
+@app.on_event("shutdown")
+def stop_response_cache_listener():
+    response_cache_listener.stop()
+
+
 # Specify allowed origins for requests
 origins = [
     "http://localhost",
@@ -94,181 +222,206 @@ def calculate_percent_frames_reviewed(object):
     return round(100 * (reviewed / total), 2)
 
 
-def predict_bounding_boxes(
-    frame_image, frame_id: uuid.UUID, project_id: uuid.UUID, db: Session
-):
-    # Apply pretrained object detection model to each frame to generate bounding boxes
-    yolo_results = yolo_model(frame_image)
-    yolo_class_ids_to_names = yolo_results[0].names
-
-    # Insert any new detected labels into the database
-    labels_to_insert = []
-    label_names = np.unique(
-        [yolo_class_ids_to_names[int(box.cls)] for box in yolo_results[0].boxes]
+# Serve a cached response body along with its ETag, or an empty 304 if the
+# client already has this version of it
+def cached_json_response(request: Request, entry):
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+# An empty 304 if the client already has the version with this ETag, which
+# is checked before running the queries that build the response
+def not_modified_response(request: Request, etag):
+    if not etag_matches(request.headers.get("if-none-match"), etag):
+        return None
+    return Response(
+        status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"}
     )
-    for label_name in label_names:
-        if crud.get_label_by_name_and_project(db, label_name, project_id) == None:
-            labels_to_insert.append(
-                schemas.LabelCreate.parse_obj(
-                    {"project_id": project_id, "name": str(label_name)}
-                )
-            )
 
-    if len(labels_to_insert) > 0:
-        crud.insert_labels(db, labels_to_insert)
 
-    # Update mapping for the IDs from the database's Label table
-    label_names_to_db_ids = {}
-    all_project_labels = crud.get_labels_by_project(db, project_id)
-    for label in all_project_labels:
-        label_names_to_db_ids[label.name] = label.id
+# generation = response_cache.generation(project_id) and etag = the ETag of
+# the data's version, both read before querying the data content was built from
+def cache_json_response(key, project_id, generation, etag, content):
+    body = JSONResponse(content=jsonable_encoder(content)).body
+    return response_cache.put(key, project_id, generation, body, etag)
 
-    # Create mapping from label name to label ids
 
-    # Put info about each box into a standard format
-    boxes = []
-    for box in yolo_results[0].boxes:
-        # Box information given as tensor([[float, float, float, float]])
-        x_top_left = int(box.xyxy[0][0])
-        y_top_left = int(box.xyxy[0][1])
-        x_bottom_right = int(box.xyxy[0][2])
-        y_bottom_right = int(box.xyxy[0][3])
-        width = int(box.xywh[0][2])
-        height = int(box.xywh[0][3])
-        label_name = yolo_class_ids_to_names[int(box.cls)]
-
-        # Crop image to what's inside the bounding box and get the feature vector for that cropped area
-        cropped_image = TF.crop(
-            TF.to_tensor(frame_image), y_top_left, x_top_left, height, width
-        ).unsqueeze(0)
-        padded_image = TF.resize(cropped_image, (64, 64), antialias=True)
-        image_features = feature_extraction_model.extract_features(padded_image)
-        image_features = pickle.dumps(image_features.detach())
-
-        db_box = schemas.BoundingBoxCreate.parse_obj(
-            {
-                "x_top_left": x_top_left,
-                "y_top_left": y_top_left,
-                "x_bottom_right": x_bottom_right,
-                "y_bottom_right": y_bottom_right,
-                "width": width,
-                "height": height,
-                "frame_id": frame_id,
-                "label_id": label_names_to_db_ids[label_name],
-                "image_features": image_features,
-                "prediction": True,
-            }
-        )
-        boxes.append(db_box)
+# Where the files of a video (the video itself, its frames and timeline)
+# are kept within the project's storage
+def get_video_path(project_name: str, video_name: str):
+    return video_files_path(storage, project_name, video_name)
 
-    # Insert all bounding boxes for this frame into the database
-    crud.insert_boxes(db, boxes)
-    return
 
+# Where a video's timeline sprite sheets are stored, next to its frames
+def get_timeline_path(project_name: str, video_name: str):
+    return timeline_path(storage, project_name, video_name)
 
-# Preprocessing a video involves extracting frames (1 fps)
-# and using a pretrained object detection model to generate
-# initial bounding boxes and labels. This will be run in
-# a FastAPI background task.
-def preprocess_video(
-    video_bytes,
-    storage_location,
-    video_id: uuid.UUID,
-    project_id: uuid.UUID,
-    db: Session,
-):
-    # Signify that preprocessing has begun
-    crud.set_video_preprocessing_status(db, video_id, "in_progress")
-
-    # Video is sent as bytes but OpenCV's VideoCapture only reads
-    # videos from files, so using a temp file here
-    with tempfile.NamedTemporaryFile() as temp:
-        temp.write(video_bytes)
-        vidcap = cv2.VideoCapture(temp.name)
-
-    # Figure out number of frames and frames per second rate
-    num_frames = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
-    fps = vidcap.get(cv2.CAP_PROP_FPS)
-
-    # Figure out frame width and height (returned as floats but we'll round)
-    width = round(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = round(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    index = 0
-    for frame in np.arange(0, num_frames, fps):
-        vidcap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-        hasFrames, image = vidcap.read()
-
-        if not hasFrames:
-            # If frames could not be extracted, signify that
-            # preprocessing failed for this video so caller can restart
-            crud.set_video_preprocessing_status(db, video_id, "failed")
+
+# Read a stored frame image as a stream of byte chunks
+def read_frame_chunks(project_name: str, frame_url: str, chunk_size=1024 * 1024):
+    if is_packed_frame(frame_url):
+        yield read_packed_frame(storage, project_name, frame_url)
+    else:
+        yield from storage.read_chunks(project_name, frame_url, chunk_size)
+
+
+# Reads the first chunk of a frame's image before anything is sent, so that
+# an image that isn't there gets an error response rather than a truncated
+# one. Returns an iterator over all of the image's chunks, or None if the
+# image hasn't been written.
+def open_frame_chunks(project_name: str, frame_url: str):
+    chunks = read_frame_chunks(project_name, frame_url)
+    try:
+        first_chunk = next(chunks, b"")
+    except FileNotFoundError:
+        return None
+    return itertools.chain([first_chunk], chunks)
+
+
+# Frames are saved before their images have been flushed or uploaded, so an
+# image can be missing for a little while as long as the video is still
+# being preprocessed
+def missing_frame_image_response(frame: models.Frame):
+    frame_id = str(frame.id)
+    if frame.video.preprocessing_status in ("queued", "in_progress"):
+        return JSONResponse(
+            status_code=409,
+            content={
+                "message": "Image for frame "
+                + frame_id
+                + " has not been written yet, try again shortly"
+            },
+        )
+    return JSONResponse(
+        status_code=404,
+        content={"message": "Image for frame " + frame_id + " not found"},
+    )
+
+
+# Returns a function that puts a project's frame image at the destination
+# path of an export, without copying bytes if the frame is on local disk
+def frame_copier(project_name: str):
+    def copy_frame_image(frame_url: str, destination: str):
+        local_path = storage.local_path(project_name, frame_url)
+        if local_path is not None and not is_packed_frame(frame_url):
+            link_or_copy(local_path, destination)
             return
+        with open(destination, "wb") as destination_file:
+            for chunk in read_frame_chunks(project_name, frame_url):
+                destination_file.write(chunk)
 
-        # Otherwise continue and save frame as image in desired storage path
-        # and note whether frame insertion was successful
-        inserted_frame = False
-        if storage_location["azure"]:
-            # First connect to storage container using the desired destination path
-            blob_client = blob_service_client.get_blob_client(
-                container=storage_location["container"],
-                blob=storage_location["path"] + "/" + str(index) + ".jpg",
-            )
+    return copy_frame_image
 
-            # Convert from OpenCV's output array into image bytes before uploading
-            is_success, buffer = cv2.imencode(".jpg", image)
 
-            if not is_success:
-                # Signify that preprocessing failed for this video so caller can restart
-                crud.set_video_preprocessing_status(db, video_id, "failed")
-                return
+# Returns a function that gives the version of a project's frame image for
+# exports (see annotation_export.py): the size and modification time of its
+# file, or of its pack since packs are written again when preprocessing is
+# restarted. None for frames that aren't on local disk.
+def frame_versioner(project_name: str):
+    def frame_image_version(frame_url: str):
+        path = frame_url
+        if is_packed_frame(frame_url):
+            path, _ = parse_frame_pack_url(frame_url)
+        local_path = storage.local_path(project_name, path)
+        if local_path is None:
+            return None
+        return local_file_version(local_path)
 
-            image_bytes = BytesIO(buffer)
-            blob_client.upload_blob(image_bytes)
-
-            new_frame = schemas.FrameCreate.parse_obj(
-                {
-                    "width": width,
-                    "height": height,
-                    "project_id": project_id,
-                    "video_id": video_id,
-                    "frame_url": storage_location["path"] + "/" + str(index) + ".jpg",
-                }
-            )
-            inserted_frame = crud.insert_one_frame(db, new_frame)
-            # if inserted_frame:
-            #     predict_bounding_boxes(image, inserted_frame.id, project_id, db)
+    return frame_image_version
 
-        else:
-            is_success = cv2.imwrite(
-                storage_location["path"] + "/" + str(index) + ".jpg", image
-            )
 
-            if not is_success:
-                # Signify that preprocessing failed for this video so caller can restart
-                crud.set_video_preprocessing_status(db, video_id, "failed")
-                return
+# Fetch the similarity index for a project, building it from the
+# image features stored in the database if this is the first query
+def get_box_index(db: Session, project_id: uuid.UUID):
+    from model_training import features_to_vector
 
-            new_frame = schemas.FrameCreate.parse_obj(
-                {
-                    "width": width,
-                    "height": height,
-                    "project_id": project_id,
-                    "video_id": video_id,
-                    "frame_url": storage_location["path"] + "/" + str(index) + ".jpg",
-                }
-            )
-            inserted_frame = crud.insert_one_frame(db, new_frame)
-            # if inserted_frame:
-            #     predict_bounding_boxes(image, inserted_frame.id, project_id, db)
+    def load_rows():
+        for row in crud.get_box_features_by_project_id(db, project_id):
+            yield row.id, features_to_vector(row.image_features)
+
+    return box_index_registry.get_or_build(project_id, load_rows)
+
+
+# Preprocess a video in this process, run by the preprocessing scheduler
+# with a database session of its own from the background pool
+def preprocess_video_task(
+    video_bytes,
+    project_name: str,
+    video_name: str,
+    video_id: uuid.UUID,
+    project_id: uuid.UUID,
+):
+    from preprocessing import preprocess_video
+
+    db = BackgroundSessionLocal()
+    try:
+        # The video may have been cancelled while it was queued
+        if not crud.start_queued_video(db, video_id):
+            return
+        preprocess_video(
+            video_bytes,
+            storage,
+            project_name,
+            video_name,
+            video_id,
+            project_id,
+            db,
+            # Make the new boxes searchable by similarity
+            on_boxes_inserted=box_index_registry.add,
+        )
+    except Exception:
+        db.rollback()
+        crud.set_video_preprocessing_status(db, video_id, "failed")
+        raise
+    finally:
+        db.close()
+
+
+# The response for when too many videos are already waiting to be
+# preprocessed, or None if there's room for another one
+def preprocessing_queue_full_response(db: Session):
+    if server_mode == "api":
+        queued_count = crud.count_queued_videos(db)
+    else:
+        queued_count = preprocessing_scheduler.queued_count()
+    if queued_count < preprocessing_scheduler.max_queued:
+        return None
+    return JSONResponse(
+        status_code=429,
+        content={"message": "Too many videos are waiting to be preprocessed"},
+        headers={"Retry-After": str(preprocessing_scheduler.retry_after(queued_count))},
+    )
 
-        if inserted_frame:
-            predict_bounding_boxes(image, inserted_frame.id, project_id, db)
 
-        index += 1
+# Preprocessing a video involves extracting frames (1 fps) and using a
+# pretrained object detection model to generate initial bounding boxes and
+# labels. Depending on server_mode this either happens in this process (see
+# preprocessing_scheduler) or the video is queued for worker.py.
+#
+# priority = UPLOAD or RERUN, see preprocessing_scheduler.py
+def start_preprocessing(
+    video_bytes,
+    project_name: str,
+    video_name: str,
+    video_id: uuid.UUID,
+    project_id: uuid.UUID,
+    db: Session,
+    priority=UPLOAD,
+):
+    crud.set_video_preprocessing_status(db, video_id, "queued")
+    if server_mode == "api":
+        return
 
-    # Update done_processing field for this video
-    crud.set_video_preprocessing_status(db, video_id, "success")
+    preprocessing_scheduler.submit(
+        video_id,
+        lambda: preprocess_video_task(
+            video_bytes, project_name, video_name, video_id, project_id
+        ),
+        len(video_bytes),
+        priority,
+    )
 
 
 ###############################################################
@@ -321,15 +474,9 @@ def create_project(project: schemas.ProjectCreate, db: Session = Depends(get_db)
             },
         )
 
-    container_name = str(res.name)
-
     # If connected to Azure, create a container in the blob storage account
     # Otherwise, create a directory in the local file system
-    if blob_service_client:
-        blob_service_client.create_container(container_name)
-    else:
-        if not os.path.exists("./local_projects/" + container_name):
-            os.makedirs("./local_projects/" + container_name)
+    storage.create_project(str(res.name))
 
     # Convert from database query response model to response model
     new_project = schemas.ExistingProject.parse_obj(
@@ -372,7 +519,9 @@ def get_project(project_id: str, db: Session = Depends(get_db)):
 
 
 @app.get("/projects/{project_id}/labels")
-def get_project_labels(project_id: str, db: Session = Depends(get_db)):
+def get_project_labels(
+    project_id: str, request: Request, db: Session = Depends(get_db)
+):
     # Validate that project_id is a valid UUID
     try:
         uuid.UUID(project_id)
@@ -382,6 +531,12 @@ def get_project_labels(project_id: str, db: Session = Depends(get_db)):
             content={"message": "Project ID " + project_id + " is not a valid UUID"},
         )
 
+    cache_key = ("labels", str(uuid.UUID(project_id)))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached_json_response(request, cached)
+    generation = response_cache.generation(uuid.UUID(project_id))
+
     res = crud.get_project_by_id(db, project_id)
 
     if res == None:
@@ -390,6 +545,11 @@ def get_project_labels(project_id: str, db: Session = Depends(get_db)):
             content={"message": "Project with ID " + project_id + " not found"},
         )
 
+    etag = make_etag("labels", crud.get_labels_version(db, project_id))
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
     rows_returned = crud.get_labels_by_project(db, project_id)
     labels = []
     for row in rows_returned:
@@ -399,7 +559,13 @@ def get_project_labels(project_id: str, db: Session = Depends(get_db)):
             )
         )
 
-    return {"project_id": project_id, "labels": labels}
+    content = {"project_id": project_id, "labels": labels}
+    return cached_json_response(
+        request,
+        cache_json_response(
+            cache_key, uuid.UUID(project_id), generation, etag, content
+        ),
+    )
 
 
 @app.post("/projects/{project_id}/labels")
@@ -489,7 +655,13 @@ def delete_label(project_id: str, label_id: str, db: Session = Depends(get_db)):
 
 
 @app.get("/projects/{project_id}/annotations")
-def get_project_annotations(project_id: str, db: Session = Depends(get_db)):
+async def get_project_annotations(project_id: str, db: Session = Depends(get_db)):
+    # Exporting reads every frame and box of the project and writes their
+    # files, so it all runs in the thread pool to keep the event loop free
+    return await run_in_threadpool(export_project_annotations, project_id, db)
+
+
+def export_project_annotations(project_id: str, db: Session):
     try:
         uuid.UUID(project_id)
     except:
@@ -509,59 +681,97 @@ def get_project_annotations(project_id: str, db: Session = Depends(get_db)):
     # Create default save location
     # TODO: later be able to download frames and annotations from Azure
     local_save_path = os.getcwd() + "/local_projects/" + project.name
-    storage_location = {
-        "azure": False,
-        "path": local_save_path + "/annotations",
-        "container": "",
-    }
+    annotations_path = local_save_path + "/annotations"
+
+    # Stream every frame and box in the project and only rewrite the
+    # frames whose boxes changed since the last export
+    stats = export_annotations(
+        crud.get_project_boxes_for_export(db, project_id),
+        crud.get_labels_by_project(db, project_id),
+        annotations_path,
+        copy_frame=frame_copier(project.name),
+        frame_version=frame_versioner(project.name),
+    )
 
-    # Create the project_name/annotations directory
-    if not os.path.exists(storage_location["path"]):
-        os.makedirs(storage_location["path"])
+    # Tell the client where to find the annotations, images, and labels
+    return JSONResponse(
+        status_code=200,
+        content={
+            "id": project_id,
+            "annotations-path": annotations_path,
+            "frames-written": stats["written"],
+            "frames-unchanged": stats["unchanged"],
+            "frames-removed": stats["removed"],
+        },
+    )
 
-    # Create the frames and boxes subdirectories
-    if not os.path.exists(storage_location["path"] + "/frames"):
-        os.makedirs(storage_location["path"] + "/frames")
-    if not os.path.exists(storage_location["path"] + "/boxes"):
-        os.makedirs(storage_location["path"] + "/boxes")
 
-    # Save all current labels and UUIDs in a single txt file
-    project_labels = crud.get_labels_by_project(db, project_id)
-    labels_to_write = [
-        str(label.id) + " " + label.name + "\n" for label in project_labels
-    ]
-    with open(storage_location["path"] + "/labels.txt", "w") as labelsfile:
-        labelsfile.writelines(labels_to_write)
-
-    # Save all frames from all videos as frameUUID.jpg files
-    project_frames = crud.get_frames_by_project_id(db, project_id)
-    for frame in project_frames:
-        shutil.copyfile(
-            frame.frame_url,
-            storage_location["path"] + "/frames/" + str(frame.id) + ".jpg",
-        )
-
-        # Save all bounding boxes from all videos in frameUUID.txt files
-        # using the YOLO format: labelUUID center_x center_y width height
-        frame_boxes = crud.get_boxes_by_frame_id(db, frame.id)
-        boxes_to_write = []
-        for box in frame_boxes:
-            center_x = ((box.x_top_left + box.x_bottom_right) / 2) / frame.width
-            center_y = ((box.y_top_left + box.y_bottom_right) / 2) / frame.height
-            normalized_width = box.width / frame.width
-            normalized_height = box.height / frame.height
-            boxes_to_write.append(
-                f"{str(box.label_id)} {center_x} {center_y} {normalized_width} {normalized_height}\n"
+# Stream a ZIP archive of the project's frames along with YOLO and/or COCO
+# label files, e.g. formats=yolo,coco
+@app.get("/projects/{project_id}/export")
+def export_project(
+    project_id: str,
+    formats: str = ",".join(EXPORT_FORMATS),
+    db: Session = Depends(get_db),
+):
+    try:
+        uuid.UUID(project_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Project ID " + project_id + " is not a valid UUID"},
+        )
+
+    project = crud.get_project_by_id(db, project_id)
+
+    if project == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Project with ID " + project_id + " not found"},
+        )
+
+    requested_formats = [f.strip() for f in formats.split(",") if f.strip()]
+    for requested_format in requested_formats:
+        if requested_format not in EXPORT_FORMATS:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "message": "Export format "
+                    + requested_format
+                    + " is not one of "
+                    + ", ".join(EXPORT_FORMATS)
+                },
             )
-        with open(
-            storage_location["path"] + "/boxes/" + str(frame.id) + ".txt", "w"
-        ) as boxfile:
-            boxfile.writelines(boxes_to_write)
 
-    # Tell the client where to find the annotations, images, and labels
-    return JSONResponse(
-        status_code=200,
-        content={"id": project_id, "annotations-path": storage_location["path"]},
+    project_name = project.name
+    archive = stream_export_zip(
+        crud.get_labels_by_project(db, project_id),
+        lambda: crud.get_project_frames_for_export(db, project_id),
+        lambda: crud.get_project_boxes_for_export(db, project_id),
+        lambda frame_url: read_frame_chunks(project_name, frame_url),
+        requested_formats,
+    )
+
+    return StreamingResponse(
+        archive,
+        media_type="application/zip",
+        headers={"Content-Disposition": attachment_disposition(project_name + ".zip")},
+    )
+
+
+# A Content-Disposition header value for downloading a file of any name. HTTP
+# headers are Latin-1, so the name is sent percent-encoded as UTF-8 in
+# filename* (RFC 5987), with an ASCII-only filename for older clients.
+def attachment_disposition(filename: str):
+    fallback = "".join(
+        character if " " <= character <= "~" and character not in '"\\' else "_"
+        for character in filename
+    )
+    return (
+        'attachment; filename="'
+        + fallback
+        + "\"; filename*=UTF-8''"
+        + urllib.parse.quote(filename, safe="")
     )
 
 
@@ -604,11 +814,104 @@ def get_project_videos(project_id: str, db: Session = Depends(get_db)):
     return {"project_id": project_id, "videos": videos}
 
 
+# Videos with predicted boxes that came from other versions of the models
+# than the ones now in the model registry, e.g. to find what to preprocess
+# again after upgrading a model
+@app.get("/projects/{project_id}/stale_predictions")
+def get_stale_predictions(project_id: str, db: Session = Depends(get_db)):
+    # Validate that project_id is a valid UUID
+    try:
+        uuid.UUID(project_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Project ID " + project_id + " is not a valid UUID"},
+        )
+
+    res = crud.get_project_by_id(db, project_id)
+
+    if res == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Project with ID " + project_id + " not found"},
+        )
+
+    current_version = model_version(preprocessing_embedder_backend)
+    rows = crud.get_stale_prediction_counts_by_project_id(
+        db, project_id, current_version
+    )
+    return {
+        "project_id": project_id,
+        "model_version": current_version,
+        "videos": [
+            {"video_id": row.video_id, "stale_boxes": row.stale_boxes} for row in rows
+        ],
+    }
+
+
+@app.get("/projects/{project_id}/sampling", response_model=schemas.SamplingSettings)
+def get_project_sampling(project_id: str, db: Session = Depends(get_db)):
+    # Validate that project_id is a valid UUID
+    try:
+        uuid.UUID(project_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Project ID " + project_id + " is not a valid UUID"},
+        )
+
+    project = crud.get_project_by_id(db, project_id)
+
+    if project == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Project with ID " + project_id + " not found"},
+        )
+
+    return schemas.SamplingSettings.from_orm(project)
+
+
+# Sets how frames are picked from the videos preprocessed from now on, see
+# frame_sampling.py. Videos already preprocessed keep their frames.
+@app.put("/projects/{project_id}/sampling", response_model=schemas.SamplingSettings)
+def set_project_sampling(
+    project_id: str,
+    settings: schemas.SamplingSettings,
+    db: Session = Depends(get_db),
+):
+    # Validate that project_id is a valid UUID
+    try:
+        uuid.UUID(project_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Project ID " + project_id + " is not a valid UUID"},
+        )
+
+    project = crud.get_project_by_id(db, project_id)
+
+    if project == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Project with ID " + project_id + " not found"},
+        )
+
+    if settings.min_sample_interval > settings.max_sample_interval:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": "min_sample_interval can't be more than max_sample_interval"
+            },
+        )
+
+    crud.set_project_sampling(db, project.id, settings)
+    return settings
+
+
 @app.post("/projects/{project_id}/videos")
 async def upload_project_video(
     project_id: str,
     video: UploadFile,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
 ):
     # Validate that project_id is a valid UUID
@@ -652,6 +955,11 @@ async def upload_project_video(
             },
         )
 
+    # Turn the video away before storing it if it can't be preprocessed soon
+    queue_full_response = preprocessing_queue_full_response(db)
+    if queue_full_response is not None:
+        return queue_full_response
+
     # Read the video file
     try:
         # Read video data as bytes
@@ -668,44 +976,15 @@ async def upload_project_video(
         )
 
     project_name = containing_project.name
-    video_name = video.filename.replace(".mp4", "")
 
-    # Create default save location
-    local_save_path = os.getcwd() + "/local_projects/" + project_name + "/" + video_name
-    storage_location = {
-        "azure": False,
-        "path": local_save_path + "/frames",
-        "container": "",
-    }
-
-    # Upload video to the appropriate storage location (Azure or local file system)
+    # Upload video to the project's storage (Azure or local file system)
+    # under the path video_name/video.mp4
     try:
-        if blob_service_client:
-            # If connected to Azure, upload video to project's blob storage container
-            # under the path video_name/video.mp4
-            # The storage container is already named after the project
-            blob_client = blob_service_client.get_blob_client(
-                container=project_name, blob=video_name + "/" + video.filename
-            )
-            blob_client.upload_blob(contents)
-
-            # Set up appropriate information for saving extracted frames in Azure
-            storage_location["azure"] = True
-            storage_location["container"] = project_name
-            storage_location["path"] = video_name + "/frames"
-        else:
-            # Otherwise, add to project directory in the local file system
-
-            # If project_name/video_name/frames directories don't exist, create them
-            if not os.path.exists(storage_location["path"]):
-                os.makedirs(storage_location["path"])
-
-            # Save the video file
-            video_save_path = local_save_path + video.filename
-            if not os.path.exists(video_save_path):
-                with open(video_save_path, "wb") as f:
-                    f.write(contents)
-
+        storage.write(
+            project_name,
+            get_video_path(project_name, video.filename) + "/" + video.filename,
+            contents,
+        )
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -734,15 +1013,31 @@ async def upload_project_video(
             },
         )
 
-    # Preprocess the video as a background task
-    background_tasks.add_task(
-        preprocess_video,
-        contents,
-        storage_location,
-        video_insert_response.id,
-        project_id,
-        db,
-    )
+    # Preprocess the video in the background. The queue can still have
+    # filled up since it was checked above, in which case the video is kept
+    # and can be preprocessed later through the restart endpoint.
+    try:
+        start_preprocessing(
+            contents,
+            project_name,
+            video.filename,
+            video_insert_response.id,
+            project_id,
+            db,
+        )
+    except QueueFull:
+        crud.set_video_preprocessing_status(db, video_insert_response.id, "failed")
+        video.file.close()
+        return JSONResponse(
+            status_code=429,
+            content={
+                "message": "Too many videos are waiting to be preprocessed, "
+                "restart preprocessing of video "
+                + str(video_insert_response.id)
+                + " later"
+            },
+            headers={"Retry-After": str(preprocessing_scheduler.retry_after())},
+        )
 
     # Close the video file
     video.file.close()
@@ -794,9 +1089,7 @@ def get_video(video_id: str, db: Session = Depends(get_db)):
 
 
 @app.get("/videos/{video_id}/preprocess")
-def restart_video_preprocess(
-    video_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)
-):
+def restart_video_preprocess(video_id: str, db: Session = Depends(get_db)):
     # Validate that video_id is a valid UUID
     try:
         uuid.UUID(video_id)
@@ -824,64 +1117,59 @@ def restart_video_preprocess(
             },
         )
 
+    queue_full_response = preprocessing_queue_full_response(db)
+    if queue_full_response is not None:
+        return queue_full_response
+
     project = crud.get_project_by_id(db, video.project_id)
-    video_name = video.name.replace(".mp4", "")
-    local_save_path = os.getcwd() + "/local_projects/" + project.name + "/" + video_name
-    storage_location = {
-        "azure": False,
-        "path": local_save_path + "/frames",
-        "container": "",
-    }
 
-    # Get the video's content as bytes (either from local storage or Azure)
-    try:
-        if blob_service_client:
-            # If connected to Azure, download the video as a byte stream
-            blob_client = blob_service_client.get_blob_client(
-                container=project.name, blob=video_name + "/" + video.name
+    # Get the video's content as bytes (either from local storage or Azure),
+    # unless a worker is going to preprocess it and read it itself
+    contents = None
+    if server_mode != "api":
+        try:
+            contents = storage.read(
+                project.name,
+                get_video_path(project.name, video.name) + "/" + video.name,
+            )
+        except Exception as e:
+            return JSONResponse(
+                status_code=500,
+                content={
+                    "message": "While restarting preprocessing, failed to fetch video "
+                    + video.name
+                    + " with error "
+                    + str(e)
+                },
             )
-            contents = BytesIO()
-            blob_client.download_blob().readinto(contents)
-
-            # Set up appropriate information for saving extracted frames in Azure
-            storage_location["azure"] = True
-            storage_location["container"] = project.name
-            storage_location["path"] = video_name + "/frames"
-        else:
-            # Otherwise, read as bytes from the local video file
-            video_save_path = local_save_path + video.name
-            with open(video_save_path, "rb") as f:
-                contents = f.read()
 
-    except Exception as e:
+    # Preprocess the video in the background, after any new uploads
+    try:
+        start_preprocessing(
+            contents,
+            project.name,
+            video.name,
+            video.id,
+            video.project_id,
+            db,
+            priority=RERUN,
+        )
+    except QueueFull:
+        crud.set_video_preprocessing_status(db, video.id, "failed")
         return JSONResponse(
-            status_code=500,
-            content={
-                "message": "While restarting preprocessing, failed to fetch video "
-                + video.name
-                + " with error "
-                + str(e)
-            },
+            status_code=429,
+            content={"message": "Too many videos are waiting to be preprocessed"},
+            headers={"Retry-After": str(preprocessing_scheduler.retry_after())},
         )
 
-    # Preprocess the video as a background task
-    background_tasks.add_task(
-        preprocess_video,
-        contents,
-        storage_location,
-        video_id,
-        video.project_id,
-        db,
-    )
-
     return JSONResponse(
         status_code=202,
         content={"id": str(video.project_id), "video_id": str(video.id)},
     )
 
 
-@app.get("/videos/{video_id}/frames")
-def get_video_frames(video_id: str, db: Session = Depends(get_db)):
+@app.delete("/videos/{video_id}/preprocess")
+def cancel_video_preprocess(video_id: str, db: Session = Depends(get_db)):
     # Validate that video_id is a valid UUID
     try:
         uuid.UUID(video_id)
@@ -891,18 +1179,161 @@ def get_video_frames(video_id: str, db: Session = Depends(get_db)):
             content={"message": "Video ID " + video_id + " is not a valid UUID"},
         )
 
-    res = crud.get_video_by_id(db, video_id)
+    video = crud.get_video_by_id(db, video_id)
 
-    if res == None:
+    if video == None:
         return JSONResponse(
             status_code=404,
             content={"message": "Video with ID " + video_id + " not found"},
         )
 
-    video_frames = crud.get_frames_by_video_id(db, video_id)
-    labels_per_frame = crud.get_unique_labels_per_frame(db, video_id)
+    # Whichever process is preprocessing the video stops before its next
+    # frame, a video still queued here is never started
+    if not crud.cancel_video_preprocessing(db, video.id):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": "Video with ID "
+                + video_id
+                + " is not queued or being preprocessed"
+            },
+        )
+    preprocessing_scheduler.cancel(video.id)
 
-    # Create a mapping from frame ID to list of unique labels detected in
+    return JSONResponse(
+        status_code=202,
+        content={"id": str(video.project_id), "video_id": str(video.id)},
+    )
+
+
+@app.get("/videos/{video_id}/progress", response_model=schemas.VideoProgress)
+def get_video_progress(video_id: str, db: Session = Depends(get_db)):
+    # Validate that video_id is a valid UUID
+    try:
+        uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    video = crud.get_video_by_id(db, video_id)
+
+    if video == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+
+    return video_progress(video)
+
+
+# The video's progress read with a session of its own, or None if the video
+# doesn't exist
+def read_video_progress(video_id: uuid.UUID):
+    db = SessionLocal()
+    try:
+        video = crud.get_video_by_id(db, video_id)
+        if video == None:
+            return None
+        return jsonable_encoder(video_progress(video))
+    finally:
+        db.close()
+
+
+# Streams the video's progress as server-sent events: a "progress" event
+# (with the same content as GET /videos/{video_id}/progress) whenever it
+# changes, until preprocessing has finished
+@app.get("/videos/{video_id}/progress/events")
+async def stream_video_progress(video_id: str, request: Request):
+    # Validate that video_id is a valid UUID
+    try:
+        video_uuid = uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    progress = await run_in_threadpool(read_video_progress, video_uuid)
+    if progress == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+
+    async def events(progress):
+        last_key = None
+        last_sent = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            # The estimated time left changes on every read, only send
+            # progress that was saved since the last event
+            key = (
+                progress["preprocessing_status"],
+                progress["frames_processed"],
+                progress["updated_at"],
+            )
+            if key != last_key:
+                yield "event: progress\ndata: " + json.dumps(progress) + "\n\n"
+                last_key = key
+                last_sent = loop.time()
+            elif loop.time() - last_sent >= progress_keep_alive_interval:
+                yield ": keep-alive\n\n"
+                last_sent = loop.time()
+
+            if progress["preprocessing_status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(progress_poll_interval)
+            if await request.is_disconnected():
+                return
+            progress = await run_in_threadpool(read_video_progress, video_uuid)
+            if progress == None:
+                return
+
+    return StreamingResponse(
+        events(progress),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/videos/{video_id}/frames")
+def get_video_frames(video_id: str, request: Request, db: Session = Depends(get_db)):
+    # Validate that video_id is a valid UUID
+    try:
+        uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    cache_key = ("frames", str(uuid.UUID(video_id)))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached_json_response(request, cached)
+
+    res = crud.get_video_by_id(db, video_id)
+
+    if res == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+    generation = response_cache.generation(res.project_id)
+
+    etag = make_etag(
+        "frames", crud.get_video_frames_version(db, video_id, res.project_id)
+    )
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    video_frames = crud.get_frames_by_video_id(db, video_id)
+    labels_per_frame = crud.get_unique_labels_per_frame(db, video_id)
+
+    # Create a mapping from frame ID to list of unique labels detected in
     # that frame that the next for loop can reference
     labels_per_frame_dict = {}
     for frame_id, labels in labels_per_frame:
@@ -920,12 +1351,176 @@ def get_video_frames(video_id: str, db: Session = Depends(get_db)):
                 "project_id": frame.project_id,
                 "video_id": frame.video_id,
                 "frame_url": frame.frame_url,
+                "frame_number": frame.frame_number,
+                "timestamp": frame.timestamp,
                 "labels": labels_per_frame_dict[frame.id],
             }
         )
         frames.append(parsed_frame)
 
-    return {"video_id": video_id, "frames": frames}
+    content = {"video_id": video_id, "frames": frames}
+    return cached_json_response(
+        request,
+        cache_json_response(cache_key, res.project_id, generation, etag, content),
+    )
+
+
+# Everything about a video that changed since the given watermark: frames
+# and bounding boxes that were inserted or updated, the project's labels, and
+# what was deleted. Clients pass the returned revision (a watermark, see
+# change_tracking.py) as `since` next time.
+@app.get("/videos/{video_id}/changes")
+def get_video_changes(video_id: str, since: int = 0, db: Session = Depends(get_db)):
+    try:
+        uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    if since < 0:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Revision must not be negative"},
+        )
+
+    video = crud.get_video_by_id(db, video_id)
+
+    if video == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+
+    # Read first, every change older than it is visible to the queries below
+    watermark = max(since, crud.get_change_watermark(db))
+
+    frames = [
+        schemas.FrameRevision.from_orm(frame)
+        for frame in crud.get_frames_changed_since(db, video_id, since, watermark)
+    ]
+    boxes = [
+        schemas.BoundingBoxRevision.from_orm(box)
+        for box in crud.get_boxes_changed_since(db, video_id, since, watermark)
+    ]
+    labels = [
+        schemas.LabelRevision.from_orm(label)
+        for label in crud.get_labels_changed_since(
+            db, video.project_id, since, watermark
+        )
+    ]
+    deleted = [
+        schemas.DeletedRow.from_orm(row)
+        for row in crud.get_deleted_rows_since(
+            db, video_id, video.project_id, since, watermark
+        )
+    ]
+
+    return {
+        "video_id": video_id,
+        "revision": watermark,
+        "frames": frames,
+        "bounding_boxes": boxes,
+        "labels": labels,
+        "deleted": deleted,
+    }
+
+
+# The layout of a video's timeline sprite sheets and which tile each frame
+# is in, along with the URLs of the sheets
+@app.get("/videos/{video_id}/timeline")
+def get_video_timeline(video_id: str, db: Session = Depends(get_db)):
+    try:
+        uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    video = crud.get_video_by_id(db, video_id)
+
+    if video == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+
+    timeline_path = get_timeline_path(video.project.name, video.name)
+    try:
+        timeline = json.loads(
+            storage.read(video.project.name, timeline_path + "/" + INDEX_NAME)
+        )
+    except FileNotFoundError:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "message": "Timeline for video with ID " + video_id + " not found"
+            },
+        )
+
+    timeline["video_id"] = video_id
+    timeline["sheets"] = [
+        f"/videos/{video_id}/timeline/{sheet_number}"
+        for sheet_number in range(timeline["sheet_count"])
+    ]
+    return timeline
+
+
+@app.get("/videos/{video_id}/timeline/{sheet_number}")
+def get_video_timeline_sheet(
+    video_id: str, sheet_number: int, db: Session = Depends(get_db)
+):
+    try:
+        uuid.UUID(video_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Video ID " + video_id + " is not a valid UUID"},
+        )
+
+    video = crud.get_video_by_id(db, video_id)
+
+    if video == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Video with ID " + video_id + " not found"},
+        )
+
+    sheet_path = (
+        get_timeline_path(video.project.name, video.name)
+        + "/"
+        + sheet_name(sheet_number)
+    )
+    headers = {"Cache-Control": "public, max-age=3600"}
+    local_path = storage.local_path(video.project.name, sheet_path)
+    if local_path is not None:
+        if sheet_number >= 0 and os.path.exists(local_path):
+            return FileResponse(local_path, media_type="image/jpeg", headers=headers)
+    else:
+        chunks = storage.read_chunks(video.project.name, sheet_path)
+        try:
+            first_chunk = next(chunks)
+        except (StopIteration, FileNotFoundError):
+            first_chunk = None
+        if first_chunk is not None:
+            return StreamingResponse(
+                itertools.chain([first_chunk], chunks),
+                media_type="image/jpeg",
+                headers=headers,
+            )
+
+    return JSONResponse(
+        status_code=404,
+        content={
+            "message": "Timeline sheet "
+            + str(sheet_number)
+            + " for video with ID "
+            + video_id
+            + " not found"
+        },
+    )
 
 
 ###############################################################
@@ -935,7 +1530,9 @@ def get_video_frames(video_id: str, db: Session = Depends(get_db)):
 
 # Get the bounding boxes for this frame
 @app.get("/frames/{frame_id}/inferences")
-def get_frame_inferences(frame_id: str, db: Session = Depends(get_db)):
+def get_frame_inferences(
+    frame_id: str, request: Request, db: Session = Depends(get_db)
+):
     try:
         uuid.UUID(frame_id)
     except:
@@ -944,6 +1541,11 @@ def get_frame_inferences(frame_id: str, db: Session = Depends(get_db)):
             content={"message": "Frame ID " + frame_id + " is not a valid UUID"},
         )
 
+    cache_key = ("inferences", str(uuid.UUID(frame_id)))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached_json_response(request, cached)
+
     res = crud.get_frame_by_id(db, frame_id)
 
     if res == None:
@@ -951,6 +1553,14 @@ def get_frame_inferences(frame_id: str, db: Session = Depends(get_db)):
             status_code=404,
             content={"message": "Frame with ID " + frame_id + " not found"},
         )
+    generation = response_cache.generation(res.project_id)
+
+    etag = make_etag(
+        "inferences", crud.get_frame_boxes_version(db, frame_id, res.video_id)
+    )
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
 
     rows_returned = crud.get_boxes_by_frame_id(db, frame_id)
 
@@ -972,7 +1582,98 @@ def get_frame_inferences(frame_id: str, db: Session = Depends(get_db)):
         )
         boxes.append(box)
 
-    return {"frame_id": frame_id, "bounding_boxes": boxes}
+    content = {"frame_id": frame_id, "bounding_boxes": boxes}
+    return cached_json_response(
+        request,
+        cache_json_response(cache_key, res.project_id, generation, etag, content),
+    )
+
+
+# Serve a frame's image. Setting w (width in pixels), q (quality from 1 to
+# 100) or fmt (jpeg, webp or png) returns a smaller or re-encoded variant,
+# which is generated on the first request and then kept in the thumbnail cache.
+@app.get("/frames/{frame_id}/image")
+def get_frame_image(
+    frame_id: str,
+    request: Request,
+    w: Optional[int] = None,
+    q: Optional[int] = None,
+    fmt: str = "jpeg",
+    db: Session = Depends(get_db),
+):
+    try:
+        uuid.UUID(frame_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Frame ID " + frame_id + " is not a valid UUID"},
+        )
+
+    if w is not None and not 16 <= w <= 4096:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Width must be between 16 and 4096 pixels"},
+        )
+    if q is not None and not 1 <= q <= 100:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Quality must be between 1 and 100"},
+        )
+    if fmt not in IMAGE_FORMATS:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": "Format must be one of: " + ", ".join(IMAGE_FORMATS.keys())
+            },
+        )
+
+    frame = crud.get_frame_by_id(db, frame_id)
+
+    if frame == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Frame with ID " + frame_id + " not found"},
+        )
+
+    # Frame images are written once, so a local file's size and modification
+    # time are enough to notice that one was replaced
+    version = frame.frame_url
+    local_path = None
+    if not is_packed_frame(frame.frame_url):
+        local_path = storage.local_path(frame.project.name, frame.frame_url)
+    if local_path is not None:
+        try:
+            stat = os.stat(local_path)
+        except FileNotFoundError:
+            return missing_frame_image_response(frame)
+        version += ":" + str(stat.st_mtime_ns) + ":" + str(stat.st_size)
+
+    is_original = w is None and q is None and fmt == "jpeg"
+    variant_key = version if is_original else f"{version}:{w}:{q}:{fmt}"
+    etag = 'W/"' + hashlib.sha1(variant_key.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = IMAGE_FORMATS[fmt][1]
+    if is_original:
+        if local_path is not None:
+            return FileResponse(local_path, media_type=media_type, headers=headers)
+        chunks = open_frame_chunks(frame.project.name, frame.frame_url)
+        if chunks is None:
+            return missing_frame_image_response(frame)
+        return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+    variant = thumbnail_cache.get(variant_key)
+    if variant is None:
+        chunks = open_frame_chunks(frame.project.name, frame.frame_url)
+        if chunks is None:
+            return missing_frame_image_response(frame)
+        original = b"".join(chunks)
+        variant = resize_image(original, w, 80 if q is None else q, fmt)
+        thumbnail_cache.put(variant_key, variant)
+
+    return Response(variant, media_type=media_type, headers=headers)
 
 
 @app.put("/frames")
@@ -981,9 +1682,7 @@ async def update_frames(
     db: Session = Depends(get_db),
 ):
     # Save the updated frames information
-    result = crud.update_frames(db, updated_frames)
-    if dict(result) != {}:
-        return 500
+    crud.update_frames(db, updated_frames)
     return 200
 
 
@@ -1033,82 +1732,96 @@ async def update_bounding_boxes(
             content={"message": "Video with ID " + video_id + " not found"},
         )
 
-    # Save the updated bounding box information
-    result = crud.update_boxes(db, updated_boxes)
-    if dict(result) != {}:
-        return 500
-
-    # Find out the specific labels used within this project
-    project_labels = crud.get_labels_by_project(db, project_id)
-    label2id = {label.name: label.id for label in project_labels}
-    unique_labels = list(label2id.keys())
-
-    # Fetch image_features and label names for each box for each
-    # frame in a video (the one specified in updated_boxes)
-    all_boxes = crud.get_box_vectors_and_labels_by_video_id(db, video_id)
-    box_vectors = []
-    box_labels = []
-    unreviewed_boxes = []
-    for row in all_boxes:
-        box = row[0]
-        # Will train on reviewed boxes and predict labels for unreviewed boxes
-        if box.prediction == True:
-            unreviewed_boxes.append(box)
-        else:
-            box_vectors.append(box.image_features)
-            box_labels.append(row.name)
+    # Everything but the training itself is blocking database and numpy
+    # work, which runs in the thread pool to keep the event loop free
+    training_data = await run_in_threadpool(
+        save_boxes_and_collect_training_data, db, project_id, updated_boxes
+    )
 
     # If there's nothing to train on, just return
-    if len(box_vectors) < 1:
+    if training_data is None:
         return 200
+    label2id, box_vectors, box_labels = training_data
 
-    # Instantiate a new classification model (small, feed forward network)
-    model = ClassifierManager(box_vectors, box_labels, unique_labels)
-
-    # Train the model using all of the bounding box information
-    model.fit()
-
-    if len(unreviewed_boxes) > 0:
-        # Get new label predictions for each box
-        unreviewed_boxes_vectors = [box.image_features for box in unreviewed_boxes]
-        new_predictions = model.predict(unreviewed_boxes_vectors)
-
-        # Attach the new label predictions to each box
-        new_predicted_boxes = []
-        for updated_label, box in zip(new_predictions, unreviewed_boxes):
-            new_box = schemas.BoundingBox.parse_obj(
-                {
-                    "x_top_left": box.x_top_left,
-                    "y_top_left": box.y_top_left,
-                    "x_bottom_right": box.x_bottom_right,
-                    "y_bottom_right": box.y_bottom_right,
-                    "width": box.width,
-                    "height": box.height,
-                    "frame_id": box.frame_id,
-                    "label_id": label2id[updated_label],
-                    "id": box.id,
-                    "prediction": True,
-                }
-            )
-            new_predicted_boxes.append(new_box)
+    # Train a new classification model (small, feed forward network) on all
+    # of the bounding box information in a training worker process, which
+    # then predicts new labels for the video's unreviewed boxes
+    await training_executor.train(
+        project_id,
+        box_vectors,
+        box_labels,
+        list(label2id.keys()),
+        relabel={
+            "video_id": video_id,
+            "label2id": label2id,
+            "chunk_size": prediction_chunk_size,
+            "min_confidence": min_relabel_confidence,
+        },
+    )
 
-        # Save updated label predictions in the database
-        result = crud.update_boxes(db, new_predicted_boxes)
-        if dict(result) != {}:
-            return 500
+    # The worker's NOTIFY reaches this process' cache listener a little later,
+    # so that the client's next request doesn't get the old labels
+    response_cache.invalidate([res.project_id])
 
     # Let the client know everything went well and to proceed
     return 200
 
 
+# Saves the updated boxes and gathers what to train the project's label
+# classifier on: the project's label name -> label ID mapping along with the
+# feature vectors and labels of the sampled reviewed boxes. Returns None if
+# no box has been reviewed yet.
+def save_boxes_and_collect_training_data(
+    db: Session, project_id: str, updated_boxes: List[schemas.BoundingBox]
+):
+    # Save the updated bounding box information
+    crud.update_boxes(db, updated_boxes)
+
+    # Find out the specific labels used within this project
+    project_labels = crud.get_labels_by_project(db, project_id)
+    label2id = {label.name: label.id for label in project_labels}
+
+    # Train on the reviewed boxes from every video in the project, sampling
+    # a bounded number of boxes per label. The sample is keyed on the box IDs
+    # so that it stays the same between retrains apart from new boxes.
+    reviewed_boxes = crud.get_reviewed_box_labels_by_project_id(db, project_id)
+    if len(reviewed_boxes) < 1:
+        return None
+
+    # Imports torch, so only once there's something to train
+    from model_training import (
+        features_to_vector,
+        balanced_sample_indices,
+        get_feature_cache,
+    )
+
+    sampled = balanced_sample_indices(
+        [row.name for row in reviewed_boxes],
+        max_training_boxes_per_label,
+        keys=[row.id for row in reviewed_boxes],
+    )
+    box_ids = [reviewed_boxes[i].id for i in sampled]
+    box_labels = [reviewed_boxes[i].name for i in sampled]
+
+    # Only read the image features of boxes that aren't cached yet
+    feature_cache = get_feature_cache(project_id, feature_cache_projects)
+    feature_cache.retain(box_ids)
+    missing_ids = feature_cache.missing(box_ids)
+    for i in range(0, len(missing_ids), 1000):
+        rows = crud.get_box_features_by_ids(db, missing_ids[i : i + 1000])
+        feature_cache.add(
+            [row.id for row in rows],
+            [features_to_vector(row.image_features) for row in rows],
+        )
+    return label2id, feature_cache.rows(box_ids), box_labels
+
+
 @app.put("/boundingboxes")
 def update_boxes_without_inference(
     updated_boxes: List[schemas.BoundingBox], db: Session = Depends(get_db)
 ):
     # Save the updated bounding box information
-    result = crud.update_boxes(db, updated_boxes)
-    if dict(result) != {}:
-        return 500
+    crud.update_boxes(db, updated_boxes)
     return 200
 
 
@@ -1130,6 +1843,7 @@ def delete_bounding_box(box_id: str, db: Session = Depends(get_db)):
             content={"message": "Bounding box with ID " + box_id + " not found"},
         )
 
+    frame = crud.get_frame_by_id(db, res.frame_id)
     crud.delete_box_by_id(db, box_id)
 
     # Check that it was actually deleted
@@ -1140,4 +1854,135 @@ def delete_bounding_box(box_id: str, db: Session = Depends(get_db)):
             content={"message": "Bounding box with ID " + box_id + " was not deleted"},
         )
 
+    box_index_registry.remove(frame.project_id, uuid.UUID(box_id))
+
     return 200
+
+
+@app.get("/boundingboxes/{box_id}/similar")
+def get_similar_boxes(box_id: str, k: int = 10, db: Session = Depends(get_db)):
+    try:
+        uuid.UUID(box_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Bounding Box ID " + box_id + " is not a valid UUID"},
+        )
+
+    res = crud.get_box_by_id(db, box_id)
+
+    if res == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Bounding box with ID " + box_id + " not found"},
+        )
+
+    frame = crud.get_frame_by_id(db, res.frame_id)
+    index = get_box_index(db, frame.project_id)
+    neighbors = index.query_by_id(res.id, k)
+
+    # Fetch the neighboring boxes and return them in order of similarity
+    rows_returned = crud.get_boxes_by_ids(
+        db, [neighbor_id for neighbor_id, _ in neighbors]
+    )
+    rows_by_id = {row.id: row for row in rows_returned}
+
+    boxes = []
+    for neighbor_id, similarity in neighbors:
+        row = rows_by_id.get(neighbor_id)
+        if row == None:
+            continue
+        box = schemas.SimilarBoundingBox.parse_obj(
+            {
+                "x_top_left": row.x_top_left,
+                "y_top_left": row.y_top_left,
+                "x_bottom_right": row.x_bottom_right,
+                "y_bottom_right": row.y_bottom_right,
+                "width": row.width,
+                "height": row.height,
+                "frame_id": row.frame_id,
+                "label_id": row.label_id,
+                "id": row.id,
+                "prediction": row.prediction,
+                "similarity": similarity,
+            }
+        )
+        boxes.append(box)
+
+    return {"box_id": box_id, "bounding_boxes": boxes}
+
+
+# Apply a label to a box and its k most similar boxes in the project,
+# optionally only to the neighbors that are at least min_similarity close
+@app.post("/boundingboxes/{box_id}/similar/label")
+def label_similar_boxes(
+    box_id: str,
+    label_id: str,
+    k: int = 10,
+    min_similarity: float = 0.0,
+    db: Session = Depends(get_db),
+):
+    try:
+        uuid.UUID(box_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Bounding Box ID " + box_id + " is not a valid UUID"},
+        )
+
+    res = crud.get_box_by_id(db, box_id)
+
+    if res == None:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "Bounding box with ID " + box_id + " not found"},
+        )
+
+    try:
+        uuid.UUID(label_id)
+    except:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Label ID " + label_id + " is not a valid UUID"},
+        )
+
+    frame = crud.get_frame_by_id(db, res.frame_id)
+    label = crud.get_label_by_id(db, label_id)
+
+    if label == None or label.project_id != frame.project_id:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "message": "Label with ID "
+                + label_id
+                + " not found in project with ID "
+                + str(frame.project_id)
+            },
+        )
+
+    index = get_box_index(db, frame.project_id)
+    neighbors = index.query_by_id(res.id, k)
+
+    box_ids = [res.id] + [
+        neighbor_id
+        for neighbor_id, similarity in neighbors
+        if similarity >= min_similarity
+    ]
+    crud.set_label_for_boxes(db, box_ids, label.id)
+
+    return {
+        "label_id": label_id,
+        "bounding_box_ids": [str(updated_id) for updated_id in box_ids],
+    }
+
+
+###############################################################
+# Metrics endpoints
+###############################################################
+
+
+# How long requests and background jobs wait for a database connection and
+# how close each connection pool is to running out (see sql_app/database.py)
+@app.get("/metrics/database")
+def get_database_metrics():
+    return {"pools": pool_metrics()}
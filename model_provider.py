@@ -0,0 +1,142 @@
+import os
+import threading
+
+from model_registry import model_registry, load_state_dict, version_tag
+
+# The pretrained models used while preprocessing videos are loaded the first
+# time they're needed rather than when a module is imported. Processes that
+# never run them (the API server in SERVER_MODE=api, tests of the other
+# endpoints) then start without importing torch or ultralytics and without
+# holding the weights in memory.
+
+
+class LazyModel:
+    # load = callable that returns the model, called at most once
+    def __init__(self, load):
+        self.load = load
+        self.model = None
+        self.lock = threading.Lock()
+
+    # Loads the model on first use. Threads asking for it at the same time
+    # wait for a single load instead of each loading their own copy.
+    def get(self):
+        model = self.model
+        if model is None:
+            with self.lock:
+                if self.model is None:
+                    self.model = self.load()
+                model = self.model
+        return model
+
+    def is_loaded(self):
+        return self.model is not None
+
+
+DETECTION_MODEL = "yolov8n"
+FEATURE_EXTRACTION_MODEL = "efficientnet-b0"
+
+
+# Which inference backend runs each model and with how many threads, see
+# inference_backends.py. Exported models are kept in model_export_dir.
+detector_backend = os.getenv("DETECTOR_BACKEND", "torch")
+detector_threads = int(os.getenv("DETECTOR_THREADS", "0"))
+embedder_backend = os.getenv("EMBEDDER_BACKEND", "torch")
+embedder_threads = int(os.getenv("EMBEDDER_THREADS", "0"))
+model_export_dir = os.getenv("MODEL_EXPORT_DIR", "./model_exports")
+
+# name -> version tag of the weights this process actually loaded
+loaded_version_tags = {}
+
+
+# Models are loaded from the local registry (see model_registry.py) when
+# they've been registered there, otherwise they're downloaded as before
+def build_detector(backend, threads):
+    from inference_backends import create_detector
+
+    artifact = model_registry.lookup(DETECTION_MODEL)
+    tag = version_tag(DETECTION_MODEL, artifact)
+    if artifact is None:
+        weights_path = DETECTION_MODEL + ".pt"
+    else:
+        model_registry.verify(artifact)
+        weights_path = artifact.path
+
+    detector = create_detector(backend, weights_path, model_export_dir, tag, threads)
+    loaded_version_tags[DETECTION_MODEL] = tag
+    return detector
+
+
+def embedder_version_tag():
+    return version_tag(
+        FEATURE_EXTRACTION_MODEL, model_registry.lookup(FEATURE_EXTRACTION_MODEL)
+    )
+
+
+# Features extracted by the quantized model differ slightly from the
+# original's, so boxes record which of the two they came from
+def _features_tag(tag, backend):
+    if backend == "onnx-int8":
+        return tag + "-int8"
+    return tag
+
+
+def build_embedder(backend, threads):
+    from efficientnet_pytorch import EfficientNet
+    from inference_backends import create_embedder
+
+    artifact = model_registry.lookup(FEATURE_EXTRACTION_MODEL)
+    tag = version_tag(FEATURE_EXTRACTION_MODEL, artifact)
+
+    def load_model():
+        if artifact is None:
+            model = EfficientNet.from_pretrained(FEATURE_EXTRACTION_MODEL)
+        else:
+            model_registry.verify(artifact)
+            model = EfficientNet.from_name(FEATURE_EXTRACTION_MODEL)
+            model.load_state_dict(load_state_dict(artifact.path))
+        model.eval()
+        return model
+
+    embedder = create_embedder(backend, load_model, model_export_dir, tag, threads)
+    loaded_version_tags[FEATURE_EXTRACTION_MODEL] = _features_tag(tag, backend)
+    return embedder
+
+
+# Pretrained YOLO object detection model, an inference_backends.Detector
+detector = LazyModel(lambda: build_detector(detector_backend, detector_threads))
+
+# Pretrained image feature extraction model (EfficientNet), an
+# inference_backends.Embedder
+embedder = LazyModel(lambda: build_embedder(embedder_backend, embedder_threads))
+
+
+# Used by processes that exist to run the models, so that the first video
+# doesn't pay for loading them
+def load_all():
+    detector.get()
+    embedder.get()
+
+
+# Stored with every predicted bounding box, so that boxes predicted by older
+# versions of the models can be found once they are replaced. This is the
+# version of what's registered now, which a process that loaded the models
+# earlier may not be running.
+# backend = the EMBEDDER_BACKEND of the processes that preprocess videos,
+# this process' by default
+def model_version(backend=None):
+    if backend is None:
+        backend = embedder_backend
+    return (
+        version_tag(DETECTION_MODEL, model_registry.lookup(DETECTION_MODEL))
+        + "+"
+        + _features_tag(embedder_version_tag(), backend)
+    )
+
+
+# The version of the models this process is running, once they're loaded
+def loaded_model_version():
+    return (
+        loaded_version_tags[DETECTION_MODEL]
+        + "+"
+        + loaded_version_tags[FEATURE_EXTRACTION_MODEL]
+    )
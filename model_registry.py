@@ -0,0 +1,203 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# Local registry of the pretrained model weights used for preprocessing.
+#
+# Weights are kept in a directory (MODEL_REGISTRY_DIR) next to a manifest,
+# MANIFEST_NAME, that records each model's version, file and SHA-256
+# checksum:
+#
+#   {"yolov8n": {"version": "8.0.93", "file": "yolov8n.pt", "sha256": "..."}}
+#
+# Loading from the registry never touches the network, doesn't depend on the
+# working directory, and checks the file against its checksum first, so every
+# worker node runs exactly the weights that were registered. Populate the
+# directory once on a machine with network access:
+#
+#   python model_registry.py bootstrap
+#
+# and copy it to the nodes, or register a file of your own with
+#
+#   python model_registry.py register <name> <version> <path>
+
+MANIFEST_NAME = "registry.json"
+DEFAULT_DIRECTORY = "./model_registry"
+
+# Models that aren't in the registry are reported with this version
+UNREGISTERED_VERSION = "pretrained"
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class ModelArtifact:
+    def __init__(self, name, version, path, sha256):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.sha256 = sha256
+
+
+# "<name>:<version>", what detections made with a model are tagged with.
+# artifact = the model's ModelArtifact, or None if it isn't registered
+def version_tag(name, artifact):
+    version = artifact.version if artifact is not None else UNREGISTERED_VERSION
+    return name + ":" + version
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as artifact_file:
+        while True:
+            chunk = artifact_file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.lock = threading.Lock()
+
+        # Paths whose checksum was already checked, keyed by (size, mtime) so
+        # that a file replaced on disk is checked again
+        self.verified = {}
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def read_manifest(self):
+        try:
+            with open(self._manifest_path()) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {}
+
+    # Returns the registered ModelArtifact, or None
+    def lookup(self, name):
+        entry = self.read_manifest().get(name)
+        if entry is None:
+            return None
+        return ModelArtifact(
+            name,
+            entry["version"],
+            os.path.join(self.directory, entry["file"]),
+            entry["sha256"],
+        )
+
+    # Raises ChecksumMismatch if the artifact's file isn't what was registered
+    def verify(self, artifact):
+        stat = os.stat(artifact.path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if self.verified.get(artifact.path) == (key, artifact.sha256):
+                return
+
+        actual = file_sha256(artifact.path)
+        if actual != artifact.sha256:
+            raise ChecksumMismatch(
+                f"{artifact.path} has checksum {actual}, "
+                f"expected {artifact.sha256} for {artifact.name}:{artifact.version}"
+            )
+        with self.lock:
+            self.verified[artifact.path] = (key, artifact.sha256)
+
+    # Copies the file into the registry and records it in the manifest
+    def register(self, name, version, source_path):
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = name + "-" + version + os.path.splitext(source_path)[1]
+        shutil.copyfile(source_path, os.path.join(self.directory, file_name))
+
+        with self.lock:
+            manifest = self.read_manifest()
+            manifest[name] = {
+                "version": version,
+                "file": file_name,
+                "sha256": file_sha256(os.path.join(self.directory, file_name)),
+            }
+
+            # Replace the manifest in one step so readers never see half of it
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+            with os.fdopen(fd, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+            os.replace(temp_path, self._manifest_path())
+        return self.lookup(name)
+
+
+# Loads a saved state dict onto the CPU, memory-mapping the file instead of
+# reading it into memory on versions of torch that support it (2.1 and up)
+def load_state_dict(path):
+    import torch
+
+    if "mmap" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    return torch.load(path, map_location="cpu")
+
+
+model_registry = ModelRegistry(os.getenv("MODEL_REGISTRY_DIR", DEFAULT_DIRECTORY))
+
+
+# Downloads the default models and registers them, run on a machine with
+# network access
+def bootstrap(registry):
+    import torch
+    import ultralytics
+    import efficientnet_pytorch
+    from ultralytics import YOLO
+    from efficientnet_pytorch import EfficientNet
+
+    with tempfile.TemporaryDirectory() as download_directory:
+        # YOLO downloads its weights into the working directory
+        previous_directory = os.getcwd()
+        os.chdir(download_directory)
+        try:
+            YOLO("yolov8n.pt")
+        finally:
+            os.chdir(previous_directory)
+        registry.register(
+            "yolov8n",
+            ultralytics.__version__,
+            os.path.join(download_directory, "yolov8n.pt"),
+        )
+
+        state_dict_path = os.path.join(download_directory, "efficientnet-b0.pt")
+        torch.save(
+            EfficientNet.from_pretrained("efficientnet-b0").state_dict(),
+            state_dict_path,
+        )
+        registry.register(
+            "efficientnet-b0", efficientnet_pytorch.__version__, state_dict_path
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("bootstrap", help="download and register the default models")
+    register_parser = subparsers.add_parser("register", help="register a weights file")
+    register_parser.add_argument("name")
+    register_parser.add_argument("version")
+    register_parser.add_argument("path")
+    subparsers.add_parser("list", help="show the registered models")
+    args = parser.parse_args()
+
+    if args.command == "bootstrap":
+        bootstrap(model_registry)
+    elif args.command == "register":
+        model_registry.register(args.name, args.version, args.path)
+
+    for name, entry in sorted(model_registry.read_manifest().items()):
+        print(f"{name:<20}{entry['version']:<12}{entry['sha256']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,142 @@ import numpy as np
 from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
 import pickle
+import threading
+import hashlib
+import heapq
+from collections import OrderedDict
 
 
 # Main reference from capstone era: https://github.com/div-lab/video-highlights/blob/capstone/model_training/fine_grained_classification.py
 
+
+# Bounding boxes store their EfficientNet features as a pickled tensor,
+# this turns one of those byte arrays into a flat float32 numpy vector
+def features_to_vector(image_features):
+    x = pickle.loads(image_features)
+    return x.numpy().reshape(-1).astype(np.float32)
+
+
+# Hash of key (mixed with seed) that stays the same between runs, unlike hash()
+def stable_hash(key, seed=None):
+    digest = hashlib.blake2b(f"{seed}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# Pick at most max_per_label boxes for each label (at random) so that the cost
+# of training stays bounded as projects grow and so that common labels do not
+# drown out rare ones. Returns the indices of the chosen boxes.
+# keys = optional list of stable IDs (such as box UUIDs), in which case each
+#        label keeps the boxes whose keys hash lowest instead, so that the
+#        sample only changes by the boxes that were added or removed
+def balanced_sample_indices(box_labels, max_per_label, seed=None, keys=None):
+    rng = np.random.default_rng(seed)
+    indices_per_label = {}
+    for index, label in enumerate(box_labels):
+        indices_per_label.setdefault(label, []).append(index)
+
+    sampled = []
+    for indices in indices_per_label.values():
+        if len(indices) > max_per_label:
+            if keys is None:
+                indices = rng.choice(indices, size=max_per_label, replace=False).tolist()
+            else:
+                indices = heapq.nsmallest(
+                    max_per_label, indices, key=lambda i: stable_hash(keys[i], seed)
+                )
+        sampled.extend(indices)
+    sampled.sort()
+    return sampled
+
+
+# Keeps the decoded feature vectors of a project's reviewed boxes in memory
+# so that retraining only reads the blobs of boxes it has not seen before
+# rather than every blob in the project
+class FeatureMatrixCache:
+    def __init__(self):
+        self.matrix = None
+        self.id2row = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.id2row)
+
+    def missing(self, box_ids):
+        with self.lock:
+            return [box_id for box_id in box_ids if box_id not in self.id2row]
+
+    # box_ids = list of bounding box UUIDs
+    # vectors = matching list of flat feature vectors
+    def add(self, box_ids, vectors):
+        if len(box_ids) == 0:
+            return
+
+        with self.lock:
+            new_rows = [
+                i for i, box_id in enumerate(box_ids) if box_id not in self.id2row
+            ]
+            if len(new_rows) == 0:
+                return
+            new_vectors = np.asarray([vectors[i] for i in new_rows], dtype=np.float32)
+
+            # Grow the matrix geometrically so appends stay cheap on average
+            size = len(self.id2row)
+            if self.matrix is None:
+                self.matrix = np.zeros(
+                    (max(1024, len(new_rows)), new_vectors.shape[1]), dtype=np.float32
+                )
+            elif size + len(new_rows) > self.matrix.shape[0]:
+                # The matrix can have no rows left after retain
+                capacity = max(self.matrix.shape[0], 1024)
+                while capacity < size + len(new_rows):
+                    capacity *= 2
+                grown = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+                grown[:size] = self.matrix[:size]
+                self.matrix = grown
+
+            self.matrix[size : size + len(new_rows)] = new_vectors
+            for offset, i in enumerate(new_rows):
+                self.id2row[box_ids[i]] = size + offset
+
+    # Forget boxes that are no longer sampled for training (or were deleted),
+    # but only once they make up most of the cache since compacting means a
+    # copy. Retaining the training sample keeps the cache under twice its size.
+    def retain(self, box_ids):
+        with self.lock:
+            keep = [box_id for box_id in box_ids if box_id in self.id2row]
+            if len(self.id2row) <= 2 * len(keep) or self.matrix is None:
+                return
+            if len(keep) == 0:
+                self.matrix = None
+                self.id2row = {}
+                return
+            rows = [self.id2row[box_id] for box_id in keep]
+            self.matrix = self.matrix[rows].copy()
+            self.id2row = {box_id: row for row, box_id in enumerate(keep)}
+
+    # Returns the feature matrix for the given boxes (which must be cached)
+    def rows(self, box_ids):
+        with self.lock:
+            return self.matrix[[self.id2row[box_id] for box_id in box_ids]]
+
+
+# Only the caches of the max_projects most recently trained projects are
+# kept, the others are freed and rebuilt from the database when next needed
+feature_caches = OrderedDict()
+feature_caches_lock = threading.Lock()
+
+
+def get_feature_cache(project_id, max_projects=4):
+    with feature_caches_lock:
+        key = str(project_id)
+        if key not in feature_caches:
+            feature_caches[key] = FeatureMatrixCache()
+        feature_caches.move_to_end(key)
+        while len(feature_caches) > max_projects:
+            feature_caches.popitem(last=False)
+        return feature_caches[key]
+
+
 class MultiClassClassifier(nn.Module):
     def __init__(self, input_dim, num_classes) :
         super().__init__()
@@ -27,6 +159,29 @@ class MultiClassClassifier(nn.Module):
         return out
 
 
+# Returns a copy of the classifier whose linear layers use INT8 weights,
+# with activations quantized on the fly. Only meant for prediction on the CPU.
+def quantize_classifier(classifier):
+    return torch.ao.quantization.quantize_dynamic(
+        classifier, {nn.Linear}, dtype=torch.qint8
+    )
+
+
+# Fraction of the box vectors (2D float32 array) that both classifiers give
+# the same label, used to check that quantizing didn't cost too much accuracy
+def prediction_agreement(classifier, other_classifier, box_vectors, chunk_size=1024):
+    if len(box_vectors) == 0:
+        return 1.0
+    classifier.eval()
+    other_classifier.eval()
+    agreeing = 0
+    with torch.inference_mode():
+        for start in range(0, len(box_vectors), chunk_size):
+            x = torch.from_numpy(np.ascontiguousarray(box_vectors[start : start + chunk_size]))
+            agreeing += int((classifier(x).argmax(1) == other_classifier(x).argmax(1)).sum())
+    return agreeing / len(box_vectors)
+
+
 class DetectionData(Dataset):
     def __init__(self, box_vectors, box_labels, unique_labels, transformations=None):
         super().__init__()
@@ -49,7 +204,7 @@ class DetectionData(Dataset):
         return len(self.box_labels)
     
     def __getitem__(self, idx):
-        x = pickle.loads(self.box_vectors[idx])
+        x = torch.from_numpy(self.box_vectors[idx])
 
         if self.transformations is not None:
             x = self.transformations(x)
@@ -59,7 +214,7 @@ class DetectionData(Dataset):
 
 
 class ClassifierManager():
-    # box_vectors = byte arrays for each box containing the extracted image features 
+    # box_vectors = 2D array with one row of flattened image features per box
     #               (aka learned values or features that help with classification)
     # box_labels = list of label names (strings) for each box vector
     # unique_labels = list of label names containing no duplicates
@@ -71,13 +226,28 @@ class ClassifierManager():
         self.train_data = DetectionData(box_vectors, box_labels, unique_labels, self.transformations)
         self.train_loader = DataLoader(self.train_data, batch_size=64, shuffle=True)
 
-        single_sample_size = self.train_data[0][0].size()[1:]
-        flat_features = 1
-        for s in single_sample_size:
-            flat_features *= s
+        flat_features = self.train_data.box_vectors.shape[1]
         self.classifier = MultiClassClassifier(flat_features, len(unique_labels))
 
     
+    # Rebuild a manager around weights that were trained elsewhere (such as
+    # in a training worker process), it can only be used for prediction.
+    # quantize = predict with INT8 weights (see quantize_classifier)
+    @classmethod
+    def from_trained(cls, state_dict, input_dim, unique_labels, quantize=False):
+        manager = cls.__new__(cls)
+        manager.unique_labels = unique_labels
+        manager.box_labels = []
+        manager.transformations = None
+        manager.train_data = None
+        manager.train_loader = None
+        manager.classifier = MultiClassClassifier(input_dim, len(unique_labels))
+        manager.classifier.load_state_dict(state_dict)
+        if quantize:
+            manager.classifier = quantize_classifier(manager.classifier)
+        return manager
+
+    
     def fit(self):
         optimizer = Adam(self.classifier.parameters())
         criterion = nn.CrossEntropyLoss()
@@ -95,22 +265,45 @@ class ClassifierManager():
                 print(f"Epoch: {epoch} | Batch: {batch_num} | Loss: {loss.item()}")
 
 
-    # Inputs = list of image feature vectors
-    def predict(self, inputs):
+    # Inputs = list of image feature byte arrays
+    # Returns the predicted label name and its softmax confidence for each
+    # input. Inputs are decoded and classified chunk_size at a time into a
+    # reused buffer so memory stays flat however many boxes there are.
+    def predict(self, inputs, chunk_size=1024):
         self.classifier.eval()
-        inputs_as_tensors = []
-        for input in inputs:
-            x = pickle.loads(input)
+        buffer = np.empty((chunk_size, self.classifier.input_dim), dtype=np.float32)
+        label_names = []
+        confidences = []
+
+        for start in range(0, len(inputs), chunk_size):
+            chunk = inputs[start : start + chunk_size]
+            for i, input in enumerate(chunk):
+                buffer[i] = features_to_vector(input)
+            x = torch.from_numpy(buffer[: len(chunk)])
             if self.transformations is not None:
                 x = self.transformations(x)
-            inputs_as_tensors.append(x)
-        inputs_as_tensors = torch.stack(inputs_as_tensors)
-        
-        logits = self.classifier(inputs_as_tensors)
-        pred_probab = nn.Softmax(dim=1)(logits)
-        y_pred = pred_probab.argmax(1)
-        label_names = [self.unique_labels[(int(pred))] for pred in y_pred]
-        return label_names
+
+            with torch.inference_mode():
+                logits = self.classifier(x)
+                pred_probab = nn.Softmax(dim=1)(logits)
+                chunk_confidences, y_pred = pred_probab.max(1)
+
+            label_names.extend([self.unique_labels[int(pred)] for pred in y_pred])
+            confidences.extend(chunk_confidences.tolist())
+
+        return label_names, confidences
+
+
+# Split any iterable (such as a streamed query) into lists of up to chunk_size
+def iterate_in_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
 
         
 # Test stuff in this file as necessary
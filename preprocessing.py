@@ -0,0 +1,383 @@
+import json
+import os
+import pickle
+import tempfile
+import uuid
+
+import cv2
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from sqlalchemy.orm import Session
+
+from sql_app import schemas, crud
+from model_provider import loaded_model_version
+from inference_server import inference_server
+from inference_backends import EMBEDDING_INPUT_SIZE
+from storage import video_files_path, timeline_path
+from timeline import SpriteSheetBuilder, sheet_name, INDEX_NAME
+from frame_pack import PACK_NAME, frame_pack_url, open_frame_pack
+from progress import ProgressTracker, DECODE, DETECT, STORE
+from frame_sampling import sample_frames
+from frame_hashing import FrameHashIndex, perceptual_hash
+
+# Video preprocessing, which needs the computer vision stack (OpenCV, torch
+# and the pretrained models). Only processes that preprocess videos import
+# this module: the API server in SERVER_MODE=all, which runs it in FastAPI
+# background tasks, and worker.py.
+
+# How preprocessing stores extracted frames: "files" for one JPEG per frame
+# or "pack" for a single append-only pack per video (see frame_pack.py)
+frame_storage_format = os.getenv("FRAME_STORAGE_FORMAT", "files")
+
+# Seconds between saving a video's preprocessing progress (see progress.py)
+progress_save_interval = float(os.getenv("PROGRESS_SAVE_INTERVAL", "1"))
+
+# A frame whose perceptual hash differs in at most this many of its 64 bits
+# from a frame already preprocessed in the project gets a copy of that
+# frame's boxes instead of running the models (see frame_hashing.py).
+# Negative (the default) to always run the models.
+frame_hash_max_distance = int(os.getenv("FRAME_HASH_MAX_DISTANCE", "-1"))
+
+# Preprocessing commits every frame, but only tells other workers to drop
+# their cached responses for the project this often (in seconds), see
+# crud.batched_invalidation
+cache_invalidation_interval = float(os.getenv("CACHE_INVALIDATION_INTERVAL", "1"))
+
+
+# Crops what's inside a bounding box out of a frame (as returned by
+# TF.to_tensor) and resizes it for the feature extractor
+def crop_box(frame_tensor, x_top_left, y_top_left, width, height):
+    cropped_image = TF.crop(
+        frame_tensor, y_top_left, x_top_left, height, width
+    ).unsqueeze(0)
+    return TF.resize(
+        cropped_image, (EMBEDDING_INPUT_SIZE, EMBEDDING_INPUT_SIZE), antialias=True
+    )
+
+
+# Runs the models on a frame and returns the boxes they found (to be inserted
+# along with the frame, see crud.insert_frame_with_boxes) and the feature
+# vector of each box. Labels the project doesn't have yet are inserted.
+def predict_bounding_boxes(
+    frame_image,
+    frame_id: uuid.UUID,
+    project_id: uuid.UUID,
+    db: Session,
+):
+    # Apply pretrained object detection model to each frame to generate bounding boxes.
+    # The models are shared by every preprocessing job in the process, which
+    # batch their frames and crops together (see inference_server.py).
+    yolo_results = inference_server.detect(frame_image)
+    yolo_class_ids_to_names = yolo_results.names
+
+    # Insert any new detected labels into the database
+    labels_to_insert = []
+    label_names = np.unique(
+        [yolo_class_ids_to_names[int(box.cls)] for box in yolo_results.boxes]
+    )
+    for label_name in label_names:
+        if crud.get_label_by_name_and_project(db, label_name, project_id) == None:
+            labels_to_insert.append(
+                schemas.LabelCreate.parse_obj(
+                    {"project_id": project_id, "name": str(label_name)}
+                )
+            )
+
+    if len(labels_to_insert) > 0:
+        crud.insert_labels(db, labels_to_insert)
+
+    # Update mapping for the IDs from the database's Label table
+    label_names_to_db_ids = {}
+    all_project_labels = crud.get_labels_by_project(db, project_id)
+    for label in all_project_labels:
+        label_names_to_db_ids[label.name] = label.id
+
+    # Put info about each box into a standard format
+    frame_tensor = TF.to_tensor(frame_image)
+    boxes = []
+    crops = []
+    for box in yolo_results.boxes:
+        # Box information given as tensor([[float, float, float, float]])
+        x_top_left = int(box.xyxy[0][0])
+        y_top_left = int(box.xyxy[0][1])
+        x_bottom_right = int(box.xyxy[0][2])
+        y_bottom_right = int(box.xyxy[0][3])
+        width = int(box.xywh[0][2])
+        height = int(box.xywh[0][3])
+        label_name = yolo_class_ids_to_names[int(box.cls)]
+
+        # The feature vectors of all of the frame's crops are extracted at
+        # once below
+        crops.append(crop_box(frame_tensor, x_top_left, y_top_left, width, height))
+
+        boxes.append(
+            {
+                "x_top_left": x_top_left,
+                "y_top_left": y_top_left,
+                "x_bottom_right": x_bottom_right,
+                "y_bottom_right": y_bottom_right,
+                "width": width,
+                "height": height,
+                "frame_id": frame_id,
+                "label_id": label_names_to_db_ids[label_name],
+                "prediction": True,
+            }
+        )
+
+    if len(boxes) == 0:
+        return [], []
+
+    features = inference_server.embed(torch.cat(crops))
+    version = loaded_model_version()
+    db_boxes = []
+    box_vectors = []
+    for i, box in enumerate(boxes):
+        # Each box keeps its own (1, 1280, 2, 2) tensor as before. Cloning
+        # keeps pickle from saving the features of the whole batch.
+        image_features = features[i : i + 1].clone()
+        box_vectors.append(image_features.numpy().reshape(-1))
+        box["image_features"] = pickle.dumps(image_features)
+        box["model_version"] = version
+        db_boxes.append(schemas.BoundingBoxCreate.parse_obj(box))
+    return db_boxes, box_vectors
+
+
+# Preprocessing a video involves extracting frames (1 fps, or as the
+# project's sampling settings pick them, see frame_sampling.py)
+# and using a pretrained object detection model to generate
+# initial bounding boxes and labels.
+#
+# storage = the storage.StorageBackend the project's files are kept in
+# on_boxes_inserted = optional callable taking (project_id, box_ids, vectors),
+# called with the feature vectors of the boxes once they're in the database
+def preprocess_video(
+    video_bytes,
+    storage,
+    project_name: str,
+    video_name: str,
+    video_id: uuid.UUID,
+    project_id: uuid.UUID,
+    db: Session,
+    on_boxes_inserted=None,
+):
+    with crud.batched_invalidation(db, cache_invalidation_interval):
+        _preprocess_video(
+            video_bytes,
+            storage,
+            project_name,
+            video_name,
+            video_id,
+            project_id,
+            db,
+            on_boxes_inserted,
+        )
+
+
+def _preprocess_video(
+    video_bytes,
+    storage,
+    project_name: str,
+    video_name: str,
+    video_id: uuid.UUID,
+    project_id: uuid.UUID,
+    db: Session,
+    on_boxes_inserted=None,
+):
+    # Signify that preprocessing has begun
+    crud.set_video_preprocessing_status(db, video_id, "in_progress")
+
+    # Video is sent as bytes but OpenCV's VideoCapture only reads
+    # videos from files, so using a temp file here
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.write(video_bytes)
+        vidcap = cv2.VideoCapture(temp.name)
+
+    # Figure out number of frames and frames per second rate
+    num_frames = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+
+    # Figure out frame width and height (returned as floats but we'll round)
+    width = round(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = round(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    frames_path = video_files_path(storage, project_name, video_name) + "/frames"
+
+    # Frame images are uploaded several at a time in the background while
+    # the next frames are extracted and run through the models
+    uploads = storage.batch_uploader(project_name)
+
+    # Small thumbnails of every frame are also tiled into timeline sprite
+    # sheets, which are saved next to the frames
+    sheets_path = timeline_path(storage, project_name, video_name)
+    timeline_builder = SpriteSheetBuilder(width, height)
+
+    # With packed storage, frames are appended to a single pack per video in
+    # large batches instead of being saved one file or blob at a time. If
+    # preprocessing fails the pack is simply written again on restart.
+    frame_pack = None
+    if frame_storage_format == "pack":
+        pack_path = frames_path + "/" + PACK_NAME
+        frame_pack = open_frame_pack(storage, project_name, pack_path)
+
+    # Frames processed out of the video's total and the rate of each stage
+    # are saved to the video as preprocessing goes
+    frames_total = int(num_frames)
+    progress = ProgressTracker(
+        frames_total,
+        lambda frames_processed, frames_per_second, stage_rates: crud.set_video_progress(
+            db,
+            video_id,
+            frames_processed,
+            frames_total,
+            frames_per_second,
+            stage_rates,
+        ),
+        progress_save_interval,
+    )
+    progress.start()
+
+    # Frames already preprocessed in the project, including other videos',
+    # whose boxes can be copied onto near identical frames of this video
+    frame_hashes = FrameHashIndex()
+    if frame_hash_max_distance >= 0:
+        frame_hashes = FrameHashIndex(
+            crud.get_frame_hashes_by_project_id(db, project_id)
+        )
+
+    sampled_frames = sample_frames(
+        vidcap, num_frames, fps, crud.get_project_by_id(db, project_id)
+    )
+
+    index = 0
+    completed = False
+    try:
+        while True:
+            # Stop if preprocessing was cancelled (DELETE
+            # /videos/{id}/preprocess), which may have happened in another
+            # process
+            if crud.get_video_preprocessing_status(db, video_id) == "cancelled":
+                return
+
+            with progress.stage(DECODE):
+                sampled_frame = next(sampled_frames, None)
+                if sampled_frame is None:
+                    completed = True
+                    break
+                frame, hasFrames, image = sampled_frame
+                frame_number = int(frame)
+                timestamp = round(frame_number / fps, 3) if fps > 0 else None
+
+                if not hasFrames:
+                    # If frames could not be extracted, signify that
+                    # preprocessing failed for this video so caller can restart
+                    crud.set_video_preprocessing_status(db, video_id, "failed")
+                    return
+
+                # Otherwise continue and save frame as image in desired storage path
+                # and note whether frame insertion was successful
+                is_success, buffer = cv2.imencode(".jpg", image)
+
+                if not is_success:
+                    # Signify that preprocessing failed for this video so
+                    # caller can restart
+                    crud.set_video_preprocessing_status(db, video_id, "failed")
+                    return
+
+            # Near identical frames get copies of the boxes of the frame
+            # they match rather than running the models again
+            frame_id = uuid.uuid4()
+            with progress.stage(DETECT):
+                frame_hash = perceptual_hash(image)
+                duplicate_frame_id = None
+                if frame_hash_max_distance >= 0:
+                    duplicate_frame_id = frame_hashes.nearest(
+                        frame_hash, frame_hash_max_distance
+                    )
+                if duplicate_frame_id is None:
+                    boxes, box_vectors = predict_bounding_boxes(
+                        image, frame_id, project_id, db
+                    )
+
+            with progress.stage(STORE):
+                if frame_pack is not None:
+                    pack_index = frame_pack.add(buffer.tobytes())
+                    frame_url = frame_pack_url(pack_path, pack_index)
+                else:
+                    frame_url = frames_path + "/" + str(index) + ".jpg"
+                    uploads.write(frame_url, buffer.tobytes())
+
+                new_frame = schemas.FrameCreate.parse_obj(
+                    {
+                        "width": width,
+                        "height": height,
+                        "project_id": project_id,
+                        "video_id": video_id,
+                        "frame_url": frame_url,
+                        "frame_number": frame_number,
+                        "timestamp": timestamp,
+                    }
+                )
+
+                # The frame, its boxes and its hash are written at once
+                if duplicate_frame_id is None:
+                    box_ids = crud.insert_frame_with_boxes(
+                        db, new_frame, frame_id, frame_hash, boxes
+                    )
+                else:
+                    rows = crud.insert_frame_with_copied_boxes(
+                        db, new_frame, frame_id, frame_hash, duplicate_frame_id
+                    )
+                    box_ids = [row.id for row in rows]
+                    box_vectors = [
+                        pickle.loads(row.image_features).numpy().reshape(-1)
+                        for row in rows
+                    ]
+                frame_hashes.add(frame_id, frame_hash)
+
+            if on_boxes_inserted is not None and len(box_ids) > 0:
+                on_boxes_inserted(project_id, box_ids, box_vectors)
+
+            with progress.stage(STORE):
+                sheet = timeline_builder.add(image, frame_number, timestamp)
+                if sheet is not None:
+                    uploads.write(
+                        sheets_path
+                        + "/"
+                        + sheet_name(timeline_builder.sheet_count - 1),
+                        sheet,
+                    )
+
+            index += 1
+            progress.frame_done(frame_number + 1)
+    finally:
+        # Also when preprocessing stops early (cancelled, failed or raised),
+        # so that the frames saved so far can be read and the progress made
+        # is recorded, and so that no upload outlives the job
+        if frame_pack is not None:
+            frame_pack.close()
+        if not completed:
+            progress.stop()
+            uploads.cancel()
+
+    # Only report success once every upload has gone through
+    try:
+        sheet = timeline_builder.finish()
+        if sheet is not None:
+            uploads.write(
+                sheets_path + "/" + sheet_name(timeline_builder.sheet_count - 1),
+                sheet,
+            )
+        uploads.write(
+            sheets_path + "/" + INDEX_NAME,
+            json.dumps(timeline_builder.index()).encode(),
+        )
+        uploads.wait()
+    except Exception:
+        uploads.cancel()
+        crud.set_video_preprocessing_status(db, video_id, "failed")
+        raise
+
+    # Update done_processing field for this video
+    progress.finish()
+    crud.set_video_preprocessing_status(db, video_id, "success")
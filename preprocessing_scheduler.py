@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+# Runs the videos an API server in SERVER_MODE=all preprocesses itself, at
+# most max_jobs at a time. The others wait in a queue of at most max_queued
+# videos, after which uploads are turned away until there's room again.
+#
+# Queued videos are preprocessed in order of priority: new uploads before
+# re-runs (see the restart endpoint), and smaller videos before larger ones
+# so that a long video doesn't hold up a batch of short ones.
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lowest first
+UPLOAD = 0
+RERUN = 1
+
+# Seconds a client is told to wait before retrying while the queue is full,
+# until there's a history of how long jobs take
+DEFAULT_RETRY_AFTER = 60
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PreprocessingScheduler:
+    def __init__(self, max_jobs, max_queued, default_retry_after=DEFAULT_RETRY_AFTER):
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.default_retry_after = default_retry_after
+
+        # (priority, size, sequence, video_id, run) entries, see submit
+        self.queue = []
+        # video_id -> callable, for the videos that are still queued
+        self.queued_jobs = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.closed = False
+
+        # Moving average of how many seconds a job takes
+        self.average_duration = None
+
+    def queued_count(self):
+        with self.condition:
+            return len(self.queued_jobs)
+
+    # Seconds until a place in the queue is likely to free up, given how many
+    # videos are queued (this scheduler's queue by default)
+    def retry_after(self, queued_count=None):
+        if queued_count is None:
+            queued_count = self.queued_count()
+        if self.average_duration is None:
+            return self.default_retry_after
+        # A place frees up each time one of the running jobs finishes
+        waiting = max(1, queued_count - self.max_queued + 1)
+        return max(1, math.ceil(self.average_duration * waiting / self.max_jobs))
+
+    # run = callable that preprocesses the video, called from one of the
+    # scheduler's threads
+    # size = the video's size in bytes
+    # priority = UPLOAD or RERUN
+    def submit(self, video_id, run, size, priority=UPLOAD):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The preprocessing scheduler has been shut down")
+            if len(self.queued_jobs) >= self.max_queued:
+                raise QueueFull()
+            # A video that's queued again replaces its queued entry
+            self.queued_jobs[video_id] = run
+            heapq.heappush(
+                self.queue, (priority, size, next(self.sequence), video_id, run)
+            )
+            self._start_threads()
+            self.condition.notify()
+
+    # Started on first use so that processes that never preprocess videos
+    # don't have idle threads
+    def _start_threads(self):
+        while len(self.threads) < self.max_jobs:
+            thread = threading.Thread(
+                target=self._run,
+                name="preprocessing-" + str(len(self.threads)),
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    # Takes a video off the queue before it starts. Returns whether it was
+    # queued here, a video that's already running is cancelled through its
+    # preprocessing status instead (see preprocessing.preprocess_video).
+    def cancel(self, video_id):
+        with self.condition:
+            return self.queued_jobs.pop(video_id, None) is not None
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+                while len(self.queue) > 0:
+                    _, _, _, video_id, run = heapq.heappop(self.queue)
+                    # Skip entries that were cancelled or queued again since
+                    if self.queued_jobs.get(video_id) is run:
+                        del self.queued_jobs[video_id]
+                        return video_id, run
+                self.condition.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            video_id, run = job
+
+            start = time.monotonic()
+            try:
+                run()
+            except Exception:
+                logger.exception("Failed to preprocess video %s", video_id)
+            duration = time.monotonic() - start
+
+            with self.condition:
+                if self.average_duration is None:
+                    self.average_duration = duration
+                else:
+                    self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+
+    # Running jobs are left to finish, videos still queued aren't started
+    def shutdown(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,116 @@
+import datetime
+import time
+from contextlib import contextmanager
+
+# Progress of preprocessing a video, recorded on its row in the videos table
+# while it runs so that any API process can report it (see
+# GET /videos/{video_id}/progress and its event stream in main.py).
+#
+# Progress is counted in frames of the video (CAP_PROP_FRAME_COUNT) rather
+# than in the frames that are sampled from it. Each stage of handling a
+# sampled frame is timed separately, so that the rates show where the time
+# goes.
+
+# Stages of handling a sampled frame
+DECODE = "decode"
+DETECT = "detect"
+STORE = "store"
+
+# Preprocessing statuses after which progress no longer changes
+FINISHED_STATUSES = ("success", "failed", "cancelled")
+
+
+class ProgressTracker:
+    # frames_total = number of frames in the video
+    # save = callable taking (frames_processed, frames_per_second,
+    # stage_rates), called at most every save_interval seconds
+    def __init__(self, frames_total, save, save_interval=1.0):
+        self.frames_total = frames_total
+        self.save = save
+        self.save_interval = save_interval
+        self.frames_processed = 0
+        self.sampled_frames = 0
+        self.stage_seconds = {}
+        self.start_time = time.monotonic()
+        self.last_save_time = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + (
+                time.monotonic() - start
+            )
+
+    # Sampled frames handled per second of each stage
+    def stage_rates(self):
+        return {
+            name: round(self.sampled_frames / seconds, 3)
+            for name, seconds in self.stage_seconds.items()
+            if seconds > 0
+        }
+
+    # Frames of the video processed per second since preprocessing started
+    def frames_per_second(self):
+        elapsed = time.monotonic() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return round(self.frames_processed / elapsed, 3)
+
+    def _save(self):
+        self.last_save_time = time.monotonic()
+        self.save(self.frames_processed, self.frames_per_second(), self.stage_rates())
+
+    def start(self):
+        self._save()
+
+    # frames_processed = frames of the video up to and including the sampled
+    # frame that was just handled
+    def frame_done(self, frames_processed):
+        self.frames_processed = min(self.frames_total, frames_processed)
+        self.sampled_frames += 1
+        if time.monotonic() - self.last_save_time >= self.save_interval:
+            self._save()
+
+    # Saves the progress made when preprocessing stops before the end
+    def stop(self):
+        self._save()
+
+    def finish(self):
+        self.frames_processed = self.frames_total
+        self._save()
+
+
+# The progress of a video (a models.Video) as returned by the API, with an
+# estimate of how many seconds are left while it's being preprocessed
+def video_progress(video, now=None):
+    frames_total = video.frames_total or 0
+    frames_processed = video.frames_processed or 0
+    percent = 0.0
+    if frames_total > 0:
+        percent = round(100 * frames_processed / frames_total, 2)
+
+    eta_seconds = None
+    rate = video.processing_rate
+    if video.preprocessing_status == "in_progress" and rate:
+        eta_seconds = (frames_total - frames_processed) / rate
+        # Progress is only saved every so often, count the time since then
+        if video.progress_updated_at is not None:
+            if now is None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+            eta_seconds -= (now - video.progress_updated_at).total_seconds()
+        eta_seconds = round(max(0.0, eta_seconds), 1)
+
+    return {
+        "video_id": video.id,
+        "preprocessing_status": video.preprocessing_status,
+        "frames_processed": frames_processed,
+        "frames_total": frames_total,
+        "percent_processed": percent,
+        "frames_per_second": rate or 0.0,
+        "stage_rates": video.stage_rates or {},
+        "eta_seconds": eta_seconds,
+        "updated_at": video.progress_updated_at,
+    }
@@ -0,0 +1,188 @@
+import argparse
+import os
+import sys
+import tempfile
+
+# INT8 quantization of the feature extractor. The label classifier is
+# quantized dynamically when it's trained instead (see
+# model_training.quantize_classifier and training_executor.py).
+#
+# The feature extractor is a convolutional network, where dynamic
+# quantization (weights only) gains little, so its ONNX export is quantized
+# statically: the scales of the activations are calibrated from the crops of
+# real boxes. Calibrate once per version of the model, from a video that
+# looks like the ones the server preprocesses:
+#
+#   python quantization.py calibrate-embedder --video <path to an mp4>
+#
+# Part of the crops are held back to check the result. The quantized model is
+# only saved (for EMBEDDER_BACKEND=onnx-int8) if the features it extracts
+# from those crops are close enough to the original model's.
+
+DEFAULT_CALIBRATION_CROPS = 500
+HELD_OUT_FRACTION = 0.2
+DEFAULT_MIN_SIMILARITY = 0.98
+
+
+# Per crop cosine similarity between two (N, ...) feature tensors
+def feature_similarity(features, other_features):
+    import torch
+
+    return torch.nn.functional.cosine_similarity(
+        features.reshape(len(features), -1),
+        other_features.reshape(len(other_features), -1),
+        dim=1,
+    )
+
+
+# Crops the boxes the detector finds in the video, one frame per second as
+# preprocessing does. Returns a (N, 3, 64, 64) tensor of at most max_crops.
+def collect_crops(video_path, detector, max_crops):
+    import cv2
+    import numpy as np
+    import torch
+    import torchvision.transforms.functional as TF
+    from preprocessing import crop_box
+
+    vidcap = cv2.VideoCapture(video_path)
+    num_frames = vidcap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+
+    crops = []
+    for frame in np.arange(0, num_frames, fps):
+        vidcap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        has_frame, image = vidcap.read()
+        if not has_frame:
+            break
+        frame_tensor = TF.to_tensor(image)
+        for box in detector.detect(image).boxes:
+            crops.append(
+                crop_box(
+                    frame_tensor,
+                    int(box.xyxy[0][0]),
+                    int(box.xyxy[0][1]),
+                    int(box.xywh[0][2]),
+                    int(box.xywh[0][3]),
+                )
+            )
+            if len(crops) == max_crops:
+                return torch.cat(crops)
+
+    if len(crops) == 0:
+        raise ValueError("No boxes were detected in " + video_path)
+    return torch.cat(crops)
+
+
+# Writes a statically quantized (INT8 weights and activations) copy of the
+# ONNX feature extractor to output_path, calibrated with the given crops
+def quantize_embedder(onnx_path, output_path, calibration_crops, batch_size=16):
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class CropReader(CalibrationDataReader):
+        def __init__(self):
+            self.start = 0
+
+        def get_next(self):
+            if self.start >= len(calibration_crops):
+                return None
+            batch = calibration_crops[self.start : self.start + batch_size]
+            self.start += batch_size
+            return {"crops": batch.numpy()}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Folds constants and infers shapes, which quantization relies on
+        prepared_path = os.path.join(work_dir, "prepared.onnx")
+        quant_pre_process(onnx_path, prepared_path)
+        quantize_static(
+            prepared_path,
+            output_path,
+            CropReader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+
+
+def calibrate_embedder(video_path, max_crops, min_similarity, threads):
+    import torch
+    import model_provider
+    from inference_backends import OnnxEmbedder, embedder_export_path
+
+    tag = model_provider.embedder_version_tag()
+    export_dir = model_provider.model_export_dir
+    reference = model_provider.build_embedder("onnx", threads)
+    onnx_path = embedder_export_path("onnx", export_dir, tag)
+    output_path = embedder_export_path("onnx-int8", export_dir, tag)
+
+    detector = model_provider.build_detector(model_provider.detector_backend, threads)
+    crops = collect_crops(video_path, detector, max_crops)
+    crops = crops[
+        torch.randperm(len(crops), generator=torch.Generator().manual_seed(0))
+    ]
+    held_out_count = max(1, int(len(crops) * HELD_OUT_FRACTION))
+    held_out, calibration = crops[:held_out_count], crops[held_out_count:]
+    if len(calibration) == 0:
+        calibration = held_out
+    print(f"Calibrating with {len(calibration)} crops, checking on {len(held_out)}")
+
+    fd, temp_path = tempfile.mkstemp(dir=export_dir, prefix=".", suffix=".onnx")
+    os.close(fd)
+    try:
+        quantize_embedder(onnx_path, temp_path, calibration)
+        quantized = OnnxEmbedder(temp_path, threads)
+        similarity = feature_similarity(
+            reference.embed(held_out), quantized.embed(held_out)
+        )
+        print(
+            f"Cosine similarity to the original features: mean "
+            f"{similarity.mean():.4f}, min {similarity.min():.4f}"
+        )
+        if similarity.mean() < min_similarity:
+            print(
+                f"Mean similarity is below {min_similarity}, "
+                "not saving the quantized model"
+            )
+            return False
+        os.replace(temp_path, output_path)
+        print("Saved " + output_path)
+        return True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser(
+        "calibrate-embedder",
+        help="quantize the feature extractor, calibrated on a video's boxes",
+    )
+    calibrate_parser.add_argument("--video", required=True)
+    calibrate_parser.add_argument(
+        "--crops", type=int, default=DEFAULT_CALIBRATION_CROPS
+    )
+    calibrate_parser.add_argument(
+        "--min-similarity", type=float, default=DEFAULT_MIN_SIMILARITY
+    )
+    calibrate_parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "calibrate-embedder":
+        saved = calibrate_embedder(
+            args.video, args.crops, args.min_similarity, args.threads
+        )
+        sys.exit(0 if saved else 1)
+
+
+if __name__ == "__main__":
+    main()
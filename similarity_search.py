@@ -0,0 +1,219 @@
+import threading
+import numpy as np
+
+# Approximate nearest-neighbor search over bounding box embeddings.
+#
+# Each box carries a flattened EfficientNet feature vector (5120 floats for
+# the 64x64 crops we extract). Rather than keeping those around in full, every
+# vector is pushed through a fixed Gaussian random projection down to
+# PROJECTION_DIM dimensions and L2-normalized. Random projections roughly
+# preserve cosine similarity (Johnson-Lindenstrauss), so a dot product against
+# the projected matrix gives approximate neighbors at a fraction of the memory.
+
+PROJECTION_DIM = 256
+INITIAL_CAPACITY = 1024
+
+# Processes that insert boxes without access to the API server's indexes
+# (worker.py) NOTIFY this channel with the project's ID once they're done
+INDEX_INVALIDATION_CHANNEL = "box_index_invalidation"
+
+
+class BoxIndex:
+    def __init__(self, projection_dim=PROJECTION_DIM, seed=0):
+        self.projection_dim = projection_dim
+        self.seed = seed
+        self.projection = None
+        self.vectors = np.zeros((INITIAL_CAPACITY, projection_dim), dtype=np.float32)
+        self.box_ids = []
+        self.id2row = {}
+        self.num_deleted = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def __len__(self):
+        return len(self.id2row)
+
+    def _project(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+
+        # The projection matrix is created on first use since the input
+        # dimension depends on the feature extraction model
+        if self.projection is None:
+            rng = np.random.default_rng(self.seed)
+            self.projection = rng.standard_normal(
+                (vectors.shape[1], self.projection_dim)
+            ).astype(np.float32) / np.sqrt(self.projection_dim)
+
+        projected = vectors @ self.projection
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return projected / norms
+
+    def _grow(self, needed):
+        capacity = self.vectors.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        grown = np.zeros((capacity, self.projection_dim), dtype=np.float32)
+        grown[: len(self.box_ids)] = self.vectors[: len(self.box_ids)]
+        self.vectors = grown
+
+    def _compact(self):
+        # Drop the rows of deleted boxes once they make up half of the index
+        keep = [row for row, box_id in enumerate(self.box_ids) if box_id is not None]
+        self.vectors[: len(keep)] = self.vectors[keep]
+        self.vectors[len(keep) :] = 0
+        self.box_ids = [self.box_ids[row] for row in keep]
+        self.id2row = {box_id: row for row, box_id in enumerate(self.box_ids)}
+        self.num_deleted = 0
+
+    # box_ids = list of bounding box UUIDs
+    # vectors = matching list (or 2D array) of flat feature vectors
+    def add(self, box_ids, vectors):
+        if len(box_ids) == 0:
+            return
+
+        with self.lock:
+            projected = self._project(vectors)
+
+            # Skip boxes that are already indexed, which can happen when
+            # preprocessing inserts boxes while the index is being built
+            new_rows = [
+                i for i, box_id in enumerate(box_ids) if box_id not in self.id2row
+            ]
+            if len(new_rows) == 0:
+                return
+
+            start = len(self.box_ids)
+            self._grow(start + len(new_rows))
+            self.vectors[start : start + len(new_rows)] = projected[new_rows]
+            for offset, i in enumerate(new_rows):
+                self.box_ids.append(box_ids[i])
+                self.id2row[box_ids[i]] = start + offset
+
+    def remove(self, box_id):
+        with self.lock:
+            row = self.id2row.pop(box_id, None)
+            if row is None:
+                return
+            self.box_ids[row] = None
+            self.vectors[row] = 0
+            self.num_deleted += 1
+            if self.num_deleted > len(self.box_ids) // 2:
+                self._compact()
+
+    # Returns up to k (box_id, cosine similarity) pairs, most similar first
+    def query_by_id(self, box_id, k=10):
+        with self.lock:
+            row = self.id2row.get(box_id)
+            if row is None:
+                return []
+            query = self.vectors[row].copy()
+        return self._query(query, k, exclude=box_id)
+
+    def query_by_vector(self, vector, k=10):
+        with self.lock:
+            query = self._project(vector)[0]
+        return self._query(query, k)
+
+    def _query(self, query, k, exclude=None):
+        with self.lock:
+            size = len(self.box_ids)
+            if size == 0 or k < 1:
+                return []
+            scores = self.vectors[:size] @ query
+
+            # Ask for a few extra candidates to make up for the excluded
+            # box and any deleted rows (which score 0)
+            candidates = min(size, k + 1 + self.num_deleted)
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for row in top:
+                box_id = self.box_ids[row]
+                if box_id is None or box_id == exclude:
+                    continue
+                results.append((box_id, float(scores[row])))
+                if len(results) == k:
+                    break
+            return results
+
+
+# Keeps one BoxIndex per project. Indexes are built lazily from the database
+# the first time a project is queried and then kept up to date as
+# preprocessing inserts new boxes.
+class BoxIndexRegistry:
+    def __init__(self):
+        self.indexes = {}
+        self.build_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, project_id):
+        with self.lock:
+            return self.indexes.get(str(project_id))
+
+    # load_rows = callable returning an iterable of (box_id, vector) pairs
+    def get_or_build(self, project_id, load_rows, batch_size=1000):
+        key = str(project_id)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None and index.ready.is_set():
+                return index
+            build_lock = self.build_locks.setdefault(key, threading.Lock())
+
+        # Anyone else querying the project waits here until the build is done
+        with build_lock:
+            with self.lock:
+                index = self.indexes.get(key)
+            if index is not None and index.ready.is_set():
+                return index
+
+            # Register the (still empty) index before loading so that boxes
+            # inserted during the build are added to it as well
+            index = BoxIndex()
+            with self.lock:
+                self.indexes[key] = index
+
+            try:
+                box_ids = []
+                vectors = []
+                for box_id, vector in load_rows():
+                    box_ids.append(box_id)
+                    vectors.append(vector)
+                    if len(box_ids) == batch_size:
+                        index.add(box_ids, vectors)
+                        box_ids = []
+                        vectors = []
+                index.add(box_ids, vectors)
+            except Exception:
+                with self.lock:
+                    self.indexes.pop(key, None)
+                raise
+
+            index.ready.set()
+            return index
+
+    # Only adds to indexes that have already been built, a project that
+    # has not been queried yet will load these boxes when it is built
+    def add(self, project_id, box_ids, vectors):
+        index = self.get(project_id)
+        if index is not None:
+            index.add(box_ids, vectors)
+
+    def remove(self, project_id, box_id):
+        index = self.get(project_id)
+        if index is not None:
+            index.remove(box_id)
+
+    # Forget a project's index so that the next query builds it again
+    def drop(self, project_id):
+        with self.lock:
+            self.indexes.pop(str(project_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
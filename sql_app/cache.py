@@ -0,0 +1,225 @@
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+# In-process LRU cache for the JSON bodies of read endpoints that are called
+# far more often than the data behind them changes.
+#
+# Cached responses belong to a project. Writes made through crud.py
+# invalidate the project's responses right after they commit, and also send
+# a NOTIFY on INVALIDATION_CHANNEL inside the same transaction. Every uvicorn
+# worker runs a listener thread that invalidates its own cache when one of
+# those notifications arrives, which keeps several workers coherent. Jobs
+# that commit very often batch their notifications (see InvalidationBatch).
+#
+# Each project has a generation counter that invalidation bumps. A response
+# is only stored if the generation didn't change while it was being built,
+# so a read that raced with a write never caches stale data.
+
+INVALIDATION_CHANNEL = "response_cache_invalidation"
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse:
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+
+
+# kind = which response it is, such as "labels"
+# version = tuple of integers that changes whenever the data behind the
+#           response does (see the versions in crud.py)
+# Weak because the same data could be serialized with different bytes
+def make_etag(kind, version):
+    return 'W/"' + kind + "-" + "-".join(str(value) for value in version) + '"'
+
+
+def _opaque_tag(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+# Whether an If-None-Match header value matches the given ETag. Uses weak
+# comparison, so the W/ prefix is ignored on both sides.
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    if "*" in candidates:
+        return True
+    return _opaque_tag(etag) in [_opaque_tag(candidate) for candidate in candidates]
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.keys_by_project = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    # Read before building a response and pass it back to put
+    def generation(self, project_id):
+        with self.lock:
+            return self.generations.get(str(project_id), 0)
+
+    # body = the serialized response
+    # etag = the make_etag of the version read before building the response
+    # Returns the entry, which is only cached if project_id wasn't
+    # invalidated since generation was read
+    def put(self, key, project_id, generation, body, etag):
+        project_id = str(project_id)
+        entry = CachedResponse(body, etag)
+        with self.lock:
+            if self.generations.get(project_id, 0) != generation:
+                return entry
+
+            self.entries[key] = (entry, project_id)
+            self.entries.move_to_end(key)
+            self.keys_by_project.setdefault(project_id, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                evicted_key, (_, evicted_project_id) = self.entries.popitem(last=False)
+                self.keys_by_project[evicted_project_id].discard(evicted_key)
+        return entry
+
+    def invalidate(self, project_ids):
+        with self.lock:
+            for project_id in project_ids:
+                project_id = str(project_id)
+                self.generations[project_id] = self.generations.get(project_id, 0) + 1
+                for key in self.keys_by_project.pop(project_id, set()):
+                    self.entries.pop(key, None)
+
+    # Used when notifications may have been missed
+    def clear(self):
+        with self.lock:
+            for project_id in list(self.generations.keys()):
+                self.generations[project_id] += 1
+            self.entries.clear()
+            self.keys_by_project.clear()
+
+
+response_cache = ResponseCache(int(os.getenv("RESPONSE_CACHE_SIZE", "1024")))
+
+
+# Sends a notification for each payload as part of the session's
+# transaction, they're only delivered if the transaction commits
+def notify(db, channel, payloads):
+    for payload in payloads:
+        db.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": channel, "payload": str(payload)},
+        )
+
+
+# Call right before committing a write to the given projects
+def notify_invalidation(db, project_ids):
+    notify(db, INVALIDATION_CHANNEL, project_ids)
+
+
+# Collects the projects written to by a long job that commits often (such as
+# preprocessing, which commits every frame) so that other workers are
+# notified about each project at most once every interval seconds rather
+# than on every commit
+class InvalidationBatch:
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = set()
+        self.last_sent = None
+
+    # Returns the projects to notify about with this commit, if it's time to
+    def add(self, project_ids):
+        self.pending.update(str(project_id) for project_id in project_ids)
+        now = time.monotonic()
+        if self.last_sent is not None and now - self.last_sent < self.interval:
+            return set()
+        self.last_sent = now
+        return self.drain()
+
+    # Returns the projects not notified about yet
+    def drain(self):
+        pending, self.pending = self.pending, set()
+        return pending
+
+
+# handlers = optional dict of other channels to listen on, each mapped to a
+# callable that is given the set of payloads received, or None when
+# notifications may have been missed
+class InvalidationListener:
+    def __init__(self, engine, cache=response_cache, poll_interval=5, handlers=None):
+        self.engine = engine
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.handlers = handlers or {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="response-cache-listener", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Response cache listener lost its connection")
+                self.stop_event.wait(self.poll_interval)
+
+    def _listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            driver_connection = connection.driver_connection
+            driver_connection.autocommit = True
+            with driver_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                for channel in self.handlers:
+                    cursor.execute(f"LISTEN {channel}")
+
+            # Anything could have changed while there was no listener
+            self.cache.clear()
+            for handler in self.handlers.values():
+                handler(None)
+
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select(
+                    [driver_connection], [], [], self.poll_interval
+                )
+                if len(readable) == 0:
+                    continue
+                driver_connection.poll()
+                payloads = {}
+                while len(driver_connection.notifies) > 0:
+                    notification = driver_connection.notifies.pop(0)
+                    payloads.setdefault(notification.channel, set()).add(
+                        notification.payload
+                    )
+                self.cache.invalidate(payloads.pop(INVALIDATION_CHANNEL, set()))
+                for channel, channel_payloads in payloads.items():
+                    if channel in self.handlers:
+                        self.handlers[channel](channel_payloads)
+        finally:
+            # The connection was put in autocommit mode and is listening, so
+            # don't hand it back to the pool
+            connection.invalidate()
+            connection.close()
@@ -0,0 +1,152 @@
+from sqlalchemy import text
+
+# Change tracking for frames, bounding boxes and labels.
+#
+# Every row in those tables carries a revision number taken from one shared,
+# monotonically increasing sequence. A row gets a new revision whenever it is
+# inserted or actually changed (see the trigger below), and deleting a row
+# leaves a tombstone in deleted_rows with a revision of its own.
+#
+# Revisions are handed out when rows are written, but transactions commit in
+# any order, so a revision can become visible after larger ones already
+# have been. Rows therefore also record the ID of the transaction that last
+# wrote them (changed_xid), and clients sync by transaction instead: a sync
+# only returns rows written by transactions older than every transaction
+# still running (the xmin of the database's snapshot), which can't change
+# anymore, and hands back that xmin as the watermark to pass next time.
+# Revisions only order the rows within a sync.
+#
+# The statements are kept here so that both create_all (through DDL events in
+# models.py) and the migration for existing databases can run them.
+
+REVISION_SEQUENCE = "change_revision_seq"
+TRACKED_TABLES = ["frames", "bounding_boxes", "labels"]
+
+# Rows given a revision at a time when adding change tracking to an existing
+# database, each batch in a transaction of its own
+BACKFILL_BATCH_SIZE = 10000
+
+BUMP_REVISION_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION bump_revision() RETURNS trigger AS $$
+BEGIN
+    -- Updates that don't change anything keep their revision
+    IF ROW(NEW.*) IS DISTINCT FROM ROW(OLD.*) THEN
+        NEW.revision := nextval('{REVISION_SEQUENCE}');
+        NEW.changed_xid := pg_current_xact_id();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+RECORD_DELETION_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_deletion() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'frames' THEN
+        INSERT INTO deleted_rows (table_name, row_id, video_id, project_id)
+        VALUES (TG_TABLE_NAME, OLD.id, OLD.video_id, OLD.project_id);
+    ELSIF TG_TABLE_NAME = 'bounding_boxes' THEN
+        INSERT INTO deleted_rows (table_name, row_id, video_id, project_id)
+        SELECT TG_TABLE_NAME, OLD.id, frames.video_id, frames.project_id
+        FROM frames WHERE frames.id = OLD.frame_id;
+    ELSE
+        INSERT INTO deleted_rows (table_name, row_id, video_id, project_id)
+        VALUES (TG_TABLE_NAME, OLD.id, NULL, OLD.project_id);
+    END IF;
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def trigger_statements(table_name):
+    return [
+        f"DROP TRIGGER IF EXISTS {table_name}_bump_revision ON {table_name}",
+        f"CREATE TRIGGER {table_name}_bump_revision BEFORE UPDATE ON {table_name} "
+        "FOR EACH ROW EXECUTE PROCEDURE bump_revision()",
+        f"DROP TRIGGER IF EXISTS {table_name}_record_deletion ON {table_name}",
+        f"CREATE TRIGGER {table_name}_record_deletion AFTER DELETE ON {table_name} "
+        "FOR EACH ROW EXECUTE PROCEDURE record_deletion()",
+    ]
+
+
+# Gives the table's existing rows a revision in batches, so that rows are
+# only locked a batch at a time instead of the whole table at once
+def backfill_revisions(table_name, batch_size=BACKFILL_BATCH_SIZE):
+    def backfill(connection):
+        # Walks the table in ID order so that each batch starts where the
+        # last one stopped rather than scanning the rows done already
+        parameters = {"batch_size": batch_size}
+        after_last = ""
+        while True:
+            updated_ids = connection.execute(
+                text(
+                    f"UPDATE {table_name} "
+                    f"SET revision = nextval('{REVISION_SEQUENCE}'), "
+                    "changed_xid = pg_current_xact_id() "
+                    f"WHERE id IN (SELECT id FROM {table_name} "
+                    f"WHERE revision IS NULL {after_last}"
+                    "ORDER BY id LIMIT :batch_size) RETURNING id"
+                ),
+                parameters,
+            ).scalars()
+            updated_ids = list(updated_ids)
+            if len(updated_ids) < batch_size:
+                return
+            parameters["last_id"] = max(updated_ids)
+            after_last = "AND id > :last_id "
+
+    return backfill
+
+
+# Statements that bring a database created before change tracking existed up
+# to date, they are all safe to run more than once. Callables are run with
+# the migration's connection (see migrations.py).
+#
+# The columns are added without a default first: a volatile default like
+# nextval() would make ADD COLUMN rewrite the whole table while holding an
+# ACCESS EXCLUSIVE lock on it. Setting the default afterwards only applies to
+# new rows, so it's set before the backfill to leave no row without one.
+def migration_statements():
+    statements = [f"CREATE SEQUENCE IF NOT EXISTS {REVISION_SEQUENCE}"]
+    for table_name in TRACKED_TABLES:
+        statements.extend(
+            [
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS revision BIGINT",
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS changed_xid XID8",
+                f"ALTER TABLE {table_name} ALTER COLUMN revision "
+                f"SET DEFAULT nextval('{REVISION_SEQUENCE}')",
+                f"ALTER TABLE {table_name} ALTER COLUMN changed_xid "
+                "SET DEFAULT pg_current_xact_id()",
+                backfill_revisions(table_name),
+            ]
+        )
+    statements.append(
+        "CREATE TABLE IF NOT EXISTS deleted_rows ("
+        f"revision BIGINT PRIMARY KEY DEFAULT nextval('{REVISION_SEQUENCE}'), "
+        "changed_xid XID8 DEFAULT pg_current_xact_id(), "
+        "table_name VARCHAR, row_id UUID, video_id UUID, project_id UUID)"
+    )
+    for table_name in TRACKED_TABLES:
+        statements.append(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table_name}_revision "
+            f"ON {table_name} (revision)"
+        )
+        statements.append(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table_name}_changed_xid "
+            f"ON {table_name} (changed_xid)"
+        )
+    statements.append(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_deleted_rows_video_id_changed_xid "
+        "ON deleted_rows (video_id, changed_xid)"
+    )
+    statements.append(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+        "ix_deleted_rows_project_id_changed_xid "
+        "ON deleted_rows (project_id, changed_xid)"
+    )
+    statements.append(BUMP_REVISION_FUNCTION)
+    statements.append(RECORD_DELETION_FUNCTION)
+    for table_name in TRACKED_TABLES:
+        statements.extend(trigger_statements(table_name))
+    return statements
@@ -1,13 +1,98 @@
-from typing import List
+from typing import Dict, List
 from sqlalchemy.orm import Session, aliased
-from sqlalchemy import Uuid, String, update, func, delete
-
-from . import models, schemas
+from sqlalchemy import (
+    Uuid,
+    String,
+    BigInteger,
+    update,
+    func,
+    delete,
+    select,
+    insert,
+    values,
+    column,
+    cast,
+    literal,
+    true,
+)
+
+from . import models, schemas, cache
 
 import datetime
+import io
+from contextlib import contextmanager
 
 # Define functions for executing CRUD operations on the database
 
+# Batches of at least this many rows are updated through a temporary table
+# (see bulk_update_rows) rather than with one UPDATE statement per row
+BULK_UPDATE_THRESHOLD = 500
+
+###############################################################
+# response cache invalidation
+###############################################################
+
+
+# Commits the session and invalidates the cached responses (see cache.py)
+# of the given projects, in this worker right after the commit and in other
+# workers through a NOTIFY sent as part of the transaction (or a later one,
+# see batched_invalidation)
+def _commit_and_invalidate(db: Session, project_ids):
+    project_ids = set(project_ids)
+    batch = db.info.get("invalidation_batch")
+    if batch is None:
+        cache.notify_invalidation(db, project_ids)
+    else:
+        cache.notify_invalidation(db, batch.add(project_ids))
+    db.commit()
+    cache.response_cache.invalidate(project_ids)
+
+
+# Within this, writes through the session only NOTIFY other workers about a
+# project once every interval seconds, along with whichever commit is next.
+# Projects still left are notified about on the way out.
+@contextmanager
+def batched_invalidation(db: Session, interval: float):
+    batch = cache.InvalidationBatch(interval)
+    db.info["invalidation_batch"] = batch
+    try:
+        yield
+    except Exception:
+        # The notifications go out in a transaction of their own
+        db.rollback()
+        raise
+    finally:
+        del db.info["invalidation_batch"]
+        pending = batch.drain()
+        if len(pending) > 0:
+            cache.notify_invalidation(db, pending)
+            db.commit()
+
+
+def _project_ids_of_frames(db: Session, frame_ids):
+    return (
+        db.execute(
+            select(models.Frame.project_id)
+            .where(models.Frame.id.in_(set(frame_ids)))
+            .distinct()
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _project_ids_of_labels(db: Session, label_ids):
+    return (
+        db.execute(
+            select(models.Label.project_id)
+            .where(models.Label.id.in_(set(label_ids)))
+            .distinct()
+        )
+        .scalars()
+        .all()
+    )
+
+
 ###############################################################
 # projects table
 ###############################################################
@@ -34,6 +119,19 @@ def get_project_by_id(db: Session, project_id: Uuid):
     return db.query(models.Project).filter(models.Project.id == project_id).first()
 
 
+# PUT /projects/{project_id}/sampling
+def set_project_sampling(
+    db: Session, project_id: Uuid, settings: schemas.SamplingSettings
+):
+    stmt = (
+        update(models.Project)
+        .where(models.Project.id == project_id)
+        .values(**settings.dict())
+    )
+    db.execute(stmt)
+    db.commit()
+
+
 def get_project_by_name(db: Session, project_name: Uuid):
     return db.query(models.Project).filter(models.Project.name == project_name).first()
 
@@ -86,38 +184,191 @@ def set_video_preprocessing_status(db: Session, video_id: Uuid, status: String):
     db.commit()
 
 
+def set_video_progress(
+    db: Session,
+    video_id: Uuid,
+    frames_processed: int,
+    frames_total: int,
+    processing_rate: float,
+    stage_rates: Dict[str, float],
+):
+    stmt = (
+        update(models.Video)
+        .where(models.Video.id == video_id)
+        .values(
+            frames_processed=frames_processed,
+            frames_total=frames_total,
+            processing_rate=processing_rate,
+            stage_rates=stage_rates,
+            progress_updated_at=func.now(),
+        )
+    )
+    db.execute(stmt)
+    db.commit()
+
+
+# Read straight from the database rather than from a Video already loaded
+# into the session, so that changes made by other sessions are seen
+def get_video_preprocessing_status(db: Session, video_id: Uuid):
+    return db.execute(
+        select(models.Video.preprocessing_status).where(models.Video.id == video_id)
+    ).scalar()
+
+
+def count_queued_videos(db: Session):
+    return db.execute(
+        select(func.count(models.Video.id)).where(
+            models.Video.preprocessing_status == "queued"
+        )
+    ).scalar()
+
+
+# Marks a queued video as in progress. Returns False if it's no longer queued
+# (it was cancelled, or is already being preprocessed).
+def start_queued_video(db: Session, video_id: Uuid):
+    stmt = (
+        update(models.Video)
+        .where(models.Video.id == video_id)
+        .where(models.Video.preprocessing_status == "queued")
+        .values(preprocessing_status="in_progress")
+        .returning(models.Video.id)
+    )
+    started = db.execute(stmt).scalar() is not None
+    db.commit()
+    return started
+
+
+# Marks a queued or in progress video as cancelled, which preprocessing
+# checks for between frames. Returns False if it wasn't queued or in progress.
+def cancel_video_preprocessing(db: Session, video_id: Uuid):
+    stmt = (
+        update(models.Video)
+        .where(models.Video.id == video_id)
+        .where(models.Video.preprocessing_status.in_(["queued", "in_progress"]))
+        .values(preprocessing_status="cancelled")
+        .returning(models.Video.id)
+    )
+    cancelled = db.execute(stmt).scalar() is not None
+    db.commit()
+    return cancelled
+
+
+# Marks the oldest queued video as in progress and returns it, or None if no
+# video is queued. SKIP LOCKED lets several workers claim videos at the same
+# time without two of them ever getting the same one.
+#
+# With stale_after (in seconds) set, a video a worker claimed earlier is
+# claimed again once neither the claim nor its progress has been updated for
+# that long, which means the worker died while preprocessing it.
+def claim_queued_video(db: Session, stale_after: float = None):
+    claimable = models.Video.preprocessing_status == "queued"
+    if stale_after is not None:
+        last_heard_from = func.greatest(
+            models.Video.claimed_at, models.Video.progress_updated_at
+        )
+        claimable = claimable | (
+            (models.Video.preprocessing_status == "in_progress")
+            & models.Video.claimed_at.is_not(None)
+            & (last_heard_from < func.now() - datetime.timedelta(seconds=stale_after))
+        )
+    queued_video_id = (
+        select(models.Video.id)
+        .where(claimable)
+        .order_by(models.Video.date_uploaded)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(models.Video)
+        .where(models.Video.id == queued_video_id)
+        .values(preprocessing_status="in_progress", claimed_at=func.now())
+        .returning(models.Video.id)
+    )
+    video_id = db.execute(stmt).scalar()
+    db.commit()
+
+    if video_id is None:
+        return None
+    return get_video_by_id(db, video_id)
+
+
 ###############################################################
 # frames table
 ###############################################################
 
 
-def insert_one_frame(db: Session, frame: schemas.FrameCreate):
-    db_frame = models.Frame(
+def _frame_model(frame: schemas.FrameCreate, **columns):
+    return models.Frame(
         width=frame.width,
         height=frame.height,
         frame_url=frame.frame_url,
         project_id=frame.project_id,
         video_id=frame.video_id,
+        frame_number=frame.frame_number,
+        timestamp=frame.timestamp,
+        **columns,
     )
+
+
+def insert_one_frame(db: Session, frame: schemas.FrameCreate):
+    db_frame = _frame_model(frame)
     db.add(db_frame)
-    db.commit()
+    _commit_and_invalidate(db, [frame.project_id])
     db.refresh(db_frame)
     return db_frame
 
 
-def insert_frames(db: Session, frames: List[schemas.FrameCreate]):
-    db_frames = [
-        models.Frame(
-            width=frame.width,
-            height=frame.height,
-            frame_url=frame.frame_url,
-            project_id=frame.project_id,
-            video_id=frame.video_id,
+# Each of these inserts a preprocessed frame along with its boxes and its
+# perceptual hash in a single transaction, so that a frame with a hash always
+# has its boxes to copy (see frame_hashing.py). The caller picks frame_id so
+# that the boxes can refer to the frame before it's inserted.
+
+
+# Returns the IDs of the new boxes
+def insert_frame_with_boxes(
+    db: Session,
+    frame: schemas.FrameCreate,
+    frame_id: Uuid,
+    perceptual_hash: int,
+    boxes: List[schemas.BoundingBoxCreate],
+):
+    db.add(_frame_model(frame, id=frame_id, perceptual_hash=perceptual_hash))
+    db.flush()
+    box_ids = _add_boxes(db, boxes)
+    _commit_and_invalidate(db, [frame.project_id])
+    return box_ids
+
+
+# Gives the frame copies of every box of source_frame_id, see
+# copy_boxes_as_predictions. Returns the IDs and image features of the copies.
+def insert_frame_with_copied_boxes(
+    db: Session,
+    frame: schemas.FrameCreate,
+    frame_id: Uuid,
+    perceptual_hash: int,
+    source_frame_id: Uuid,
+):
+    db.add(_frame_model(frame, id=frame_id, perceptual_hash=perceptual_hash))
+    db.flush()
+    rows = db.execute(copy_boxes_as_predictions(source_frame_id, frame_id)).all()
+    _commit_and_invalidate(db, [frame.project_id])
+    return rows
+
+
+def get_frame_hashes_by_project_id(db: Session, project_id: Uuid):
+    return db.execute(
+        select(models.Frame.id, models.Frame.perceptual_hash).where(
+            models.Frame.project_id == project_id,
+            models.Frame.perceptual_hash.is_not(None),
         )
-        for frame in frames
-    ]
+    ).all()
+
+
+def insert_frames(db: Session, frames: List[schemas.FrameCreate]):
+    db_frames = [_frame_model(frame) for frame in frames]
     db.add_all(db_frames)
-    db.commit()
+    _commit_and_invalidate(db, [frame.project_id for frame in frames])
 
 
 def get_frames_by_video_id(db: Session, video_id: Uuid):
@@ -128,16 +379,59 @@ def get_frames_by_project_id(db: Session, project_id: Uuid):
     return db.query(models.Frame).filter(models.Frame.project_id == project_id).all()
 
 
+def get_project_frames_for_export(db: Session, project_id: Uuid):
+    return (
+        db.query(
+            models.Frame.id.label("frame_id"),
+            models.Frame.frame_url,
+            models.Frame.width.label("frame_width"),
+            models.Frame.height.label("frame_height"),
+        )
+        .filter(models.Frame.project_id == project_id)
+        .order_by(models.Frame.id)
+        .yield_per(5000)
+    )
+
+
+def get_project_boxes_for_export(db: Session, project_id: Uuid):
+    # One streamed query for every frame in the project joined with its
+    # boxes (if any), ordered so that each frame's boxes are next to each other
+    return (
+        db.query(
+            models.Frame.id.label("frame_id"),
+            models.Frame.frame_url,
+            models.Frame.width.label("frame_width"),
+            models.Frame.height.label("frame_height"),
+            models.BoundingBox.id.label("box_id"),
+            models.BoundingBox.label_id,
+            models.BoundingBox.x_top_left,
+            models.BoundingBox.y_top_left,
+            models.BoundingBox.x_bottom_right,
+            models.BoundingBox.y_bottom_right,
+            models.BoundingBox.width,
+            models.BoundingBox.height,
+        )
+        .outerjoin(models.BoundingBox, models.BoundingBox.frame_id == models.Frame.id)
+        .filter(models.Frame.project_id == project_id)
+        .order_by(models.Frame.id, models.BoundingBox.id)
+        .yield_per(5000)
+    )
+
+
 def get_frame_by_id(db: Session, frame_id: Uuid):
     return db.query(models.Frame).filter(models.Frame.id == frame_id).first()
 
 
 def update_frames(db: Session, updated_frames: List[schemas.Frame]):
-    result = db.execute(
-        update(models.Frame), [frame.dict() for frame in updated_frames]
-    )
-    db.commit()
-    return result
+    # Where a frame is in its video never changes
+    rows = [
+        frame.dict(exclude={"frame_number", "timestamp"}) for frame in updated_frames
+    ]
+    if len(rows) >= BULK_UPDATE_THRESHOLD:
+        bulk_update_rows(db, models.Frame, rows)
+    else:
+        db.execute(update(models.Frame), rows)
+    _commit_and_invalidate(db, [frame.project_id for frame in updated_frames])
 
 
 ###############################################################
@@ -145,7 +439,8 @@ def update_frames(db: Session, updated_frames: List[schemas.Frame]):
 ###############################################################
 
 
-def insert_boxes(db: Session, boxes: List[schemas.BoundingBoxCreate]):
+# Adds the boxes to the session's transaction and returns their IDs
+def _add_boxes(db: Session, boxes: List[schemas.BoundingBoxCreate]):
     db_boxes = [
         models.BoundingBox(
             x_top_left=box.x_top_left,
@@ -158,11 +453,53 @@ def insert_boxes(db: Session, boxes: List[schemas.BoundingBoxCreate]):
             label_id=box.label_id,
             image_features=box.image_features,
             prediction=box.prediction,
+            model_version=box.model_version,
         )
         for box in boxes
     ]
     db.add_all(db_boxes)
-    db.commit()
+
+    # Flushing fetches the generated UUIDs so that callers can refer to
+    # the new boxes without querying for them again
+    db.flush()
+    return [db_box.id for db_box in db_boxes]
+
+
+def insert_boxes(db: Session, boxes: List[schemas.BoundingBoxCreate]):
+    box_ids = _add_boxes(db, boxes)
+    _commit_and_invalidate(
+        db, _project_ids_of_frames(db, [box.frame_id for box in boxes])
+    )
+    return box_ids
+
+
+# Statement that copies every box of a frame onto another frame of the same
+# project, features and all, in a single INSERT ... SELECT. The copies are
+# predictions even where the source box was reviewed, since nobody has
+# reviewed them on the new frame. Returns the IDs and image features of the
+# new boxes.
+def copy_boxes_as_predictions(source_frame_id: Uuid, frame_id: Uuid):
+    copied_columns = [
+        "x_top_left",
+        "y_top_left",
+        "x_bottom_right",
+        "y_bottom_right",
+        "width",
+        "height",
+        "label_id",
+        "image_features",
+        "model_version",
+    ]
+    source_boxes = select(
+        *[getattr(models.BoundingBox, name) for name in copied_columns],
+        literal(frame_id, Uuid).label("frame_id"),
+        literal(True).label("prediction"),
+    ).where(models.BoundingBox.frame_id == source_frame_id)
+    return (
+        insert(models.BoundingBox)
+        .from_select(copied_columns + ["frame_id", "prediction"], source_boxes)
+        .returning(models.BoundingBox.id, models.BoundingBox.image_features)
+    )
 
 
 def get_boxes_by_frame_id(db: Session, frame_id: Uuid):
@@ -174,35 +511,146 @@ def get_boxes_by_frame_id(db: Session, frame_id: Uuid):
 
 
 def update_boxes(db: Session, updated_boxes: List[schemas.BoundingBox]):
-    result = db.execute(
-        update(models.BoundingBox), [box.dict() for box in updated_boxes]
+    rows = [box.dict() for box in updated_boxes]
+    if len(rows) >= BULK_UPDATE_THRESHOLD:
+        bulk_update_rows(db, models.BoundingBox, rows)
+    else:
+        db.execute(update(models.BoundingBox), rows)
+    _commit_and_invalidate(
+        db, _project_ids_of_frames(db, [box.frame_id for box in updated_boxes])
     )
-    db.commit()
-    return result
 
 
-def get_box_vectors_and_labels_by_video_id(db: Session, video_id: Uuid):
-    b = aliased(models.BoundingBox)
-    f = aliased(models.Frame)
-    l = aliased(models.Label)
+def get_reviewed_box_labels_by_project_id(db: Session, project_id: Uuid):
+    # Only fetches IDs and label names (not the image_features blobs) for
+    # every human-reviewed box in the project so that callers can choose
+    # which feature vectors they actually need to load
+    return (
+        db.query(models.BoundingBox.id, models.Label.name)
+        .join(models.Frame, models.Frame.id == models.BoundingBox.frame_id)
+        .join(models.Label, models.Label.id == models.BoundingBox.label_id)
+        .filter(
+            models.Frame.project_id == project_id,
+            models.BoundingBox.prediction == False,
+        )
+        .all()
+    )
 
-    # Find all bounding boxes from every frame that exists in this video
-    subquery = db.query(f.id).filter(f.video_id == video_id).subquery()
-    query = (
-        db.query(b, subquery.c.id, l.name)
-        .join(b, b.frame_id == subquery.c.id)
-        .join(l, l.id == b.label_id, isouter=True)
+
+def get_unreviewed_boxes_by_video_id(db: Session, video_id: Uuid):
+    # Streams only what label prediction needs rather than loading every
+    # feature blob at once
+    return (
+        db.query(
+            models.BoundingBox.id,
+            models.BoundingBox.label_id,
+            models.BoundingBox.image_features,
+        )
+        .join(models.Frame, models.Frame.id == models.BoundingBox.frame_id)
+        .filter(
+            models.Frame.video_id == video_id,
+            models.BoundingBox.prediction == True,
+        )
+        .yield_per(1000)
+    )
+
+
+# Counts the boxes in each of the project's videos that are still the
+# prediction of a model version other than model_version. Boxes predicted
+# before versions were recorded count as stale too.
+def get_stale_prediction_counts_by_project_id(
+    db: Session, project_id: Uuid, model_version: str
+):
+    return (
+        db.query(
+            models.Frame.video_id,
+            func.count(models.BoundingBox.id).label("stale_boxes"),
+        )
+        .join(models.Frame, models.Frame.id == models.BoundingBox.frame_id)
+        .filter(
+            models.Frame.project_id == project_id,
+            models.BoundingBox.prediction == True,
+            models.BoundingBox.model_version.is_distinct_from(model_version),
+        )
+        .group_by(models.Frame.video_id)
+        .all()
+    )
+
+
+# box_ids_by_label = mapping from a label ID to the boxes that should now have it
+def update_predicted_box_labels(
+    db: Session, box_ids_by_label: Dict[Uuid, List[Uuid]], chunk_size: int = 5000
+):
+    # Runs one set-based UPDATE ... FROM (VALUES ...) per label (split into
+    # chunks for very large batches) instead of one statement per box. Boxes
+    # that were reviewed in the meantime are left alone. The IDs are cast
+    # since psycopg2 sends them as untyped literals.
+    for label_id, box_ids in box_ids_by_label.items():
+        for start in range(0, len(box_ids), chunk_size):
+            changed_boxes = values(column("id", Uuid), name="changed_boxes").data(
+                [(box_id,) for box_id in box_ids[start : start + chunk_size]]
+            )
+            db.execute(
+                update(models.BoundingBox)
+                .where(
+                    models.BoundingBox.id == cast(changed_boxes.c.id, Uuid),
+                    models.BoundingBox.prediction == True,
+                )
+                .values(label_id=label_id)
+                .execution_options(synchronize_session=False)
+            )
+    _commit_and_invalidate(db, _project_ids_of_labels(db, box_ids_by_label.keys()))
+
+
+def get_box_features_by_ids(db: Session, box_ids: List[Uuid]):
+    return (
+        db.query(models.BoundingBox.id, models.BoundingBox.image_features)
+        .filter(models.BoundingBox.id.in_(box_ids))
+        .all()
     )
-    return query.all()
 
 
 def get_box_by_id(db: Session, box_id: Uuid):
     return db.query(models.BoundingBox).filter(models.BoundingBox.id == box_id).first()
 
 
+def get_boxes_by_ids(db: Session, box_ids: List[Uuid]):
+    return db.query(models.BoundingBox).filter(models.BoundingBox.id.in_(box_ids)).all()
+
+
+def get_box_features_by_project_id(db: Session, project_id: Uuid):
+    # Streams (box ID, image_features) pairs for every box in the project
+    # rather than loading all of the feature blobs at once
+    return (
+        db.query(models.BoundingBox.id, models.BoundingBox.image_features)
+        .join(models.Frame, models.Frame.id == models.BoundingBox.frame_id)
+        .filter(models.Frame.project_id == project_id)
+        .yield_per(1000)
+    )
+
+
+def set_label_for_boxes(db: Session, box_ids: List[Uuid], label_id: Uuid):
+    # Boxes labeled this way were chosen by a person, so they count as reviewed
+    db.execute(
+        update(models.BoundingBox)
+        .where(models.BoundingBox.id.in_(box_ids))
+        .values(label_id=label_id, prediction=False)
+    )
+    _commit_and_invalidate(db, _project_ids_of_labels(db, [label_id]))
+
+
 def delete_box_by_id(db: Session, box_id: Uuid):
+    project_ids = (
+        db.execute(
+            select(models.Frame.project_id)
+            .join(models.BoundingBox, models.BoundingBox.frame_id == models.Frame.id)
+            .where(models.BoundingBox.id == box_id)
+        )
+        .scalars()
+        .all()
+    )
     db.execute(delete(models.BoundingBox).where(models.BoundingBox.id == box_id))
-    db.commit()
+    _commit_and_invalidate(db, project_ids)
 
 
 ###############################################################
@@ -215,7 +663,7 @@ def insert_labels(db: Session, labels: List[schemas.LabelCreate]):
         models.Label(name=label.name, project_id=label.project_id) for label in labels
     ]
     db.add_all(db_labels)
-    db.commit()
+    _commit_and_invalidate(db, [label.project_id for label in labels])
 
 
 def get_label_by_name_and_project(db: Session, name: str, project_id: Uuid):
@@ -269,9 +717,246 @@ def replace_label(db: Session, label_id: Uuid, replace_id: Uuid):
         .where(models.BoundingBox.label_id == label_id)
         .values(label_id=replace_id)
     )
-    db.commit()
+    _commit_and_invalidate(db, _project_ids_of_labels(db, [label_id, replace_id]))
 
 
 def delete_label_by_id(db: Session, label_id: Uuid):
+    project_ids = _project_ids_of_labels(db, [label_id])
     db.execute(delete(models.Label).where(models.Label.id == label_id))
-    db.commit()
+    _commit_and_invalidate(db, project_ids)
+
+
+###############################################################
+# change tracking
+###############################################################
+
+
+# The transaction ID below which every transaction has finished, so that no
+# row with a smaller changed_xid can still appear or change. Has to be read
+# before the rows it's the watermark for, see change_tracking.py.
+def get_change_watermark(db: Session):
+    return db.execute(
+        select(
+            cast(
+                cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), String),
+                BigInteger,
+            )
+        )
+    ).scalar_one()
+
+
+# Rows last written by transactions in [since, watermark)
+def _changed_between(changed_xid, since: int, watermark: int):
+    return (changed_xid >= _xid8(since)) & (changed_xid < _xid8(watermark))
+
+
+# There's no cast from integers to xid8, only from text
+def _xid8(value: int):
+    return cast(literal(str(value), String), models.Xid8())
+
+
+# Each of these returns the rows last written by a transaction in [since,
+# watermark) in the order they changed, see change_tracking.py for how
+# changes are tracked
+
+
+def get_frames_changed_since(db: Session, video_id: Uuid, since: int, watermark: int):
+    return (
+        db.query(models.Frame)
+        .filter(
+            models.Frame.video_id == video_id,
+            _changed_between(models.Frame.changed_xid, since, watermark),
+        )
+        .order_by(models.Frame.revision)
+        .all()
+    )
+
+
+def get_boxes_changed_since(db: Session, video_id: Uuid, since: int, watermark: int):
+    return (
+        db.query(models.BoundingBox)
+        .join(models.Frame, models.Frame.id == models.BoundingBox.frame_id)
+        .filter(
+            models.Frame.video_id == video_id,
+            _changed_between(models.BoundingBox.changed_xid, since, watermark),
+        )
+        .order_by(models.BoundingBox.revision)
+        .all()
+    )
+
+
+def get_labels_changed_since(db: Session, project_id: Uuid, since: int, watermark: int):
+    return (
+        db.query(models.Label)
+        .filter(
+            models.Label.project_id == project_id,
+            _changed_between(models.Label.changed_xid, since, watermark),
+        )
+        .order_by(models.Label.revision)
+        .all()
+    )
+
+
+def get_deleted_rows_since(
+    db: Session, video_id: Uuid, project_id: Uuid, since: int, watermark: int
+):
+    # Deleted frames and boxes belong to the video, deleted labels only
+    # belong to the project
+    return (
+        db.query(models.DeletedRow)
+        .filter(
+            _changed_between(models.DeletedRow.changed_xid, since, watermark),
+            (models.DeletedRow.video_id == video_id)
+            | (
+                (models.DeletedRow.project_id == project_id)
+                & (models.DeletedRow.table_name == "labels")
+            ),
+        )
+        .order_by(models.DeletedRow.revision)
+        .all()
+    )
+
+
+# Versions of the cached read responses (see cache.py), which change
+# whenever a row a response is built from is inserted, updated or deleted.
+# Each is the number of rows and the sum of their revisions, plus the number
+# of tombstones: inserts and deletes change the counts, and since an update
+# gives the row a larger revision, updates grow the sum. Unlike the largest
+# revision, these also change when a transaction that took its revisions
+# earlier commits after a later one.
+
+
+def _row_version(model, *criteria):
+    return select(func.count(), func.coalesce(func.sum(model.revision), 0)).where(
+        *criteria
+    )
+
+
+def _deletion_version(*criteria):
+    return select(func.count()).select_from(models.DeletedRow).where(*criteria)
+
+
+# Runs the queries (each returning one row) in a single round trip
+def _version(db: Session, queries):
+    subqueries = [query.subquery() for query in queries]
+    joined = subqueries[0]
+    for subquery in subqueries[1:]:
+        joined = joined.join(subquery, true())
+    row = db.execute(
+        select(*[subquery.c for subquery in subqueries]).select_from(joined)
+    ).one()
+    return tuple(int(value) for value in row)
+
+
+def _label_queries(project_id: Uuid):
+    return [
+        _row_version(models.Label, models.Label.project_id == project_id),
+        _deletion_version(
+            models.DeletedRow.project_id == project_id,
+            models.DeletedRow.table_name == "labels",
+        ),
+    ]
+
+
+# GET /projects/{project_id}/labels
+def get_labels_version(db: Session, project_id: Uuid):
+    return _version(db, _label_queries(project_id))
+
+
+# GET /videos/{video_id}/frames, which also lists the names of the labels in
+# each frame
+def get_video_frames_version(db: Session, video_id: Uuid, project_id: Uuid):
+    frame_ids = select(models.Frame.id).where(models.Frame.video_id == video_id)
+    return _version(
+        db,
+        [
+            _row_version(models.Frame, models.Frame.video_id == video_id),
+            _row_version(
+                models.BoundingBox, models.BoundingBox.frame_id.in_(frame_ids)
+            ),
+            _deletion_version(models.DeletedRow.video_id == video_id),
+        ]
+        + _label_queries(project_id),
+    )
+
+
+# GET /frames/{frame_id}/inferences. Tombstones don't record the frame, so
+# deleting any box in the video changes it.
+def get_frame_boxes_version(db: Session, frame_id: Uuid, video_id: Uuid):
+    return _version(
+        db,
+        [
+            _row_version(models.BoundingBox, models.BoundingBox.frame_id == frame_id),
+            _deletion_version(
+                models.DeletedRow.video_id == video_id,
+                models.DeletedRow.table_name == "bounding_boxes",
+            ),
+        ],
+    )
+
+
+###############################################################
+# bulk updates
+###############################################################
+
+
+# rows = dicts with the "id" of each row to update plus the columns to change.
+# Rows don't all need the same columns (e.g. some may only change label_id).
+#
+# Rows that change the same set of columns are COPYed into a temporary table
+# and applied with a single UPDATE ... FROM join, so updating tens of
+# thousands of rows takes a handful of round trips instead of one per row.
+# The caller commits.
+def bulk_update_rows(db: Session, model, rows: List[dict]):
+    table = model.__table__
+
+    # Group rows by which columns they change, ignoring keys that aren't
+    # columns of the table (such as a frame's list of labels)
+    rows_by_columns = {}
+    for row in rows:
+        columns = tuple(sorted(key for key in row if key != "id" and key in table.c))
+        if len(columns) > 0:
+            rows_by_columns.setdefault(columns, []).append(row)
+
+    temp_table = "bulk_update_" + table.name
+    updated = 0
+
+    # The raw psycopg2 connection shares the session's transaction
+    dbapi_connection = db.connection().connection.dbapi_connection
+    with dbapi_connection.cursor() as cursor:
+        for columns, column_rows in rows_by_columns.items():
+            column_list = ", ".join(columns)
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {temp_table} ON COMMIT DROP AS "
+                f"SELECT id, {column_list} FROM {table.name} WITH NO DATA"
+            )
+
+            buffer = io.StringIO()
+            for row in column_rows:
+                fields = [row["id"]] + [row[c] for c in columns]
+                buffer.write(",".join(_copy_value(field) for field in fields) + "\n")
+            buffer.seek(0)
+            cursor.copy_expert(
+                f"COPY {temp_table} (id, {column_list}) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+
+            assignments = ", ".join(f"{c} = {temp_table}.{c}" for c in columns)
+            cursor.execute(
+                f"UPDATE {table.name} SET {assignments} FROM {temp_table} "
+                f"WHERE {table.name}.id = {temp_table}.id"
+            )
+            updated += cursor.rowcount
+            cursor.execute(f"DROP TABLE {temp_table}")
+
+    return updated
+
+
+# Format a value as a COPY CSV field. NULL is an unquoted empty field while
+# strings (and UUIDs) are always quoted so that empty strings stay empty.
+def _copy_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (bool, int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
@@ -3,6 +3,8 @@ from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 import os
 
+from .pool_metrics import PoolMetrics, instrumented_pool_class
+
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = ""
@@ -13,12 +15,49 @@ if os.getenv('TEST_ENVIRONMENT') == "TRUE":
 else:
     SQLALCHEMY_DATABASE_URL = os.getenv("POSTGRES_DEV_DATABASE_URL")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+# Creates an engine whose connection pool is configured through the
+# <prefix>_POOL_SIZE, <prefix>_MAX_OVERFLOW and <prefix>_POOL_TIMEOUT
+# environment variables and reports its metrics (see pool_metrics.py)
+def create_pooled_engine(name, prefix, default_size, default_overflow):
+    pool_size = int(os.getenv(prefix + '_POOL_SIZE', str(default_size)))
+    max_overflow = int(os.getenv(prefix + '_MAX_OVERFLOW', str(default_overflow)))
+    return create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        poolclass=instrumented_pool_class(PoolMetrics(name, pool_size, max_overflow)),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        # seconds to wait for a connection before giving up
+        pool_timeout=float(os.getenv(prefix + '_POOL_TIMEOUT', "30")),
+        # check connections before handing them out, long running processes
+        # otherwise get connections the database has since closed
+        pool_pre_ping=True,
+    )
+
+
+# Used by requests
+engine = create_pooled_engine("requests", "DB", 5, 10)
+
+# Background work (preprocessing videos, see main.py and worker.py) gets its
+# own pool, so that long jobs holding connections never leave requests
+# waiting for one and the other way around
+background_engine = create_pooled_engine("background", "BACKGROUND_DB", 4, 4)
 
 # each instance of SessionLocal class will be a database session
 # not the same as SQLAlchemy's Session class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# sessions for background work, which open and close their own rather than
+# borrowing the session of the request that started them
+BackgroundSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=background_engine
+)
+
+
+# The metrics of every connection pool
+def pool_metrics():
+    return [engine.pool.metrics(), background_engine.pool.metrics()]
+
+
 # inherit from this Base class to create ORM models that represent the database
 Base = declarative_base()
-
@@ -0,0 +1,152 @@
+from sqlalchemy import text, select, insert
+
+from . import models, change_tracking
+
+# Versioned schema migrations for databases that already exist.
+#
+# models.Base.metadata.create_all only creates missing tables, it never
+# changes tables that are already there. Each migration below brings an
+# existing database up to date with the models and is recorded in the
+# schema_migrations table once applied. Migrations must be safe to run on a
+# brand new database too (create_all will already have done the work there),
+# so use IF [NOT] EXISTS everywhere.
+#
+# Statements run outside of a transaction so that indexes can be built with
+# CREATE INDEX CONCURRENTLY, which doesn't block writes to tables in use. A
+# statement can also be a callable taking the connection, for work like
+# backfills that has to be split over several transactions.
+
+MIGRATIONS = [
+    (
+        1,
+        "Index the foreign keys used by the hot frame, box and label queries",
+        [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_frames_video_id ON frames (video_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_frames_project_id ON frames (project_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bounding_boxes_frame_id ON bounding_boxes (frame_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bounding_boxes_label_id ON bounding_boxes (label_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_labels_project_id_name ON labels (project_id, name)",
+        ],
+    ),
+    (
+        2,
+        "Drop the redundant unique indexes on UUID primary keys",
+        [
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_projects_id",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_videos_id",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_frames_id",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_bounding_boxes_id",
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_labels_id",
+        ],
+    ),
+    (
+        3,
+        "Track revisions of frames, bounding boxes and labels",
+        change_tracking.migration_statements(),
+    ),
+    (
+        4,
+        "Record which model versions predicted each bounding box",
+        [
+            "ALTER TABLE bounding_boxes ADD COLUMN IF NOT EXISTS model_version VARCHAR",
+        ],
+    ),
+    (
+        5,
+        "Record the preprocessing progress of videos",
+        [
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS frames_total INTEGER",
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS frames_processed INTEGER",
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS processing_rate DOUBLE PRECISION",
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS stage_rates JSON",
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS progress_updated_at TIMESTAMP WITH TIME ZONE",
+        ],
+    ),
+    (
+        6,
+        "Add per-project frame sampling settings",
+        [
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS sampling_mode VARCHAR NOT NULL DEFAULT 'fixed'",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS min_sample_interval DOUBLE PRECISION NOT NULL DEFAULT 0.2",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS max_sample_interval DOUBLE PRECISION NOT NULL DEFAULT 5.0",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS scene_change_threshold DOUBLE PRECISION NOT NULL DEFAULT 0.1",
+        ],
+    ),
+    (
+        7,
+        "Store perceptual hashes of frames",
+        [
+            "ALTER TABLE frames ADD COLUMN IF NOT EXISTS perceptual_hash BIGINT",
+        ],
+    ),
+    (
+        8,
+        "Record where in their video frames were taken",
+        [
+            "ALTER TABLE frames ADD COLUMN IF NOT EXISTS frame_number INTEGER",
+            "ALTER TABLE frames ADD COLUMN IF NOT EXISTS timestamp DOUBLE PRECISION",
+        ],
+    ),
+    (
+        9,
+        "Record when workers claim videos",
+        [
+            "ALTER TABLE videos ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE",
+        ],
+    ),
+]
+
+# Arbitrary key for the advisory lock that keeps several uvicorn workers
+# from running migrations at the same time
+MIGRATION_LOCK_KEY = 7293150
+
+
+# A CREATE INDEX CONCURRENTLY that fails part way (e.g. the server restarts)
+# leaves an invalid index behind, which IF NOT EXISTS would then skip over.
+# Drop those so that the migration can build them again.
+def drop_invalid_indexes(connection):
+    invalid_indexes = connection.execute(
+        text(
+            "SELECT index_class.relname FROM pg_index "
+            "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+            "WHERE NOT pg_index.indisvalid AND index_class.relname LIKE 'ix\\_%'"
+        )
+    ).scalars()
+    for index_name in list(invalid_indexes):
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'))
+
+
+def get_applied_versions(connection):
+    return set(connection.execute(select(models.SchemaMigration.version)).scalars())
+
+
+def run_migrations(engine):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(
+            text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+        try:
+            applied_versions = get_applied_versions(connection)
+            pending = [
+                migration
+                for migration in MIGRATIONS
+                if migration[0] not in applied_versions
+            ]
+            if len(pending) > 0:
+                drop_invalid_indexes(connection)
+
+            for version, description, statements in pending:
+                for statement in statements:
+                    if callable(statement):
+                        statement(connection)
+                    else:
+                        connection.execute(text(statement))
+                connection.execute(
+                    insert(models.SchemaMigration).values(
+                        version=version, description=description
+                    )
+                )
+        finally:
+            connection.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
@@ -1,16 +1,54 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Uuid, Date, text, LargeBinary
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, BigInteger, String, Uuid, Date, DateTime, Index, Sequence, DDL, event, text, func, LargeBinary, Float, JSON
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import UserDefinedType
 
 from .database import Base
+from . import change_tracking
 
 # Define all SQLAlchemy ORM models that represent the database
 
+# Shared by every table with change tracking (see change_tracking.py) so that
+# revisions are ordered across frames, bounding boxes and labels
+revision_sequence = Sequence(change_tracking.REVISION_SEQUENCE, metadata=Base.metadata)
+
+
+def revision_column():
+    return Column(
+        'revision',
+        BigInteger,
+        server_default=text(f"nextval('{change_tracking.REVISION_SEQUENCE}')"),
+        index=True,
+    )
+
+
+# PostgreSQL's 64 bit transaction IDs
+class Xid8(UserDefinedType):
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return 'XID8'
+
+
+# The transaction that last inserted or changed the row
+def changed_xid_column():
+    return Column(
+        'changed_xid',
+        Xid8(),
+        server_default=text('pg_current_xact_id()'),
+        index=True,
+    )
+
 class Project(Base):
     __tablename__ = "projects"
 
     # Represents the columns in the projects table
-    id = Column('id', Uuid, primary_key=True, index=True, unique=True, server_default=text("gen_random_uuid()"))
+    id = Column('id', Uuid, primary_key=True, server_default=text("gen_random_uuid()"))
     name = Column('name', String, unique=True)
+    # How frames are picked from the project's videos, see frame_sampling.py
+    sampling_mode = Column('sampling_mode', String, nullable=False, server_default="fixed")
+    min_sample_interval = Column('min_sample_interval', Float, nullable=False, server_default=text("0.2"))
+    max_sample_interval = Column('max_sample_interval', Float, nullable=False, server_default=text("5.0"))
+    scene_change_threshold = Column('scene_change_threshold', Float, nullable=False, server_default=text("0.1"))
 
     # Fetch the items from the database that has foreign key pointing
     # to this record in the projects table
@@ -22,12 +60,20 @@ class Project(Base):
 class Video(Base):
     __tablename__ = "videos"
 
-    id = Column('id', Uuid, primary_key=True, index=True, unique=True, server_default=text("gen_random_uuid()"))
+    id = Column('id', Uuid, primary_key=True, server_default=text("gen_random_uuid()"))
     name = Column('name', String, unique=True)
     video_url = Column('video_url', String)
     date_uploaded = Column('date_uploaded', Date)
     project_id = Column('project_id', Uuid, ForeignKey("projects.id"))
     preprocessing_status = Column('preprocessing_status', String, default="not_started")
+    # Preprocessing progress, see progress.py
+    frames_total = Column('frames_total', Integer, nullable=True)
+    frames_processed = Column('frames_processed', Integer, nullable=True)
+    processing_rate = Column('processing_rate', Float, nullable=True)
+    stage_rates = Column('stage_rates', JSON, nullable=True)
+    progress_updated_at = Column('progress_updated_at', DateTime(timezone=True), nullable=True)
+    # When a worker (see worker.py) claimed the video for preprocessing
+    claimed_at = Column('claimed_at', DateTime(timezone=True), nullable=True)
 
     project = relationship("Project", back_populates="videos")
     frames = relationship("Frame", back_populates="video")
@@ -36,13 +82,21 @@ class Video(Base):
 class Frame(Base):
     __tablename__ = "frames"
 
-    id = Column('id', Uuid, primary_key=True, index=True, unique=True, server_default=text("gen_random_uuid()"))
+    id = Column('id', Uuid, primary_key=True, server_default=text("gen_random_uuid()"))
     human_reviewed = Column('human_reviewed', Boolean, default=False)
     width = Column('width', Integer)
     height = Column('height', Integer)
     frame_url = Column('frame_url', String)
-    project_id = Column('project_id', Uuid, ForeignKey("projects.id"))
-    video_id = Column('video_id', Uuid, ForeignKey("videos.id"))
+    project_id = Column('project_id', Uuid, ForeignKey("projects.id"), index=True)
+    video_id = Column('video_id', Uuid, ForeignKey("videos.id"), index=True)
+    # Where in the video the frame was taken, missing for frames from before
+    # these were recorded
+    frame_number = Column('frame_number', Integer, nullable=True)
+    timestamp = Column('timestamp', Float, nullable=True)
+    # Perceptual hash of the frame's image, see frame_hashing.py
+    perceptual_hash = Column('perceptual_hash', BigInteger, nullable=True)
+    revision = revision_column()
+    changed_xid = changed_xid_column()
 
     project = relationship("Project", back_populates="frames")
     video = relationship("Video", back_populates="frames")
@@ -51,27 +105,78 @@ class Frame(Base):
 class BoundingBox(Base):
     __tablename__ = "bounding_boxes"
 
-    id = Column('id', Uuid, primary_key=True, index=True, unique=True, server_default=text("gen_random_uuid()"))
+    id = Column('id', Uuid, primary_key=True, server_default=text("gen_random_uuid()"))
     x_top_left = Column('x_top_left', Integer)
     y_top_left = Column('y_top_left', Integer)
     x_bottom_right = Column('x_bottom_right', Integer)
     y_bottom_right = Column('y_bottom_right', Integer)
     width = Column('width', Integer)
     height = Column('height', Integer)
-    frame_id = Column('frame_id', Uuid, ForeignKey("frames.id"))
-    label_id = Column('label_id', Uuid, ForeignKey("labels.id"), nullable=True)
+    frame_id = Column('frame_id', Uuid, ForeignKey("frames.id"), index=True)
+    label_id = Column('label_id', Uuid, ForeignKey("labels.id"), nullable=True, index=True)
     image_features = Column('image_features', LargeBinary(length=21000))
     prediction = Column('prediction', Boolean, default=True)
+    # Versions of the models that predicted the box, see model_provider.py
+    model_version = Column('model_version', String, nullable=True)
+    revision = revision_column()
+    changed_xid = changed_xid_column()
 
     label = relationship("Label", cascade="all, delete")
 
 
 class Label(Base):
     __tablename__ = "labels"
+    __table_args__ = (Index("ix_labels_project_id_name", "project_id", "name"),)
 
-    id = Column('id', Uuid, primary_key=True, index=True, unique=True, server_default=text("gen_random_uuid()"))
+    id = Column('id', Uuid, primary_key=True, server_default=text("gen_random_uuid()"))
     name = Column('name', String)
     project_id = Column('project_id', Uuid, ForeignKey("projects.id"))
+    revision = revision_column()
+    changed_xid = changed_xid_column()
 
     project = relationship("Project", back_populates="labels")
-    
\ No newline at end of file
+
+
+# Tombstones left behind by the record_deletion trigger when a frame, box or
+# label is deleted. Rows are copied by the trigger, so there are no foreign keys.
+class DeletedRow(Base):
+    __tablename__ = "deleted_rows"
+    __table_args__ = (
+        Index("ix_deleted_rows_video_id_changed_xid", "video_id", "changed_xid"),
+        Index("ix_deleted_rows_project_id_changed_xid", "project_id", "changed_xid"),
+    )
+
+    revision = Column(
+        'revision',
+        BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        server_default=text(f"nextval('{change_tracking.REVISION_SEQUENCE}')"),
+    )
+    changed_xid = Column('changed_xid', Xid8(), server_default=text('pg_current_xact_id()'))
+    table_name = Column('table_name', String)
+    row_id = Column('row_id', Uuid)
+    video_id = Column('video_id', Uuid)
+    project_id = Column('project_id', Uuid)
+
+
+# Keeps track of which schema migrations (see migrations.py) have been applied
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column('version', Integer, primary_key=True)
+    description = Column('description', String)
+    applied_at = Column('applied_at', DateTime, server_default=func.now())
+
+
+# Install the change tracking triggers whenever create_all creates the tables,
+# existing databases get them through a migration instead
+event.listen(
+    Base.metadata, "before_create", DDL(change_tracking.BUMP_REVISION_FUNCTION)
+)
+event.listen(
+    Base.metadata, "before_create", DDL(change_tracking.RECORD_DELETION_FUNCTION)
+)
+for tracked_table in [Frame.__table__, BoundingBox.__table__, Label.__table__]:
+    for statement in change_tracking.trigger_statements(tracked_table.name):
+        event.listen(tracked_table, "after_create", DDL(statement))
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Metrics of the database connection pools (see database.py): how long
+# checking out a connection takes, how often it times out and how close the
+# pool is to having every connection it's allowed checked out.
+
+# Checkout times are kept for this many of the most recent checkouts
+RECENT_CHECKOUTS = 1000
+
+
+def _percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    ]
+
+
+class PoolMetrics:
+    def __init__(self, name, pool_size, max_overflow):
+        self.name = name
+        # A negative max_overflow means there's no limit
+        self.capacity = None
+        if max_overflow >= 0:
+            self.capacity = pool_size + max_overflow
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.peak_checked_out = 0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=RECENT_CHECKOUTS)
+
+    # wait = seconds the checkout took, including opening a new connection
+    def record_checkout(self, wait, checked_out):
+        with self.lock:
+            self.checkouts += 1
+            self.recent_waits.append(wait)
+            self.max_wait = max(self.max_wait, wait)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def record_timeout(self, wait):
+        with self.lock:
+            self.timeouts += 1
+            self.max_wait = max(self.max_wait, wait)
+
+    def snapshot(self, pool):
+        with self.lock:
+            waits = sorted(self.recent_waits)
+            checkouts = self.checkouts
+            timeouts = self.timeouts
+            peak_checked_out = self.peak_checked_out
+            max_wait = self.max_wait
+        checked_out = pool.checkedout()
+        saturation = None
+        if self.capacity is not None:
+            saturation = round(checked_out / self.capacity, 3)
+        return {
+            "name": self.name,
+            "pool_size": pool.size(),
+            "capacity": self.capacity,
+            "checked_out": checked_out,
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "saturation": saturation,
+            "peak_checked_out": peak_checked_out,
+            "checkouts": checkouts,
+            "timeouts": timeouts,
+            "checkout_ms": {
+                "p50": round(1000 * _percentile(waits, 0.5), 3),
+                "p95": round(1000 * _percentile(waits, 0.95), 3),
+                "p99": round(1000 * _percentile(waits, 0.99), 3),
+                "max": round(1000 * max_wait, 3),
+            },
+        }
+
+
+# Returns a QueuePool class that times every checkout into pool_metrics. The
+# metrics live on the class so that they carry over when the engine
+# recreates its pool.
+def instrumented_pool_class(pool_metrics):
+    class InstrumentedQueuePool(QueuePool):
+        checkout_metrics = pool_metrics
+
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                connection = super().connect()
+            except exc.TimeoutError:
+                self.checkout_metrics.record_timeout(time.perf_counter() - start)
+                raise
+            self.checkout_metrics.record_checkout(
+                time.perf_counter() - start, self.checkedout()
+            )
+            return connection
+
+        def metrics(self):
+            return self.checkout_metrics.snapshot(self)
+
+    return InstrumentedQueuePool
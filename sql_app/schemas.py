@@ -1,8 +1,8 @@
-from typing import List
+from typing import Dict, List, Literal, Optional
 from uuid import UUID
-from datetime import date
+from datetime import date, datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # Define all Pydantic models that define valid data shapes for the API
 
@@ -37,6 +37,19 @@ class ExistingProject(ProjectBase):
         allow_mutation = True
 
 
+# How frames are picked from a project's videos, see frame_sampling.py.
+# Intervals are in seconds, the threshold is how different a frame has to
+# look (from 0 to 1) to be picked in adaptive mode.
+class SamplingSettings(BaseModel):
+    sampling_mode: Literal["fixed", "adaptive"] = "fixed"
+    min_sample_interval: float = Field(0.2, gt=0)
+    max_sample_interval: float = Field(5.0, gt=0)
+    scene_change_threshold: float = Field(0.1, gt=0, le=1)
+
+    class Config:
+        orm_mode = True
+
+
 ###############################################################
 # Video schemas
 ###############################################################
@@ -77,6 +90,19 @@ class VideoResponse(VideoBase):
     preprocessing_status: str
 
 
+# Preprocessing progress of a video, see progress.py
+class VideoProgress(BaseModel):
+    video_id: UUID
+    preprocessing_status: str
+    frames_processed: int
+    frames_total: int
+    percent_processed: float
+    frames_per_second: float
+    stage_rates: Dict[str, float]
+    eta_seconds: Optional[float]
+    updated_at: Optional[datetime]
+
+
 ###############################################################
 # BoundingBox schemas
 ###############################################################
@@ -99,6 +125,7 @@ class BoundingBoxBase(BaseModel):
 # except for the auto-generated UUID
 class BoundingBoxCreate(BoundingBoxBase):
     image_features: bytes
+    model_version: Optional[str] = None
 
 
 class BoundingBox(BoundingBoxBase):
@@ -108,6 +135,12 @@ class BoundingBox(BoundingBoxBase):
         orm_mode = True
 
 
+# A box returned from a similarity search along with how close its
+# image features are to the queried box (cosine similarity)
+class SimilarBoundingBox(BoundingBox):
+    similarity: float
+
+
 ###############################################################
 # Label schemas
 ###############################################################
@@ -145,6 +178,9 @@ class FrameBase(BaseModel):
     project_id: UUID
     video_id: UUID
     frame_url: str
+    # Frame number in the video and seconds into it
+    frame_number: Optional[int] = None
+    timestamp: Optional[float] = None
 
 
 # When uploading a frame, we should know what project it belongs
@@ -160,3 +196,36 @@ class Frame(FrameBase):
 
     class Config:
         orm_mode = True
+
+
+###############################################################
+# Change tracking schemas
+###############################################################
+
+
+# Rows returned by the changes feed carry the revision at which they were
+# last inserted or updated
+class FrameRevision(FrameBase):
+    id: UUID
+    revision: int
+
+    class Config:
+        orm_mode = True
+
+
+class BoundingBoxRevision(BoundingBox):
+    revision: int
+
+
+class LabelRevision(Label):
+    revision: int
+
+
+# A frame, bounding box or label that was deleted at this revision
+class DeletedRow(BaseModel):
+    revision: int
+    table_name: str
+    row_id: UUID
+
+    class Config:
+        orm_mode = True
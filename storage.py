@@ -0,0 +1,369 @@
+import io
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+# Storage backends for the files that belong to a project: uploaded videos,
+# extracted frames, frame packs and timeline sprite sheets.
+#
+# Every file is addressed by the project's name plus a path. The path is what
+# gets stored in the database (e.g. a frame's frame_url), so each backend
+# keeps the form it has always used: an absolute file system path for local
+# storage and a blob name within the project's container for Azure. Use
+# video_path to build paths rather than assembling them by hand.
+#
+# Uploads can go through a BatchUploader, which writes many files at once
+# from a thread pool shared by the whole backend, with a cap on how many
+# uploads can be waiting so that memory stays bounded.
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(ABC):
+    def __init__(self, upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        self.upload_concurrency = upload_concurrency
+        self.upload_pool = ThreadPoolExecutor(
+            max_workers=upload_concurrency, thread_name_prefix="storage-upload"
+        )
+
+    # Called once when a project is created
+    @abstractmethod
+    def create_project(self, project_name):
+        raise NotImplementedError
+
+    # Where the files of a video in the project are kept
+    @abstractmethod
+    def video_path(self, project_name, video_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write(self, project_name, path, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_chunks(self, project_name, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        raise NotImplementedError
+
+    def read(self, project_name, path):
+        return b"".join(self.read_chunks(project_name, path))
+
+    @abstractmethod
+    def read_range(self, project_name, path, offset, length):
+        raise NotImplementedError
+
+    @abstractmethod
+    def exists(self, project_name, path):
+        raise NotImplementedError
+
+    # Returns a file-like object that appends to a new, empty file at the
+    # path (replacing any file already there)
+    @abstractmethod
+    def open_append(self, project_name, path):
+        raise NotImplementedError
+
+    # The file's location on the local file system, or None if it isn't on
+    # local disk (it then has to be read through read_chunks)
+    def local_path(self, project_name, path):
+        return None
+
+    def batch_uploader(self, project_name, max_pending=None):
+        return BatchUploader(
+            self,
+            project_name,
+            max_pending if max_pending is not None else 4 * self.upload_concurrency,
+        )
+
+    def close(self):
+        self.upload_pool.shutdown()
+
+
+# Writes files through the backend's upload pool. write only blocks while
+# max_pending uploads are already waiting.
+class BatchUploader:
+    def __init__(self, storage, project_name, max_pending):
+        self.storage = storage
+        self.project_name = project_name
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def write(self, path, data):
+        self.slots.acquire()
+        try:
+            future = self.storage.upload_pool.submit(
+                self.storage.write, self.project_name, path, data
+            )
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+        # Raise upload errors as soon as they're noticed rather than at the end
+        while len(self.futures) > 0 and self.futures[0].done():
+            self.futures.pop(0).result()
+
+    # Waits for every upload and raises the first error, if any
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    # For when the files aren't needed anymore (e.g. the job failed): drops
+    # the uploads that haven't started and waits for the rest, logging their
+    # errors rather than raising them over the reason for giving up
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        for future in self.futures:
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                logger.error(
+                    "Upload to project %s failed",
+                    self.project_name,
+                    exc_info=error,
+                )
+        self.futures = []
+
+
+# Where the files of a video (the video itself, its frames and timeline)
+# are kept within the project's storage
+def video_files_path(storage, project_name, video_name):
+    return storage.video_path(project_name, video_name.replace(".mp4", ""))
+
+
+# Where a video's timeline sprite sheets are stored, next to its frames
+def timeline_path(storage, project_name, video_name):
+    return video_files_path(storage, project_name, video_name) + "/timeline"
+
+
+###############################################################
+# Local file system
+###############################################################
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root, upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        super().__init__(upload_concurrency)
+        self.root = os.path.abspath(root)
+
+    def create_project(self, project_name):
+        os.makedirs(os.path.join(self.root, project_name), exist_ok=True)
+
+    def video_path(self, project_name, video_name):
+        return self.root + "/" + project_name + "/" + video_name
+
+    def write(self, project_name, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that readers never see partial files
+        with open(path + ".tmp", "wb") as stored_file:
+            stored_file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def read_chunks(self, project_name, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        with open(path, "rb") as stored_file:
+            while True:
+                chunk = stored_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read_range(self, project_name, path, offset, length):
+        with open(path, "rb") as stored_file:
+            stored_file.seek(offset)
+            return stored_file.read(length)
+
+    def exists(self, project_name, path):
+        return os.path.exists(path)
+
+    def open_append(self, project_name, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Replace (rather than truncate) an existing file, since truncating a
+        # file that a reader has mapped would crash the reader
+        if os.path.exists(path):
+            os.remove(path)
+        return open(path, "wb")
+
+    def local_path(self, project_name, path):
+        return path
+
+
+###############################################################
+# Azure Blob Storage
+###############################################################
+
+
+# File-like wrapper around an Azure append blob
+class AppendBlobFile:
+    # Largest block a single append_block call accepts
+    MAX_BLOCK_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+        self.blob_client.create_append_blob()
+
+    def write(self, data):
+        for start in range(0, len(data), self.MAX_BLOCK_BYTES):
+            self.blob_client.append_block(data[start : start + self.MAX_BLOCK_BYTES])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Each project has its own container named after it
+class AzureStorage(StorageBackend):
+    def __init__(
+        self, connection_string, upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY
+    ):
+        super().__init__(upload_concurrency)
+
+        import requests
+        from azure.core.pipeline.transport import RequestsTransport
+        from azure.storage.blob import BlobServiceClient
+
+        # Every upload thread shares one HTTP connection pool, sized so that
+        # concurrent uploads don't have to open new connections
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=upload_concurrency + 4)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            connection_string,
+            transport=RequestsTransport(session=session, session_owner=False),
+        )
+
+    def _blob_client(self, project_name, path):
+        return self.blob_service_client.get_blob_client(
+            container=project_name, blob=path
+        )
+
+    def create_project(self, project_name):
+        self.blob_service_client.create_container(project_name)
+
+    def video_path(self, project_name, video_name):
+        return video_name
+
+    def write(self, project_name, path, data):
+        self._blob_client(project_name, path).upload_blob(data, overwrite=True)
+
+    def read_chunks(self, project_name, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            downloader = self._blob_client(project_name, path).download_blob()
+        except ResourceNotFoundError:
+            raise FileNotFoundError(path)
+        yield from downloader.chunks()
+
+    def read_range(self, project_name, path, offset, length):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return (
+                self._blob_client(project_name, path)
+                .download_blob(offset=offset, length=length)
+                .readall()
+            )
+        except ResourceNotFoundError:
+            raise FileNotFoundError(path)
+
+    def exists(self, project_name, path):
+        return self._blob_client(project_name, path).exists()
+
+    def open_append(self, project_name, path):
+        return AppendBlobFile(self._blob_client(project_name, path))
+
+
+###############################################################
+# In memory
+###############################################################
+
+
+class _MemoryAppendFile(io.BytesIO):
+    def __init__(self, storage, project_name, path):
+        super().__init__()
+        self.storage = storage
+        self.key = (project_name, path)
+        with storage.lock:
+            storage.files[self.key] = b""
+
+    def flush(self):
+        super().flush()
+        with self.storage.lock:
+            self.storage.files[self.key] = self.getvalue()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+        super().close()
+
+
+# Keeps everything in a dict. Useful for tests and for benchmarking upload
+# throughput without a real storage account: latency adds a delay to every
+# write to stand in for a network round trip.
+class InMemoryStorage(StorageBackend):
+    def __init__(self, upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY, latency=0.0):
+        super().__init__(upload_concurrency)
+        self.latency = latency
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def create_project(self, project_name):
+        pass
+
+    def video_path(self, project_name, video_name):
+        return video_name
+
+    def write(self, project_name, path, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.files[(project_name, path)] = bytes(data)
+
+    def _get(self, project_name, path):
+        with self.lock:
+            try:
+                return self.files[(project_name, path)]
+            except KeyError:
+                raise FileNotFoundError(path)
+
+    def read_chunks(self, project_name, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        data = self._get(project_name, path)
+        for start in range(0, len(data), chunk_size):
+            yield data[start : start + chunk_size]
+
+    def read_range(self, project_name, path, offset, length):
+        return self._get(project_name, path)[offset : offset + length]
+
+    def exists(self, project_name, path):
+        with self.lock:
+            return (project_name, path) in self.files
+
+    def open_append(self, project_name, path):
+        return _MemoryAppendFile(self, project_name, path)
+
+
+# Picks the backend from the environment: Azure if a connection string is
+# set, otherwise STORAGE_BACKEND ("local" or "memory")
+def create_storage_backend():
+    upload_concurrency = int(
+        os.getenv("STORAGE_UPLOAD_CONCURRENCY", str(DEFAULT_UPLOAD_CONCURRENCY))
+    )
+    connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+    if connection_string:
+        return AzureStorage(connection_string, upload_concurrency)
+    if os.getenv("STORAGE_BACKEND") == "memory":
+        return InMemoryStorage(upload_concurrency)
+    return LocalStorage(os.path.join(os.getcwd(), "local_projects"), upload_concurrency)
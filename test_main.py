@@ -1,9 +1,15 @@
+import os
 from fastapi.testclient import TestClient
 from sql_app.database import SessionLocal, engine
 from sql_app import models
+from sql_app.cache import response_cache
 from main import app, get_db
+from sqlalchemy import text
 import uuid
 import time
+import io
+import json
+import zipfile
 
 # Clear test database before creating new tables
 models.Base.metadata.drop_all(bind=engine)
@@ -93,6 +99,63 @@ def test_create_project_with_same_name():
     assert data["message"] == "Error: there is already a project named testproject1"
 
 
+def test_project_sampling_settings():
+    response = client.post("/projects", json={"name": "samplingproject"})
+    assert response.status_code == 200, response.text
+    project_id = response.json()["id"]
+
+    # Projects sample one frame per second unless set otherwise
+    response = client.get(f"/projects/{project_id}/sampling")
+    assert response.status_code == 200
+    assert response.json()["sampling_mode"] == "fixed"
+
+    settings = {
+        "sampling_mode": "adaptive",
+        "min_sample_interval": 0.5,
+        "max_sample_interval": 10,
+        "scene_change_threshold": 0.2,
+    }
+    response = client.put(f"/projects/{project_id}/sampling", json=settings)
+    assert response.status_code == 200, response.text
+    response = client.get(f"/projects/{project_id}/sampling")
+    assert response.json() == settings
+
+    response = client.put(
+        f"/projects/{project_id}/sampling",
+        json={**settings, "min_sample_interval": 20},
+    )
+    assert response.status_code == 400
+    response = client.put(
+        f"/projects/{project_id}/sampling",
+        json={**settings, "sampling_mode": "sometimes"},
+    )
+    assert response.status_code == 422
+
+
+def test_scene_change_sampler_keeps_changed_frames():
+    import numpy as np
+    from frame_sampling import SceneChangeSampler, signature_difference
+
+    dark = np.full((32, 32), 20, dtype=np.uint8)
+    noisy_dark = dark + np.random.default_rng(0).integers(0, 3, (32, 32)).astype(
+        np.uint8
+    )
+    bright = np.full((32, 32), 220, dtype=np.uint8)
+    assert signature_difference(dark, dark) == 0
+    assert signature_difference(dark, noisy_dark) < 0.1
+    assert signature_difference(dark, bright) > 0.5
+
+    sampler = SceneChangeSampler(threshold=0.1, max_interval=5)
+    assert sampler.keep(0, dark)
+    # Nothing changed
+    assert not sampler.keep(1, noisy_dark)
+    # A cut
+    assert sampler.keep(2, bright)
+    assert not sampler.keep(3, bright)
+    # No change for max_interval seconds
+    assert sampler.keep(7, bright)
+
+
 def test_upload_one_video():
     # Step 1: create a project
     project_id = ""
@@ -142,6 +205,9 @@ def test_upload_one_video():
     assert data["video_id"] == video_id
     assert data["frames"]
     assert len(data["frames"]) == 64
+    # One frame was sampled every second
+    timestamps = sorted(frame["timestamp"] for frame in data["frames"])
+    assert [round(timestamp) for timestamp in timestamps] == list(range(64))
     one_frame_id = data["frames"][0]["id"]
     another_frame_id = data["frames"][10]["id"]
     assert "labels" in data["frames"][10]
@@ -172,6 +238,34 @@ def test_upload_one_video():
     assert data["frame_id"] == another_frame_id
     assert len(data["bounding_boxes"]) == 5  # This frame detected 4 people and 1 car
 
+    # Every box was predicted by the current models, so none of them are stale
+    stale_response = client.get(f"/projects/{project_id}/stale_predictions")
+    assert stale_response.status_code == 200
+    assert stale_response.json()["videos"] == []
+
+    # Every frame of the video was processed
+    progress_response = client.get(f"/videos/{video_id}/progress")
+    assert progress_response.status_code == 200
+    progress = progress_response.json()
+    assert progress["preprocessing_status"] == "success"
+    assert progress["frames_total"] > 0
+    assert progress["frames_processed"] == progress["frames_total"]
+    assert progress["percent_processed"] == 100.0
+    assert progress["eta_seconds"] is None
+    assert set(progress["stage_rates"]) == {"decode", "detect", "store"}
+
+    # The event stream sends the final progress and ends
+    events_response = client.get(f"/videos/{video_id}/progress/events")
+    assert events_response.status_code == 200
+    assert events_response.headers["content-type"].startswith("text/event-stream")
+    assert events_response.text.startswith("event: progress\ndata: ")
+    streamed = json.loads(events_response.text.split("data: ", 1)[1].strip())
+    assert streamed["frames_processed"] == progress["frames_total"]
+
+    # A video that's done preprocessing can't be cancelled
+    cancel_response = client.delete(f"/videos/{video_id}/preprocess")
+    assert cancel_response.status_code == 400
+
     # Uploading with invalid project UUID should fail
     response = client.post(
         f"/projects/{project_id}4321abc/videos",
@@ -208,6 +302,79 @@ def test_upload_one_video():
     assert data["videos"][0]["id"] == video_id
 
 
+def test_near_identical_frames_reuse_boxes(tmp_path, monkeypatch):
+    import cv2
+    import preprocessing
+
+    monkeypatch.setattr(preprocessing, "frame_hash_max_distance", 4)
+
+    # A few seconds of a single frame with people and a car in it
+    vidcap = cv2.VideoCapture("./test_videos/president-mckinley-oath.mp4")
+    vidcap.set(cv2.CAP_PROP_POS_MSEC, 10000)
+    has_frame, image = vidcap.read()
+    assert has_frame
+    video_path = str(tmp_path / "still.mp4")
+    writer = cv2.VideoWriter(
+        video_path,
+        cv2.VideoWriter_fourcc(*"mp4v"),
+        10,
+        (image.shape[1], image.shape[0]),
+    )
+    for _ in range(30):
+        writer.write(image)
+    writer.release()
+
+    response = client.post("/projects", json={"name": "reuse-project"})
+    project_id = response.json()["id"]
+    upload_response = client.post(
+        f"/projects/{project_id}/videos",
+        files={"video": ("still.mp4", open(video_path, "rb"), "video/mp4")},
+    )
+    assert upload_response.status_code == 202
+    video_id = upload_response.json()["video_id"]
+
+    for _ in range(60):
+        status = client.get(f"/videos/{video_id}").json()["preprocessing_status"]
+        if status not in ("not_started", "queued", "in_progress"):
+            break
+        time.sleep(1)
+    assert status == "success"
+
+    frames = client.get(f"/videos/{video_id}/frames").json()["frames"]
+    assert len(frames) == 3
+
+    # Only one frame ran through the models, the others have copies of its
+    # boxes, labels and features
+    db = SessionLocal()
+    try:
+        boxes_by_frame = []
+        for frame in frames:
+            boxes = (
+                db.query(models.BoundingBox)
+                .filter(models.BoundingBox.frame_id == frame["id"])
+                .all()
+            )
+            assert all(box.prediction for box in boxes)
+            boxes_by_frame.append(
+                sorted(
+                    (
+                        box.x_top_left,
+                        box.y_top_left,
+                        box.x_bottom_right,
+                        box.y_bottom_right,
+                        box.label_id,
+                        box.image_features,
+                    )
+                    for box in boxes
+                )
+            )
+    finally:
+        db.close()
+    assert len(boxes_by_frame[0]) > 0
+    assert boxes_by_frame[1] == boxes_by_frame[0]
+    assert boxes_by_frame[2] == boxes_by_frame[0]
+
+
 def test_upload_video_to_nonexistent_project():
     # Uploading to a non-existent project should fail
     fake_project_id = uuid.UUID("12345678123456781234567812345678")
@@ -325,6 +492,45 @@ def test_interactive_workflow():
     frame1 = data["frames"][0]
     frame2 = data["frames"][10]
 
+    # All 16 frames fit on a single timeline sprite sheet
+    timeline_response = client.get(f"/videos/{video_id}/timeline")
+    assert timeline_response.status_code == 200
+    timeline = timeline_response.json()
+    assert timeline["frame_count"] == 16
+    assert timeline["sheet_count"] == 1
+    assert timeline["tiles"][11] == [0, timeline["tile_width"], timeline["tile_height"]]
+    assert len(timeline["frame_numbers"]) == 16
+    assert timeline["timestamps"] == sorted(timeline["timestamps"])
+    sheet_response = client.get(timeline["sheets"][0])
+    assert sheet_response.status_code == 200
+    assert sheet_response.headers["content-type"] == "image/jpeg"
+    assert client.get(f"/videos/{video_id}/timeline/1").status_code == 404
+
+    # The full image and a thumbnail of a frame can be fetched directly
+    image_response = client.get(f"/frames/{frame1['id']}/image")
+    assert image_response.status_code == 200
+    assert image_response.headers["content-type"] == "image/jpeg"
+    thumbnail_response = client.get(f"/frames/{frame1['id']}/image?w=160&q=70")
+    assert thumbnail_response.status_code == 200
+    assert len(thumbnail_response.content) < len(image_response.content)
+    cached_thumbnail = client.get(
+        f"/frames/{frame1['id']}/image?w=160&q=70",
+        headers={"If-None-Match": thumbnail_response.headers["etag"]},
+    )
+    assert cached_thumbnail.status_code == 304
+    bad_format = client.get(f"/frames/{frame1['id']}/image?fmt=gif")
+    assert bad_format.status_code == 400
+
+    # Everything in the video is new to a client that has seen nothing yet
+    changes_response = client.get(f"/videos/{video_id}/changes?since=0")
+    assert changes_response.status_code == 200
+    data = changes_response.json()
+    assert len(data["frames"]) == 16
+    assert len(data["labels"]) == 7
+    assert data["deleted"] == []
+    first_revision = data["revision"]
+    assert first_revision > 0
+
     # Fetch the labels and make sure it's the expected amount
     labels_response = client.get(f"/projects/{project_id}/labels")
     assert labels_response.status_code == 200
@@ -344,6 +550,24 @@ def test_interactive_workflow():
     data = check_label_create.json()
     assert len(data["labels"]) == 8
 
+    # Asking again with the ETag of the current labels returns 304 without a body
+    etag = check_label_create.headers["etag"]
+    assert etag.startswith('W/"')
+    cached_labels = client.get(
+        f"/projects/{project_id}/labels", headers={"If-None-Match": etag}
+    )
+    assert cached_labels.status_code == 304
+    assert cached_labels.content == b""
+
+    # The ETag comes from the labels' version, so a worker that hasn't
+    # cached the response yet answers 304 too
+    response_cache.clear()
+    revalidated_uncached = client.get(
+        f"/projects/{project_id}/labels", headers={"If-None-Match": etag}
+    )
+    assert revalidated_uncached.status_code == 304
+    assert revalidated_uncached.headers["etag"] == etag
+
     # Fetch the bounding boxes for the first frame and simply mark
     # the frame and boxes as human-reviewed. Mimics the frontend
     # simply clicking to go to the next frame, no corrections needed.
@@ -401,6 +625,26 @@ def test_interactive_workflow():
     )
     assert training_response.status_code == 200
 
+    # Find the boxes most similar to one of the reviewed boxes
+    query_box_id = frame1_boxes[0]["id"]
+    similar_response = client.get(f"/boundingboxes/{query_box_id}/similar?k=5")
+    assert similar_response.status_code == 200
+    data = similar_response.json()
+    assert data["box_id"] == query_box_id
+    assert len(data["bounding_boxes"]) == 5
+    similarities = [box["similarity"] for box in data["bounding_boxes"]]
+    assert similarities == sorted(similarities, reverse=True)
+    assert query_box_id not in [box["id"] for box in data["bounding_boxes"]]
+
+    # Apply a label to the box and its nearest neighbors in one request
+    label_response = client.post(
+        f"/boundingboxes/{query_box_id}/similar/label?label_id={label_id1}&k=3"
+    )
+    assert label_response.status_code == 200
+    data = label_response.json()
+    assert len(data["bounding_box_ids"]) == 4
+    assert query_box_id in data["bounding_box_ids"]
+
     # Delete a box
     box_id = frame2_boxes[0]["id"]
     delete_response = client.delete(f"/boundingboxes/{box_id}")
@@ -414,8 +658,792 @@ def test_interactive_workflow():
     data = check_label_delete.json()
     assert len(data["labels"]) == 7
 
+    # The labels changed, so the old ETag no longer matches
+    revalidated_labels = client.get(
+        f"/projects/{project_id}/labels", headers={"If-None-Match": etag}
+    )
+    assert revalidated_labels.status_code == 200
+    assert revalidated_labels.headers["etag"] != etag
+    assert revalidated_labels.json() == data
+
+    # Only what changed since the first sync comes back, including deletions
+    changes_response = client.get(f"/videos/{video_id}/changes?since={first_revision}")
+    assert changes_response.status_code == 200
+    data = changes_response.json()
+    assert data["revision"] > first_revision
+    assert frame1_id in [frame["id"] for frame in data["frames"]]
+    assert len(data["frames"]) < 16
+    deleted = [(row["table_name"], row["row_id"]) for row in data["deleted"]]
+    assert ("bounding_boxes", box_id) in deleted
+    assert ("labels", label_id2) in deleted
+
+    # Nothing is left to sync at the latest revision
+    changes_response = client.get(
+        f"/videos/{video_id}/changes?since={data['revision']}"
+    )
+    data = changes_response.json()
+    assert data["frames"] == []
+    assert data["bounding_boxes"] == []
+    assert data["deleted"] == []
+
     # Download all annotations for this project
     download_response = client.get(f"/projects/{project_id}/annotations")
     assert download_response.status_code == 200
     download_path = download_response.json()
     assert "local_projects/sidewalk-project" in download_path["annotations-path"]
+    assert download_path["frames-written"] == 16
+
+    # Nothing changed since the last download, so nothing should be rewritten
+    download_response = client.get(f"/projects/{project_id}/annotations")
+    assert download_response.status_code == 200
+    download_path = download_response.json()
+    assert download_path["frames-written"] == 0
+    assert download_path["frames-unchanged"] == 16
+
+    # Download the same annotations as a streamed ZIP archive
+    export_response = client.get(f"/projects/{project_id}/export")
+    assert export_response.status_code == 200
+    assert export_response.headers["content-type"] == "application/zip"
+    assert export_response.headers["content-disposition"] == (
+        'attachment; filename="sidewalk-project.zip"; '
+        "filename*=UTF-8''sidewalk-project.zip"
+    )
+    archive = zipfile.ZipFile(io.BytesIO(export_response.content))
+    names = archive.namelist()
+    assert len([name for name in names if name.startswith("images/")]) == 16
+    assert "labels/classes.txt" in names
+    coco = json.loads(archive.read("annotations.json"))
+    assert len(coco["images"]) == 16
+    assert len(coco["categories"]) == 7
+
+    bad_format_response = client.get(f"/projects/{project_id}/export?formats=voc")
+    assert bad_format_response.status_code == 400
+
+
+# Walk an EXPLAIN (FORMAT JSON) plan and collect the tables it reads
+# with a sequential scan
+def find_sequential_scans(plan):
+    scans = []
+    if plan["Node Type"] == "Seq Scan":
+        scans.append(plan["Relation Name"])
+    for subplan in plan.get("Plans", []):
+        scans.extend(find_sequential_scans(subplan))
+    return scans
+
+
+def test_database_pool_metrics():
+    response = client.get("/metrics/database")
+    assert response.status_code == 200
+    pools = {pool["name"]: pool for pool in response.json()["pools"]}
+    assert set(pools) == {"requests", "background"}
+    # Earlier tests checked out request connections
+    assert pools["requests"]["checkouts"] > 0
+    assert pools["requests"]["checked_out"] <= pools["requests"]["capacity"]
+    assert pools["requests"]["checkout_ms"]["p50"] >= 0
+
+
+def test_hot_queries_use_indexes():
+    from sqlalchemy import event
+    from sql_app import crud
+
+    some_id = uuid.uuid4()
+    hot_queries = {
+        "get_boxes_by_frame_id": lambda db: crud.get_boxes_by_frame_id(db, some_id),
+        "get_frames_by_video_id": lambda db: crud.get_frames_by_video_id(db, some_id),
+        "get_frames_by_project_id": lambda db: crud.get_frames_by_project_id(
+            db, some_id
+        ),
+        "replace_label": lambda db: crud.replace_label(db, some_id, uuid.uuid4()),
+        "get_label_by_name_and_project": lambda db: crud.get_label_by_name_and_project(
+            db, "person", some_id
+        ),
+        "get_unique_labels_per_frame": lambda db: crud.get_unique_labels_per_frame(
+            db, some_id
+        ),
+    }
+
+    # Runs the query and returns the statements it sent, as the driver got
+    # them along with their parameters
+    def sent_statements(run_query, db):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            run_query(db)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        return statements
+
+    # The test tables are tiny, so disable sequential scans to see whether the
+    # planner has an index to use at all. Without one it falls back to a
+    # sequential scan anyway.
+    db = SessionLocal()
+    connection = engine.connect()
+    try:
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        for name, run_query in hot_queries.items():
+            statements = [
+                (statement, parameters)
+                for statement, parameters in sent_statements(run_query, db)
+                if statement.lstrip().split()[0].upper() in ("SELECT", "UPDATE")
+            ]
+            assert statements != [], name
+            for statement, parameters in statements:
+                explain = connection.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + statement, parameters
+                ).scalar()
+                scans = find_sequential_scans(explain[0]["Plan"])
+                assert scans == [], name + " scans " + ", ".join(scans)
+    finally:
+        connection.close()
+        db.close()
+
+
+def test_changes_wait_for_earlier_transactions():
+    db = SessionLocal()
+    slow = SessionLocal()
+    fast = SessionLocal()
+    try:
+        project = models.Project(name="changes-project")
+        db.add(project)
+        db.commit()
+        video = models.Video(name="changes-video", project_id=project.id)
+        db.add(video)
+        db.commit()
+        changes_url = f"/videos/{video.id}/changes"
+
+        # The slow transaction writes first but commits after the fast one
+        slow.add(models.Label(name="slow", project_id=project.id))
+        slow.flush()
+        fast.add(models.Label(name="fast", project_id=project.id))
+        fast.commit()
+
+        # Neither label is returned while the slow transaction is running,
+        # otherwise a client would move past the slow label's revision
+        data = client.get(changes_url + "?since=0").json()
+        assert [label["name"] for label in data["labels"]] == []
+
+        slow.commit()
+        data = client.get(changes_url + f"?since={data['revision']}").json()
+        assert sorted(label["name"] for label in data["labels"]) == ["fast", "slow"]
+
+        data = client.get(changes_url + f"?since={data['revision']}").json()
+        assert data["labels"] == []
+    finally:
+        slow.rollback()
+        slow.close()
+        fast.close()
+        db.close()
+
+
+def test_frame_image_not_written_yet(tmp_path):
+    from frame_pack import frame_pack_url, PACK_NAME
+
+    db = SessionLocal()
+    try:
+        project = models.Project(name="unflushed-project")
+        db.add(project)
+        db.commit()
+        video = models.Video(
+            name="unflushed-video",
+            project_id=project.id,
+            preprocessing_status="in_progress",
+        )
+        db.add(video)
+        db.commit()
+        frame = models.Frame(
+            width=16,
+            height=16,
+            project_id=project.id,
+            video_id=video.id,
+            frame_url=frame_pack_url(str(tmp_path / PACK_NAME), 0),
+        )
+        db.add(frame)
+        db.commit()
+
+        # The pack hasn't been flushed while the video is being preprocessed
+        response = client.get(f"/frames/{frame.id}/image")
+        assert response.status_code == 409
+        response = client.get(f"/frames/{frame.id}/image?w=16")
+        assert response.status_code == 409
+
+        # Once preprocessing is over the image is simply missing
+        video.preprocessing_status = "failed"
+        db.commit()
+        response = client.get(f"/frames/{frame.id}/image")
+        assert response.status_code == 404
+    finally:
+        db.close()
+
+
+def test_workers_reclaim_videos_of_dead_workers():
+    import datetime
+    from sql_app import crud
+
+    db = SessionLocal()
+    try:
+        project = models.Project(name="reclaim-project")
+        db.add(project)
+        db.commit()
+        hour_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            hours=1
+        )
+        video = models.Video(
+            name="reclaim-video",
+            project_id=project.id,
+            preprocessing_status="in_progress",
+            claimed_at=hour_ago,
+            progress_updated_at=hour_ago,
+        )
+        db.add(video)
+        db.commit()
+
+        # Still within the time a worker has to save progress
+        assert crud.claim_queued_video(db, stale_after=2 * 3600) is None
+
+        claimed = crud.claim_queued_video(db, stale_after=600)
+        assert claimed.id == video.id
+        assert claimed.preprocessing_status == "in_progress"
+        assert claimed.claimed_at > hour_ago
+
+        # Claimed again just now, so nobody else takes it over
+        assert crud.claim_queued_video(db, stale_after=600) is None
+    finally:
+        db.close()
+
+
+def test_relabeling_skips_unconfident_predictions(monkeypatch):
+    from types import SimpleNamespace
+    from training_executor import relabel_unreviewed_boxes
+    from sql_app import crud
+
+    boxes = [
+        SimpleNamespace(id=box_id, label_id="person", image_features=None)
+        for box_id in range(3)
+    ]
+
+    class Classifier:
+        def predict(self, inputs, chunk_size):
+            return ["cat"] * len(inputs), [0.9, 0.4, 0.6]
+
+    saved = {}
+    monkeypatch.setattr(
+        crud, "get_unreviewed_boxes_by_video_id", lambda db, video_id: boxes
+    )
+    monkeypatch.setattr(
+        crud,
+        "update_predicted_box_labels",
+        lambda db, box_ids_by_label: saved.update(box_ids_by_label),
+    )
+    relabel_unreviewed_boxes(
+        None,
+        "video",
+        Classifier(),
+        {"person": "person", "cat": "cat"},
+        min_confidence=0.5,
+    )
+    assert saved == {"cat": [0, 2]}
+
+
+def test_export_picks_up_frame_images_replaced_under_the_same_url(tmp_path):
+    import os
+    from types import SimpleNamespace
+    from annotation_export import export_annotations
+
+    frame_path = tmp_path / "0.jpg"
+    frame_path.write_bytes(b"first")
+    row = SimpleNamespace(
+        frame_id="frame",
+        frame_url=str(frame_path),
+        frame_width=10,
+        frame_height=10,
+        box_id=None,
+    )
+    export_path = str(tmp_path / "export")
+    export_annotations([row], [], export_path)
+    exported_path = os.path.join(export_path, "frames", "frame.jpg")
+    assert open(exported_path, "rb").read() == b"first"
+
+    # A new image replaces the file, so the hard link still has the old one
+    frame_path.with_suffix(".tmp").write_bytes(b"second image")
+    os.replace(frame_path.with_suffix(".tmp"), frame_path)
+    stats = export_annotations([row], [], export_path)
+    assert stats["written"] == 1
+    assert open(exported_path, "rb").read() == b"second image"
+
+    stats = export_annotations([row], [], export_path)
+    assert stats["unchanged"] == 1
+
+
+def test_thumbnail_cache_limit_is_shared_between_processes(tmp_path):
+    from image_cache import ThumbnailCache
+
+    # Two API worker processes sharing the cache directory
+    cache = ThumbnailCache(str(tmp_path), max_bytes=100, rescan_bytes=1)
+    other_cache = ThumbnailCache(str(tmp_path), max_bytes=100, rescan_bytes=1)
+
+    cache.put("first", b"1" * 40)
+    assert other_cache.get("first") == b"1" * 40
+    other_cache.put("second", b"2" * 40)
+    cache.put("third", b"3" * 40)
+
+    # Together they stay within the limit by dropping the oldest variant
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 100
+    assert cache.get("first") is None
+    assert cache.get("second") == b"2" * 40
+    assert other_cache.get("third") == b"3" * 40
+
+
+def check_frame_pack_round_trip(storage, pack_path):
+    from frame_pack import open_frame_pack, frame_pack_url, read_packed_frame
+
+    frame_pack = open_frame_pack(storage, "project", pack_path, batch_bytes=64)
+    images = [bytes([index]) * (10 + index) for index in range(20)]
+    frame_urls = [frame_pack_url(pack_path, frame_pack.add(image)) for image in images]
+    frame_pack.close()
+
+    for frame_url, image in zip(frame_urls, images):
+        assert read_packed_frame(storage, "project", frame_url) == image
+
+    # Writing the pack again replaces what readers see
+    frame_pack = open_frame_pack(storage, "project", pack_path)
+    frame_pack.add(b"replaced")
+    frame_pack.close()
+    assert read_packed_frame(storage, "project", frame_urls[0]) == b"replaced"
+
+
+def test_frame_pack_round_trip(tmp_path):
+    from storage import LocalStorage, InMemoryStorage
+
+    check_frame_pack_round_trip(
+        LocalStorage(str(tmp_path)), str(tmp_path / "video" / "frames.pack")
+    )
+    check_frame_pack_round_trip(InMemoryStorage(), "video/frames/frames.pack")
+
+
+def test_invalidation_batch_notifies_once_per_interval():
+    from sql_app.cache import InvalidationBatch
+
+    batch = InvalidationBatch(interval=60)
+    # The first commit notifies right away, later ones wait for the interval
+    assert batch.add(["project-1"]) == {"project-1"}
+    assert batch.add(["project-1"]) == set()
+    assert batch.add(["project-2"]) == set()
+    assert batch.drain() == {"project-1", "project-2"}
+
+    batch = InvalidationBatch(interval=0)
+    batch.add(["project-1"])
+    assert batch.add(["project-1"]) == {"project-1"}
+
+
+def test_batch_uploader_writes_everything():
+    from storage import InMemoryStorage
+
+    storage = InMemoryStorage(upload_concurrency=4, latency=0.001)
+    uploads = storage.batch_uploader("project", max_pending=8)
+    for index in range(50):
+        uploads.write(f"video/frames/{index}.jpg", bytes([index]))
+    uploads.wait()
+    assert storage.read("project", "video/frames/49.jpg") == bytes([49])
+    assert len(storage.files) == 50
+
+
+def test_batch_uploader_cancel_drops_waiting_uploads():
+    from storage import InMemoryStorage
+
+    storage = InMemoryStorage(upload_concurrency=1, latency=0.05)
+    uploads = storage.batch_uploader("project", max_pending=8)
+    for index in range(8):
+        uploads.write(f"video/frames/{index}.jpg", bytes([index]))
+    uploads.cancel()
+
+    # Nothing is still uploading once cancel returns
+    written = len(storage.files)
+    assert written < 8
+    time.sleep(0.2)
+    assert len(storage.files) == written
+
+
+def test_incomplete_storage_backend_fails_on_creation():
+    from storage import InMemoryStorage, StorageBackend
+
+    class NoAppendStorage(StorageBackend):
+        create_project = InMemoryStorage.create_project
+        video_path = InMemoryStorage.video_path
+        write = InMemoryStorage.write
+        read_chunks = InMemoryStorage.read_chunks
+        read_range = InMemoryStorage.read_range
+        exists = InMemoryStorage.exists
+
+    try:
+        NoAppendStorage()
+        assert False, "a backend without open_append shouldn't be created"
+    except TypeError:
+        pass
+
+
+def test_feature_cache_grows_again_after_emptying():
+    import numpy as np
+    from model_training import FeatureMatrixCache
+
+    cache = FeatureMatrixCache()
+    cache.add(["a", "b"], np.ones((2, 4), dtype=np.float32))
+    # None of the cached boxes are reviewed any more
+    cache.retain(["c"])
+    assert len(cache) == 0
+
+    vectors = np.arange(3000 * 4, dtype=np.float32).reshape(3000, 4)
+    box_ids = [str(i) for i in range(3000)]
+    cache.add(box_ids, vectors)
+    assert len(cache) == 3000
+    assert (cache.rows(["2999", "0"]) == vectors[[2999, 0]]).all()
+
+    # Shrinking to a few rows and then growing past them works too
+    cache.retain(["0"])
+    cache.add(["new"], np.zeros((1, 4), dtype=np.float32))
+    assert len(cache) == 2
+
+
+def test_training_sample_and_feature_caches_stay_bounded():
+    from model_training import balanced_sample_indices, get_feature_cache
+
+    box_ids = [f"box-{i}" for i in range(500)]
+    labels = ["a" if i % 5 else "b" for i in range(500)]
+    sampled = balanced_sample_indices(labels, 50, keys=box_ids)
+    assert len(sampled) == 100
+
+    # Adding boxes only swaps in the new boxes that make the sample
+    more_ids = box_ids + [f"box-{i}" for i in range(500, 600)]
+    more_labels = labels + ["a"] * 100
+    resampled = balanced_sample_indices(more_labels, 50, keys=more_ids)
+    kept = set(more_ids[i] for i in resampled) & set(box_ids[i] for i in sampled)
+    new = [i for i in resampled if i >= 500]
+    assert len(kept) + len(new) == 100
+
+    # Only the most recently used project caches are kept
+    first = get_feature_cache("project-1", max_projects=2)
+    second = get_feature_cache("project-2", max_projects=2)
+    assert get_feature_cache("project-1", max_projects=2) is first
+    get_feature_cache("project-3", max_projects=2)
+    assert get_feature_cache("project-1", max_projects=2) is first
+    assert get_feature_cache("project-2", max_projects=2) is not second
+
+
+def test_lazy_model_loads_once():
+    from concurrent.futures import ThreadPoolExecutor
+    from model_provider import LazyModel
+
+    loads = []
+
+    def load():
+        time.sleep(0.05)
+        loads.append(1)
+        return object()
+
+    model = LazyModel(load)
+    assert not model.is_loaded()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        models_seen = list(pool.map(lambda _: model.get(), range(8)))
+    assert len(loads) == 1
+    assert all(seen is models_seen[0] for seen in models_seen)
+
+
+def test_micro_batcher_batches_concurrent_requests():
+    from concurrent.futures import ThreadPoolExecutor
+    from inference_server import MicroBatcher
+
+    batches = []
+
+    def run_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(run_batch, max_batch_size=4, max_wait=0.2)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: batcher.submit(i).result(), range(8)))
+    assert results == [i * 2 for i in range(8)]
+    # Full batches run without waiting for the deadline
+    assert all(len(batch) <= 4 for batch in batches)
+    assert len(batches) < 8
+
+    # A lone request runs once it has waited max_wait
+    start = time.monotonic()
+    assert batcher.submit(5).result() == 10
+    assert time.monotonic() - start < 1
+
+    def fail(items):
+        raise ValueError("model failed")
+
+    failing = MicroBatcher(fail, max_batch_size=4, max_wait=0.01)
+    future = failing.submit(1)
+    assert isinstance(future.exception(), ValueError)
+    batcher.close()
+    failing.close()
+
+
+def test_preprocessing_scheduler_priorities_and_admission():
+    import threading
+    from preprocessing_scheduler import PreprocessingScheduler, QueueFull, RERUN
+
+    scheduler = PreprocessingScheduler(max_jobs=1, max_queued=3)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def blocking_job():
+        started.set()
+        release.wait()
+
+    scheduler.submit("first", blocking_job, 100)
+    started.wait()
+
+    # Re-runs go last, smaller videos first
+    scheduler.submit("rerun", lambda: order.append("rerun"), 1, RERUN)
+    scheduler.submit("large", lambda: order.append("large"), 1000)
+    scheduler.submit("small", lambda: order.append("small"), 10)
+    try:
+        scheduler.submit("one too many", lambda: None, 1)
+        assert False, "the queue should be full"
+    except QueueFull:
+        pass
+    assert scheduler.retry_after() > 0
+
+    assert scheduler.cancel("large")
+    assert not scheduler.cancel("first")
+    release.set()
+
+    deadline = time.monotonic() + 5
+    while len(order) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert order == ["small", "rerun"]
+    scheduler.shutdown()
+
+
+def test_progress_tracker_saves_progress_and_estimates_time_left():
+    import datetime
+    from types import SimpleNamespace
+    from progress import ProgressTracker, video_progress, DETECT
+
+    saved = []
+    tracker = ProgressTracker(
+        100, lambda *progress: saved.append(progress), save_interval=3600
+    )
+    tracker.start()
+    with tracker.stage(DETECT):
+        time.sleep(0.01)
+    tracker.frame_done(30)
+    # Saved at most every save_interval
+    assert len(saved) == 1
+    # Stopping early saves the progress made so far
+    tracker.stop()
+    assert saved[-1][0] == 30
+    tracker.finish()
+    frames_processed, frames_per_second, stage_rates = saved[-1]
+    assert frames_processed == 100
+    assert frames_per_second > 0
+    assert 0 < stage_rates[DETECT] <= 100
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    video = SimpleNamespace(
+        id=uuid.uuid4(),
+        preprocessing_status="in_progress",
+        frames_total=100,
+        frames_processed=40,
+        processing_rate=10.0,
+        stage_rates={},
+        progress_updated_at=now - datetime.timedelta(seconds=2),
+    )
+    progress = video_progress(video, now)
+    assert progress["percent_processed"] == 40.0
+    assert progress["eta_seconds"] == 4.0
+
+
+def test_frame_hash_index_finds_near_duplicates():
+    import numpy as np
+    from frame_hashing import FrameHashIndex, hamming_distances
+
+    frame_hash = 0x0123456789ABCDEF
+    one_bit_off = frame_hash ^ (1 << 20)
+    unrelated = -0x0123456789ABCDEF
+    assert list(hamming_distances(np.array([frame_hash], dtype=np.int64), 0)) == [
+        bin(frame_hash).count("1")
+    ]
+
+    index = FrameHashIndex([("earlier video", frame_hash)])
+    assert index.nearest(one_bit_off, 4) == "earlier video"
+    assert index.nearest(unrelated, 4) is None
+    assert index.nearest(one_bit_off, 0) is None
+
+    # Of equally close frames the one added last is picked
+    index.add("previous frame", frame_hash)
+    assert index.nearest(one_bit_off, 4) == "previous frame"
+
+    for i in range(5000):
+        index.add(i, unrelated + i)
+    assert len(index) == 5002
+    assert index.nearest(frame_hash, 4) == "previous frame"
+
+
+def test_api_mode_does_not_import_vision_stack():
+    import os
+    import subprocess
+    import sys
+
+    code = (
+        "import sys, main; "
+        "print([m for m in ('cv2', 'torch', 'ultralytics', 'efficientnet_pytorch') "
+        "if m in sys.modules])"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "SERVER_MODE": "api"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_model_registry_checks_checksums(tmp_path):
+    from model_registry import ModelRegistry, ChecksumMismatch, version_tag
+
+    weights_path = tmp_path / "weights.pt"
+    weights_path.write_bytes(b"weights")
+
+    registry = ModelRegistry(str(tmp_path / "registry"))
+    assert registry.lookup("detector") is None
+    assert version_tag("detector", None) == "detector:pretrained"
+
+    artifact = registry.register("detector", "1.0", str(weights_path))
+    assert artifact.version == "1.0"
+    assert version_tag("detector", artifact) == "detector:1.0"
+    registry.verify(artifact)
+
+    # A file that no longer matches what was registered is refused
+    with open(artifact.path, "wb") as artifact_file:
+        artifact_file.write(b"tampered")
+    try:
+        registry.verify(artifact)
+        assert False, "expected a checksum mismatch"
+    except ChecksumMismatch:
+        pass
+
+
+def test_embedder_backends_match_eager(tmp_path):
+    import torch
+    from efficientnet_pytorch import EfficientNet
+    from inference_backends import BACKENDS, EMBEDDING_INPUT_SIZE, create_embedder
+
+    def load_model():
+        # Random weights are enough to compare the backends and need no download
+        torch.manual_seed(0)
+        return EfficientNet.from_name("efficientnet-b0").eval()
+
+    crops = torch.rand(5, 3, EMBEDDING_INPUT_SIZE, EMBEDDING_INPUT_SIZE)
+    expected = create_embedder("torch", load_model, str(tmp_path), "test").embed(crops)
+    assert expected.shape == (5, 1280, 2, 2)
+
+    for backend in BACKENDS:
+        embedder = create_embedder(backend, load_model, str(tmp_path), "test")
+        features = embedder.embed(crops)
+        assert features.shape == expected.shape, backend
+        assert torch.allclose(features, expected, atol=1e-4), backend
+
+        # A single crop gives the same features as it does within a batch
+        assert torch.allclose(embedder.embed(crops[2:3]), expected[2:3], atol=1e-4)
+
+
+def test_detector_backends_match_eager(tmp_path):
+    import cv2
+    from inference_backends import BACKENDS, create_detector
+
+    image = cv2.imread("./test_videos/test-screenshot.png")
+    expected = create_detector("torch", "yolov8n.pt", str(tmp_path), "test").detect(
+        image
+    )
+
+    for backend in BACKENDS:
+        results = create_detector(backend, "yolov8n.pt", str(tmp_path), "test").detect(
+            image
+        )
+        assert len(results.boxes) == len(expected.boxes), backend
+        for box, expected_box in zip(results.boxes, expected.boxes):
+            assert int(box.cls) == int(expected_box.cls), backend
+            assert (box.xyxy - expected_box.xyxy).abs().max() < 2, backend
+
+
+def test_quantized_classifier_agrees_with_original():
+    import pickle
+    import numpy as np
+    import torch
+    from model_training import (
+        ClassifierManager,
+        quantize_classifier,
+        prediction_agreement,
+    )
+
+    # Three well separated clusters of feature vectors
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(3, 64)).astype(np.float32) * 4
+    box_labels = [["car", "person", "dog"][i % 3] for i in range(300)]
+    box_vectors = np.stack(
+        [centers[i % 3] + rng.normal(size=64).astype(np.float32) for i in range(300)]
+    )
+    unique_labels = ["car", "person", "dog"]
+
+    manager = ClassifierManager(box_vectors, box_labels, unique_labels)
+    manager.fit()
+    quantized = quantize_classifier(manager.classifier)
+    assert prediction_agreement(manager.classifier, quantized, box_vectors) >= 0.98
+
+    manager = ClassifierManager.from_trained(
+        manager.classifier.state_dict(), 64, unique_labels, quantize=True
+    )
+    inputs = [pickle.dumps(torch.from_numpy(vector)) for vector in box_vectors[:30]]
+    predictions, confidences = manager.predict(inputs, chunk_size=8)
+    assert predictions == box_labels[:30]
+    assert all(0 < confidence <= 1 for confidence in confidences)
+
+
+def test_statically_quantized_embedder(tmp_path):
+    import torch
+    from efficientnet_pytorch import EfficientNet
+    from inference_backends import (
+        EMBEDDING_INPUT_SIZE,
+        OnnxEmbedder,
+        create_embedder,
+        embedder_export_path,
+    )
+    from quantization import quantize_embedder, feature_similarity
+
+    def load_model():
+        torch.manual_seed(0)
+        return EfficientNet.from_name("efficientnet-b0").eval()
+
+    torch.manual_seed(1)
+    crops = torch.rand(40, 3, EMBEDDING_INPUT_SIZE, EMBEDDING_INPUT_SIZE)
+    reference = create_embedder("onnx", load_model, str(tmp_path), "test")
+
+    # Not calibrated yet
+    try:
+        create_embedder("onnx-int8", load_model, str(tmp_path), "test")
+        assert False, "expected the quantized model to be missing"
+    except FileNotFoundError:
+        pass
+
+    quantize_embedder(
+        embedder_export_path("onnx", str(tmp_path), "test"),
+        embedder_export_path("onnx-int8", str(tmp_path), "test"),
+        crops[:32],
+    )
+    quantized = create_embedder("onnx-int8", load_model, str(tmp_path), "test")
+    assert isinstance(quantized, OnnxEmbedder)
+
+    features = quantized.embed(crops[32:])
+    assert features.shape == (8, 1280, 2, 2)
+    similarity = feature_similarity(reference.embed(crops[32:]), features)
+    assert similarity.mean() > 0.9
@@ -0,0 +1,113 @@
+import math
+
+import numpy as np
+
+# Timeline sprite sheets let the client scrub through a video by loading a
+# handful of images instead of one JPEG per frame. Every extracted frame is
+# shrunk to a small tile and the tiles are laid out left to right, top to
+# bottom on sheets of SHEET_COLUMNS x SHEET_ROWS tiles.
+#
+# The index saved next to the sheets (INDEX_NAME) describes the layout and
+# maps each frame index to its tile as [sheet number, x, y] in pixels. Since
+# frames aren't necessarily sampled at a fixed rate (see frame_sampling.py),
+# it also lists each tile's frame number in the video and timestamp in
+# seconds.
+#
+# OpenCV is imported where it's used so that the API server can read the
+# constants below without loading it.
+
+TILE_WIDTH = 160
+SHEET_COLUMNS = 10
+SHEET_ROWS = 10
+SHEET_QUALITY = 70
+INDEX_NAME = "index.json"
+
+
+def sheet_name(sheet_number):
+    return str(sheet_number) + ".jpg"
+
+
+class SpriteSheetBuilder:
+    def __init__(
+        self,
+        frame_width,
+        frame_height,
+        tile_width=TILE_WIDTH,
+        columns=SHEET_COLUMNS,
+        rows=SHEET_ROWS,
+        quality=SHEET_QUALITY,
+    ):
+        self.tile_width = min(tile_width, frame_width)
+        self.tile_height = max(1, round(frame_height * self.tile_width / frame_width))
+        self.columns = columns
+        self.rows = rows
+        self.quality = quality
+
+        self.sheet = None
+        self.tiles_on_sheet = 0
+        self.sheet_count = 0
+        self.tiles = []
+        self.frame_numbers = []
+        self.timestamps = []
+
+    # image = a decoded frame as returned by OpenCV
+    # Returns the encoded sheet once it is full, otherwise None
+    def add(self, image, frame_number, timestamp):
+        import cv2
+
+        if self.sheet is None:
+            self.sheet = np.zeros(
+                (self.rows * self.tile_height, self.columns * self.tile_width, 3),
+                dtype=np.uint8,
+            )
+
+        x = (self.tiles_on_sheet % self.columns) * self.tile_width
+        y = (self.tiles_on_sheet // self.columns) * self.tile_height
+        self.sheet[y : y + self.tile_height, x : x + self.tile_width] = cv2.resize(
+            image,
+            (self.tile_width, self.tile_height),
+            interpolation=cv2.INTER_AREA,
+        )
+        self.tiles.append([self.sheet_count, x, y])
+        self.frame_numbers.append(frame_number)
+        self.timestamps.append(timestamp)
+        self.tiles_on_sheet += 1
+
+        if self.tiles_on_sheet == self.columns * self.rows:
+            return self._encode_sheet()
+        return None
+
+    # Returns the last, partially filled sheet (or None if there isn't one)
+    def finish(self):
+        if self.sheet is None:
+            return None
+        # Leave off the rows that never got any tiles
+        used_rows = math.ceil(self.tiles_on_sheet / self.columns)
+        self.sheet = self.sheet[: used_rows * self.tile_height]
+        return self._encode_sheet()
+
+    def _encode_sheet(self):
+        import cv2
+
+        is_success, buffer = cv2.imencode(
+            ".jpg", self.sheet, [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        )
+        if not is_success:
+            raise ValueError("Could not encode timeline sprite sheet")
+        self.sheet = None
+        self.tiles_on_sheet = 0
+        self.sheet_count += 1
+        return buffer.tobytes()
+
+    def index(self):
+        return {
+            "tile_width": self.tile_width,
+            "tile_height": self.tile_height,
+            "columns": self.columns,
+            "rows": self.rows,
+            "frame_count": len(self.tiles),
+            "sheet_count": self.sheet_count,
+            "tiles": self.tiles,
+            "frame_numbers": self.frame_numbers,
+            "timestamps": self.timestamps,
+        }
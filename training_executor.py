@@ -0,0 +1,260 @@
+import asyncio
+import gc
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Runs label classifier training jobs in a pool of worker processes so that
+# training does not compete with the API worker for CPU, and so that several
+# projects retraining at once spread across cores. Each worker is limited to
+# a fixed number of torch threads to avoid oversubscribing the machine.
+#
+# The (potentially large) feature matrix is handed to the worker through a
+# shared memory block rather than being pickled through the pool's pipe.
+#
+# With quantize set, classifiers predict with INT8 weights, unless the
+# quantized classifier disagrees with the original one on more than
+# 1 - min_quantized_agreement of the boxes it was trained on.
+#
+# Jobs can also relabel a video's unreviewed boxes with the new classifier
+# right after training it, in the same worker process with a database session
+# of its own, so that prediction stays off the API process' CPU as well.
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker(torch_threads):
+    import torch
+
+    torch.set_num_threads(torch_threads)
+
+
+# Predicts new labels for the boxes in the video that nobody has reviewed,
+# streaming them from the database in chunks of chunk_size. Boxes only get
+# the predicted label when the classifier is at least min_confidence sure.
+def relabel_unreviewed_boxes(
+    db, video_id, model, label2id, chunk_size=1024, min_confidence=0.0
+):
+    from model_training import iterate_in_chunks
+    from sql_app import crud
+
+    unreviewed_boxes = crud.get_unreviewed_boxes_by_video_id(db, video_id)
+    changed_box_ids_by_label = {}
+    for chunk in iterate_in_chunks(unreviewed_boxes, chunk_size):
+        # Get new label predictions for each box
+        new_predictions, confidences = model.predict(
+            [box.image_features for box in chunk], chunk_size
+        )
+
+        # Only boxes whose predicted label actually changed need to be saved,
+        # grouped by their new label
+        for updated_label, confidence, box in zip(new_predictions, confidences, chunk):
+            if confidence < min_confidence:
+                continue
+            new_label_id = label2id[updated_label]
+            if new_label_id != box.label_id:
+                changed_box_ids_by_label.setdefault(new_label_id, []).append(box.id)
+
+    # Save updated label predictions in the database
+    crud.update_predicted_box_labels(db, changed_box_ids_by_label)
+
+
+# Whether to predict with the quantized classifier given how often it agrees
+# with the original one (None if it wasn't checked)
+def _use_quantized(project_id, agreement, min_quantized_agreement):
+    if agreement is None:
+        return False
+    if agreement < min_quantized_agreement:
+        logger.warning(
+            "Quantized classifier for project %s only agrees on %.3f of the "
+            "boxes, predicting with the original weights instead",
+            project_id,
+            agreement,
+        )
+        return False
+    return True
+
+
+# Runs inside a worker process and returns the trained classifier weights and
+# whether to predict with INT8 weights. With relabel (the arguments of
+# relabel_unreviewed_boxes besides db and model) the video's boxes are
+# relabeled first and nothing is returned.
+def _train_job(
+    shm_name,
+    shape,
+    dtype,
+    box_labels,
+    unique_labels,
+    project_id,
+    quantize,
+    min_quantized_agreement,
+    relabel,
+):
+    from model_training import (
+        ClassifierManager,
+        quantize_classifier,
+        prediction_agreement,
+    )
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        box_vectors = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        model = ClassifierManager(box_vectors, box_labels, unique_labels)
+        model.fit()
+        state_dict = model.classifier.state_dict()
+
+        agreement = None
+        if quantize:
+            agreement = prediction_agreement(
+                model.classifier, quantize_classifier(model.classifier), box_vectors
+            )
+
+        # Every view onto the shared buffer has to be gone before closing it
+        del model, box_vectors
+        gc.collect()
+    finally:
+        shm.close()
+
+    quantized = _use_quantized(project_id, agreement, min_quantized_agreement)
+    if relabel is None:
+        return state_dict, quantized
+
+    from sql_app.database import BackgroundSessionLocal
+
+    model = ClassifierManager.from_trained(
+        state_dict, shape[1], unique_labels, quantized
+    )
+    db = BackgroundSessionLocal()
+    try:
+        relabel_unreviewed_boxes(db, model=model, **relabel)
+    finally:
+        db.close()
+
+
+class TrainingExecutor:
+    def __init__(
+        self, max_workers, torch_threads, quantize=False, min_quantized_agreement=0.98
+    ):
+        self.max_workers = max_workers
+        self.torch_threads = torch_threads
+        self.quantize = quantize
+        self.min_quantized_agreement = min_quantized_agreement
+        self.pool = None
+        self.lock = threading.Lock()
+        # project ID -> (lock, number of train calls holding or waiting for
+        # it), dropped once no call needs it anymore
+        self.project_locks = {}
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # Spawn rather than fork so that workers don't inherit the
+                # API process' torch thread pools and open database connections
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.torch_threads,),
+                )
+            return self.pool
+
+    # box_vectors = 2D float32 array with one row of image features per box
+    # Returns the pool the job was submitted to and a concurrent.futures.Future
+    # for the job's result (see _train_job)
+    def submit(self, project_id, box_vectors, box_labels, unique_labels, relabel=None):
+        box_vectors = np.ascontiguousarray(box_vectors, dtype=np.float32)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, box_vectors.nbytes))
+        shared_vectors = np.ndarray(
+            box_vectors.shape, dtype=box_vectors.dtype, buffer=shm.buf
+        )
+        shared_vectors[:] = box_vectors
+        del shared_vectors
+
+        def release_shared_memory(_):
+            shm.close()
+            shm.unlink()
+
+        try:
+            pool = self._get_pool()
+            future = pool.submit(
+                _train_job,
+                shm.name,
+                box_vectors.shape,
+                box_vectors.dtype.str,
+                box_labels,
+                unique_labels,
+                str(project_id),
+                self.quantize,
+                self.min_quantized_agreement,
+                relabel,
+            )
+        except BrokenProcessPool:
+            release_shared_memory(None)
+            self._discard_broken_pool(pool)
+            raise
+        except Exception:
+            release_shared_memory(None)
+            raise
+        future.add_done_callback(release_shared_memory)
+        return pool, future
+
+    # A worker of the pool died (e.g. ran out of memory). Its other jobs fail
+    # too, so the pool is shut down without waiting and a fresh one is
+    # started for the next job, unless another job already replaced it.
+    def _discard_broken_pool(self, pool):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Trains a classifier for the project without blocking the event loop.
+    # Jobs for the same project run one at a time, jobs for different
+    # projects run in parallel up to max_workers.
+    #
+    # relabel = optional dict of the arguments of relabel_unreviewed_boxes
+    #           besides db and model (video_id, label2id and optionally
+    #           chunk_size and min_confidence), in which case the worker
+    #           relabels the boxes with the classifier and None is returned
+    # Otherwise returns the classifier as a ClassifierManager.
+    async def train(
+        self, project_id, box_vectors, box_labels, unique_labels, relabel=None
+    ):
+        from model_training import ClassifierManager
+
+        key = str(project_id)
+        project_lock, users = self.project_locks.get(key, (asyncio.Lock(), 0))
+        self.project_locks[key] = (project_lock, users + 1)
+        try:
+            async with project_lock:
+                pool, future = self.submit(
+                    project_id, box_vectors, box_labels, unique_labels, relabel
+                )
+                try:
+                    result = await asyncio.wrap_future(future)
+                except BrokenProcessPool:
+                    self._discard_broken_pool(pool)
+                    raise
+        finally:
+            project_lock, users = self.project_locks[key]
+            if users == 1:
+                del self.project_locks[key]
+            else:
+                self.project_locks[key] = (project_lock, users - 1)
+
+        if relabel is not None:
+            return None
+        state_dict, quantized = result
+        return ClassifierManager.from_trained(
+            state_dict, box_vectors.shape[1], unique_labels, quantized
+        )
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
@@ -0,0 +1,127 @@
+import argparse
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# Preprocesses the videos that an API server running in SERVER_MODE=api
+# queues, so that the API processes never load the computer vision stack:
+#
+#   python worker.py
+#
+# Any number of workers can run at once, each one claims --jobs queued videos
+# at a time. A worker's jobs share its models, which run the frames of all of
+# them in batches (see inference_server.py). The models are loaded when the
+# worker starts rather than when the first video arrives.
+#
+# Preprocessing saves the video's progress as it goes. A video whose progress
+# hasn't been saved for --stale-after seconds is taken to belong to a worker
+# that died, and is claimed again by the next worker looking for work.
+
+load_dotenv()
+
+from sql_app import crud
+from sql_app.cache import notify
+from sql_app.database import BackgroundSessionLocal
+from storage import create_storage_backend, video_files_path
+from similarity_search import INDEX_INVALIDATION_CHANNEL
+import model_provider
+from preprocessing import preprocess_video
+
+logger = logging.getLogger("worker")
+
+
+def process_video(db, storage, video):
+    project_name = video.project.name
+    try:
+        contents = storage.read(
+            project_name,
+            video_files_path(storage, project_name, video.name) + "/" + video.name,
+        )
+        preprocess_video(
+            contents,
+            storage,
+            project_name,
+            video.name,
+            video.id,
+            video.project_id,
+            db,
+        )
+    except Exception:
+        logger.exception("Failed to preprocess video %s", video.id)
+        db.rollback()
+        crud.set_video_preprocessing_status(db, video.id, "failed")
+        return
+
+    # The API servers' similarity indexes don't have this video's boxes yet
+    notify(db, INDEX_INVALIDATION_CHANNEL, [video.project_id])
+    db.commit()
+
+
+def process_queue(storage, poll_interval, stale_after):
+    while True:
+        db = BackgroundSessionLocal()
+        try:
+            video = crud.claim_queued_video(db, stale_after)
+            if video is None:
+                time.sleep(poll_interval)
+                continue
+            logger.info("Preprocessing video %s", video.id)
+            process_video(db, storage, video)
+        finally:
+            db.close()
+
+
+def run(poll_interval, jobs=1, stale_after=None):
+    storage = create_storage_backend()
+    model_provider.load_all()
+    logger.info("Models loaded, waiting for videos")
+
+    try:
+        threads = [
+            threading.Thread(
+                target=process_queue,
+                args=(storage, poll_interval, stale_after),
+                daemon=True,
+            )
+            for _ in range(jobs)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=float(os.getenv("WORKER_POLL_INTERVAL", "2")),
+        help="seconds to wait before looking again when no video is queued",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=int(os.getenv("WORKER_JOBS", "1")),
+        help="number of videos to preprocess at the same time",
+    )
+    parser.add_argument(
+        "--stale-after",
+        type=float,
+        default=float(os.getenv("WORKER_STALE_AFTER", "600")),
+        help="seconds without progress after which another worker's video is "
+        "claimed again",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run(args.poll_interval, args.jobs, args.stale_after)
+
+
+if __name__ == "__main__":
+    main()